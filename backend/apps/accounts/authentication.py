@@ -0,0 +1,61 @@
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from porcupine_backend.log import bind
+
+ACTIVE_USER_TIMEOUT = 60 * 5
+
+
+def active_user_key(user_id):
+    return f'user-active:{user_id}'
+
+
+def forget_active_user(user_id):
+    """Make the next request of this user load the row again, e.g. after deactivation"""
+    cache.delete(active_user_key(user_id))
+
+
+class LazyUser(SimpleLazyObject):
+    """
+    Request user that is only loaded from the database when something other
+    than its id is needed, so cached responses can be served without a query.
+    """
+
+    def __init__(self, func, user_id):
+        super().__init__(func)
+        # Stored directly so reading them does not trigger the lazy load
+        self.__dict__['id'] = user_id
+        self.__dict__['pk'] = user_id
+        self.__dict__['is_authenticated'] = True
+        self.__dict__['is_anonymous'] = False
+
+    def __bool__(self):
+        # IsAuthenticated checks `request.user and ...`; don't load for that
+        return True
+
+
+class LazyJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that defers the user lookup.
+
+    Whether the user still exists and is active is cached per user for
+    ACTIVE_USER_TIMEOUT (cleared when a user is deactivated or deleted). On a
+    hit the row is only fetched when the view touches it; on a miss it is
+    loaded and checked right away.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        bind(user_id=user_id)
+        if not cache.get(active_user_key(user_id)):
+            # Raises AuthenticationFailed for missing or inactive users
+            user = super().get_user(validated_token)
+            cache.set(active_user_key(user_id), True, ACTIVE_USER_TIMEOUT)
+            return user
+        return LazyUser(lambda: super(LazyJWTAuthentication, self).get_user(validated_token), user_id)
@@ -0,0 +1,157 @@
+"""
+Password hashing in a bounded process pool.
+
+PBKDF2 with Django's default iteration count takes a few hundred ms of CPU.
+Done on the request workers, a burst of logins or registrations competes
+with chat traffic for the same cores. PooledPBKDF2PasswordHasher produces
+and verifies the same `pbkdf2_sha256` hashes, but computes them in a small
+pool of low-priority worker processes. At most MAX_QUEUE hashes may be
+pending; beyond that the request fails fast with 503 and Retry-After.
+"""
+import base64
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.utils.encoding import force_bytes
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+logger = logging.getLogger(__name__)
+
+
+class HashingOverloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many sign-in attempts are being processed, try again shortly.'
+    default_code = 'hashing_overloaded'
+
+    def __init__(self, wait):
+        super().__init__()
+        self.wait = wait  # Sent as Retry-After by DRF's exception handler
+
+
+def pbkdf2_sha256(password, salt, iterations):
+    """Runs in a pool worker; `password` and `salt` are bytes"""
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+
+def lower_priority(niceness):
+    """Pool worker initializer: let request workers win the CPU"""
+    if niceness:
+        os.nice(niceness)
+
+
+class HashingPool:
+    """Process pool with a pending-job limit and counters"""
+
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.counters = {'completed': 0, 'rejected': 0, 'failed': 0}
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+
+    def get_executor(self):
+        config = settings.PASSWORD_HASHING
+        if self.executor is None:
+            # Not fork: the parent runs an event loop and other threads
+            self.executor = ProcessPoolExecutor(
+                max_workers=config['WORKERS'],
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=lower_priority,
+                initargs=(config['NICE'],),
+            )
+        return self.executor
+
+    def run(self, func, *args):
+        config = settings.PASSWORD_HASHING
+        with self.lock:
+            if self.pending >= config['MAX_QUEUE']:
+                self.counters['rejected'] += 1
+                raise HashingOverloaded(config['RETRY_AFTER'])
+            self.pending += 1
+            executor = self.get_executor()
+
+        started = time.perf_counter()
+        try:
+            future = executor.submit(func, *args)
+        except BrokenProcessPool:
+            self.job_done(None)
+            self.broken(executor)
+            raise HashingOverloaded(config['RETRY_AFTER'])
+        # A job counts against MAX_QUEUE until it has actually left the pool
+        future.add_done_callback(self.job_done)
+
+        try:
+            result = future.result(timeout=config['TIMEOUT'])
+        except BrokenProcessPool:
+            self.broken(executor)
+            raise HashingOverloaded(config['RETRY_AFTER'])
+        except TimeoutError:
+            # Drops the job if it is still queued; a running hash cannot be stopped
+            future.cancel()
+            with self.lock:
+                self.counters['failed'] += 1
+            raise HashingOverloaded(config['RETRY_AFTER'])
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.counters['completed'] += 1
+            self.wait_ms_total += elapsed_ms
+            self.wait_ms_max = max(self.wait_ms_max, elapsed_ms)
+        return result
+
+    def job_done(self, future):
+        with self.lock:
+            self.pending -= 1
+
+    def broken(self, executor):
+        logger.error('Password hashing pool broke, restarting it')
+        with self.lock:
+            if self.executor is executor:
+                self.executor = None
+            self.counters['failed'] += 1
+
+    def metrics(self):
+        with self.lock:
+            completed = self.counters['completed']
+            return {
+                **self.counters,
+                'pending': self.pending,
+                'workers': settings.PASSWORD_HASHING['WORKERS'],
+                'max_queue': settings.PASSWORD_HASHING['MAX_QUEUE'],
+                'avg_latency_ms': round(self.wait_ms_total / completed, 1) if completed else 0,
+                'max_latency_ms': round(self.wait_ms_max, 1),
+            }
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+
+pool = HashingPool()
+
+
+class PooledPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """PBKDF2PasswordHasher computing the hash in the hashing pool"""
+
+    def encode(self, password, salt, iterations=None):
+        self._check_encode_args(password, salt)
+        iterations = iterations or self.iterations
+        args = (force_bytes(password), force_bytes(salt), iterations)
+        if settings.PASSWORD_HASHING['WORKERS']:
+            hash = pool.run(pbkdf2_sha256, *args)
+        else:
+            hash = pbkdf2_sha256(*args)
+        hash = base64.b64encode(hash).decode('ascii').strip()
+        return '%s$%d$%s$%s' % (self.algorithm, iterations, salt, hash)
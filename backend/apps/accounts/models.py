@@ -0,0 +1,36 @@
+from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.contrib.auth.models import User
+
+
+class SupabaseIdentity(models.Model):
+    """Maps a legacy Supabase auth uid to the Django user it was imported as"""
+    supabase_uid = models.CharField(max_length=64, unique=True)
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='supabase_identity')
+    imported_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'supabase_identities'
+
+    def __str__(self):
+        return f"{self.user.username} ({self.supabase_uid})"
+
+
+def revoke_cached_access(user_id):
+    """A deactivated or deleted user must stop being served from caches at once"""
+    from apps.rooms.caching import bump_user
+    from .authentication import forget_active_user
+    forget_active_user(user_id)
+    bump_user(user_id)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, **kwargs):
+    if not created and not instance.is_active:
+        revoke_cached_access(instance.id)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    revoke_cached_access(instance.id)
@@ -0,0 +1,116 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.contrib.auth.models import User
+from django.test import override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from porcupine_backend.testing import SEED_PASSWORD, SeededAPITestCase
+from .hashers import HashingOverloaded, PooledPBKDF2PasswordHasher, pool
+
+
+class AccountQueryTests(SeededAPITestCase):
+
+    def test_register(self):
+        response = self.assertQueryBaseline('accounts.register', lambda: APIClient().post(reverse('register'), {
+            'username': 'newcomer',
+            'email': 'newcomer@example.com',
+            'password': SEED_PASSWORD,
+            'password_confirm': SEED_PASSWORD,
+        }))
+        self.assertEqual(response.status_code, 201)
+
+    def test_token_obtain(self):
+        response = self.assertQueryBaseline('accounts.token_obtain', lambda: APIClient().post(
+            reverse('token_obtain_pair'), {'username': self.user.username, 'password': SEED_PASSWORD}
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    def test_token_refresh(self):
+        refresh = str(RefreshToken.for_user(self.user))
+        response = self.assertQueryBaseline('accounts.token_refresh', lambda: APIClient().post(
+            reverse('token_refresh'), {'refresh': refresh}
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    def test_user_profile(self):
+        response = self.assertQueryBaseline('accounts.user_profile', lambda: self.client.get(reverse('user-profile')))
+        self.assertEqual(response.status_code, 200)
+
+    def test_logout(self):
+        response = self.assertQueryBaseline('accounts.logout', lambda: self.client.post(reverse('logout')))
+        self.assertEqual(response.status_code, 200)
+
+
+class PasswordHashingPoolTests(SeededAPITestCase):
+
+    def tearDown(self):
+        pool.shutdown()
+
+    @override_settings(PASSWORD_HASHING={**settings.PASSWORD_HASHING, 'WORKERS': 1})
+    def test_pool_hash_matches_pbkdf2(self):
+        hasher = PooledPBKDF2PasswordHasher()
+        encoded = hasher.encode('secret', 'salt1234', 1000)
+        self.assertEqual(encoded, PBKDF2PasswordHasher().encode('secret', 'salt1234', 1000))
+        self.assertTrue(hasher.verify('secret', encoded))
+        self.assertFalse(hasher.verify('wrong', encoded))
+        self.assertEqual(pool.metrics()['completed'], 3)
+
+    @override_settings(
+        PASSWORD_HASHERS=['apps.accounts.hashers.PooledPBKDF2PasswordHasher'],
+        PASSWORD_HASHING={**settings.PASSWORD_HASHING, 'WORKERS': 1, 'MAX_QUEUE': 0, 'RETRY_AFTER': 3},
+    )
+    def test_full_queue_sheds_registrations(self):
+        response = APIClient().post(reverse('register'), {
+            'username': 'newcomer',
+            'email': 'newcomer@example.com',
+            'password': SEED_PASSWORD,
+            'password_confirm': SEED_PASSWORD,
+        })
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertEqual(pool.metrics()['rejected'], 1)
+
+    @override_settings(PASSWORD_HASHING={**settings.PASSWORD_HASHING, 'WORKERS': 1, 'TIMEOUT': 0.05})
+    def test_timed_out_jobs_still_count_until_they_leave_the_pool(self):
+        executor = ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        release = threading.Event()
+        with mock.patch.object(pool, 'get_executor', return_value=executor):
+            with self.assertRaises(HashingOverloaded):
+                pool.run(release.wait)
+            self.assertEqual(pool.metrics()['pending'], 1)  # Still running
+
+            # Queued behind it: cancelled when it times out
+            with self.assertRaises(HashingOverloaded):
+                pool.run(release.wait)
+            self.assertEqual(pool.metrics()['pending'], 1)
+
+            release.set()
+            executor.submit(lambda: None).result()
+        self.assertEqual(pool.metrics()['pending'], 0)
+
+    @override_settings(PASSWORD_HASHING={**settings.PASSWORD_HASHING, 'WORKERS': 1, 'RETRY_AFTER': 4})
+    def test_broken_pool_is_overloaded_not_an_error(self):
+        future = Future()
+        future.set_exception(BrokenProcessPool())
+        executor = mock.Mock(submit=mock.Mock(return_value=future))
+        pool.executor = executor
+        with self.assertRaises(HashingOverloaded) as raised:
+            pool.run(len, b'')
+        self.assertEqual(raised.exception.wait, 4)
+        self.assertIsNone(pool.executor)
+        self.assertEqual(pool.metrics()['pending'], 0)
+
+    def test_metrics_are_staff_only(self):
+        self.assertEqual(self.client.get(reverse('hashing-metrics')).status_code, 403)
+        User.objects.filter(id=self.user.id).update(is_staff=True)
+        response = self.client.get(reverse('hashing-metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('pending', response.data)
@@ -14,4 +14,5 @@ urlpatterns = [
     path('register/', views.RegisterView.as_view(), name='register'),
     path('user/', views.UserProfileView.as_view(), name='user-profile'),
     path('logout/', views.LogoutView.as_view(), name='logout'),
+    path('hashing-metrics/', views.hashing_metrics, name='hashing-metrics'),
 ]
\ No newline at end of file
@@ -1,10 +1,11 @@
 from rest_framework import generics, status
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 from rest_framework.response import Response
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
+from .hashers import pool
 from .serializers import UserSerializer, RegisterSerializer
 
 
@@ -43,4 +44,11 @@ class LogoutView(generics.GenericAPIView):
     permission_classes = [IsAuthenticated]
     
     def post(self, request):
-        return logout_view(request)
\ No newline at end of file
+        return logout_view(request._request)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def hashing_metrics(request):
+    """Password hashing pool counters (staff only)"""
+    return Response(pool.metrics())
@@ -0,0 +1,177 @@
+"""
+Attachment storage.
+
+Clients encrypt files before upload; the server only stores opaque bytes.
+An upload is created with its total size and then sent in chunks, each
+PATCHed at the current offset and streamed straight to a partial file, so a
+dropped connection resumes from `received`. When the last byte arrives the
+file is hashed and moved into a content-addressed store
+(``<ROOT>/blobs/ab/cd/<sha256>``); identical content is kept once.
+
+Downloads are handed to the front proxy (X-Accel-Redirect or X-Sendfile),
+which serves ranges without the bytes passing through Django. Without a
+proxy, Django serves them itself, including single byte ranges.
+"""
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+
+from .models import Attachment, Blob
+
+COPY_BUFFER_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class OffsetMismatch(Exception):
+    """The chunk does not start at the upload's current offset"""
+
+
+def blob_name(sha256):
+    return os.path.join('blobs', sha256[:2], sha256[2:4], sha256)
+
+
+def blob_path(sha256):
+    return os.path.join(settings.ATTACHMENTS['ROOT'], blob_name(sha256))
+
+
+def partial_path(attachment_id):
+    return os.path.join(settings.ATTACHMENTS['ROOT'], 'partial', str(attachment_id))
+
+
+def write_chunk(attachment_id, offset, stream, length):
+    """
+    Write `length` bytes read from `stream` at `offset` and return the upload.
+
+    The row is only locked to check the offset and, once the chunk is on disk,
+    to advance `received`; it is not held while the client's body is read.
+    Of concurrent retries of the same chunk, the first to finish advances the
+    offset and the others get OffsetMismatch. The partial file is never
+    truncated, so a stale retry cannot cut off a later chunk; bytes past
+    `received` are overwritten by the next chunk or dropped by finalize.
+    """
+    with transaction.atomic():
+        attachment = Attachment.objects.select_for_update().get(id=attachment_id)
+        if attachment.is_complete or offset != attachment.received:
+            raise OffsetMismatch(attachment.received)
+        length = min(length, attachment.size - offset)
+
+    path = partial_path(attachment.id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining:
+            data = stream.read(min(COPY_BUFFER_SIZE, remaining))
+            if not data:
+                break
+            f.write(data)
+            remaining -= len(data)
+
+    with transaction.atomic():
+        attachment = Attachment.objects.select_for_update().get(id=attachment_id)
+        if attachment.is_complete or offset != attachment.received:
+            raise OffsetMismatch(attachment.received)
+        attachment.received = offset + length - remaining
+        attachment.save(update_fields=['received'])
+        if attachment.received == attachment.size:
+            finalize(attachment)
+    return attachment
+
+
+def finalize(attachment):
+    """Move a fully received upload into the content-addressed store"""
+    path = partial_path(attachment.id)
+    os.truncate(path, attachment.size)  # Drop anything a stale retry wrote past the end
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            digest.update(data)
+    sha256 = digest.hexdigest()
+
+    target = blob_path(sha256)
+    if os.path.exists(target):
+        os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    attachment.blob, _ = Blob.objects.get_or_create(sha256=sha256, defaults={'size': attachment.size})
+    attachment.completed_at = timezone.now()
+    attachment.save(update_fields=['blob', 'completed_at'])
+
+
+def delete_orphaned_blobs(sha256s):
+    """Delete the blobs among `sha256s` that no attachment references, with their files"""
+    for sha256 in sha256s:
+        if Blob.objects.filter(sha256=sha256, attachments__isnull=True).delete()[0]:
+            try:
+                os.remove(blob_path(sha256))
+            except FileNotFoundError:
+                pass
+
+
+def parse_range(header, size):
+    """(start, end) of a single `bytes=` range, inclusive; None if absent or unsatisfiable"""
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        start, end = max(0, size - int(end)), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end:
+        return None
+    return start, end
+
+
+def read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining:
+            data = f.read(min(COPY_BUFFER_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def download_response(attachment, range_header=''):
+    """Response serving an attachment's content"""
+    blob = attachment.blob
+    backend = settings.ATTACHMENTS['SENDFILE']
+
+    if backend:
+        # The proxy handles Range and If-Range against the stored file
+        response = HttpResponse(content_type='application/octet-stream')
+        if backend == 'nginx':
+            response['X-Accel-Redirect'] = settings.ATTACHMENTS['ACCEL_PREFIX'] + blob_name(blob.sha256)
+        else:
+            response['X-Sendfile'] = blob_path(blob.sha256)
+    else:
+        path = blob_path(blob.sha256)
+        byte_range = parse_range(range_header, blob.size) if range_header else None
+        if range_header and byte_range is None:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{blob.size}'
+            return response
+        if byte_range:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                read_range(path, start, end), status=206, content_type='application/octet-stream'
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{blob.size}'
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            response = FileResponse(open(path, 'rb'), content_type='application/octet-stream')
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = f'"{blob.sha256}"'
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
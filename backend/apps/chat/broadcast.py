@@ -0,0 +1,117 @@
+"""
+Room broadcast helpers.
+
+Events are JSON-encoded once by the sender and fanned out as text, so each
+recipient connection only concatenates strings. Connections that opt in to
+coalescing collect events for a short window and send them as one
+``{"type": "batch", "events": [...]}`` frame.
+"""
+import asyncio
+import json
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from rest_framework.utils.encoders import JSONEncoder
+
+# Events that only describe current state and may be dropped under load
+EPHEMERAL_KINDS = {'typing', 'presence'}
+
+
+def room_group_name(room_id):
+    """Channel layer group for a room (see porcupine_backend.channel_layers)"""
+    return f'room.{str(room_id).replace("-", "")}'
+
+
+def encode_event(payload):
+    return json.dumps(payload, cls=JSONEncoder, separators=(',', ':'))
+
+
+def make_room_event(kind, payload, key=None, seq=None):
+    """Build the channel layer message consumed by ChatConsumer.room_event"""
+    return {
+        'type': 'room.event',
+        'kind': kind,
+        'key': key,
+        'seq': seq,
+        'payload': payload if isinstance(payload, str) else encode_event(payload),
+    }
+
+
+def broadcast_to_room(room_id, event):
+    """Send a room event from synchronous code (views, tasks)"""
+    async_to_sync(get_channel_layer().group_send)(room_group_name(room_id), event)
+
+
+class Outbox:
+    """
+    Per-connection outgoing queue.
+
+    With window == 0 every event is sent as its own frame. Otherwise events
+    are held for `window` seconds and flushed as one batch frame. When more
+    than `max_pending` events are waiting, typing/presence events are dropped
+    first; if chat messages alone exceed the limit `overflowed` is set and the
+    connection should be closed so the client reconnects and catches up.
+    """
+
+    def __init__(self, send, window=0.0, max_pending=500):
+        self.send = send
+        self.window = window
+        self.max_pending = max_pending
+        self.pending = []  # (kind, key, encoded payload)
+        self.dropped = 0
+        self.overflowed = False
+        self._flush_task = None
+
+    async def push(self, kind, payload, key=None):
+        if not self.window:
+            await self.send(payload)
+            return
+
+        if key is not None:
+            # A newer typing/presence state for the same user replaces the queued one
+            self.pending = [entry for entry in self.pending if entry[1] != key]
+        self.pending.append((kind, key, payload))
+        if len(self.pending) > self.max_pending:
+            self._shed()
+
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    def _shed(self):
+        excess = len(self.pending) - self.max_pending
+        kept = []
+        for entry in self.pending:
+            if excess > 0 and entry[0] in EPHEMERAL_KINDS:
+                excess -= 1
+                self.dropped += 1
+                continue
+            kept.append(entry)
+        self.pending = kept
+        if excess > 0:
+            self.overflowed = True
+
+    async def _flush_loop(self):
+        try:
+            # Events pushed while a frame is being written are picked up by
+            # the next iteration instead of scheduling another task
+            while self.pending:
+                await asyncio.sleep(self.window)
+                await self.flush()
+        finally:
+            self._flush_task = None
+
+    async def flush(self):
+        if not self.pending:
+            return
+        entries, self.pending = self.pending, []
+        if len(entries) == 1:
+            frame = entries[0][2]
+        else:
+            frame = '{"type":"batch","events":[' + ','.join(entry[2] for entry in entries) + ']}'
+        await self.send(frame)
+
+    def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self.pending = []
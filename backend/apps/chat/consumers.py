@@ -0,0 +1,294 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from apps.rooms.models import Room, RoomMembership
+from apps.notifications.tasks import notify_new_message
+from porcupine_backend.log import bind, new_request_id
+from porcupine_backend.ratelimit import admission, limiter, track_queries
+from .broadcast import Outbox, make_room_event, room_group_name
+from .history import publish_message, resume_frame
+from .presence import heartbeat, leave
+from .serializers import MessageCreateSerializer
+
+logger = logging.getLogger(__name__)
+
+# Close codes
+CLOSE_FORBIDDEN = 4003
+CLOSE_SLOW_CONSUMER = 4008
+CLOSE_TRY_AGAIN_LATER = 1013
+
+MAX_KEY_EPOCH = 2 ** 31 - 1  # Message.key_epoch is an IntegerField
+
+
+class Rejected(Exception):
+    """A client frame that is refused with an error frame"""
+
+    def __init__(self, code, **fields):
+        super().__init__(code)
+        self.code = code
+        self.fields = fields
+
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    Real-time room channel at ws/chat/<room_id>/?token=<jwt>[&resume=<seq>]
+
+    With `resume`, the messages after that sequence number are sent first as
+    one `replay` frame (or a `snapshot` frame if too many were missed), and
+    live delivery continues from there without gaps or duplicates.
+
+    Client -> server:
+        {"type": "message", "encrypted_content": "...", "nonce": "...", "key_epoch": 3, "attachment": "<id>"}
+        {"type": "typing"}
+    Server -> client:
+        {"type": "message", "message": {...}}
+        {"type": "typing", "user_id": 1}
+        {"type": "presence", "user_id": 1, "status": "online"}
+        {"type": "expired", "message_ids": [...], "up_to_seq": 12}   (disappearing messages)
+        {"type": "key_request", "user_id": 7, "epoch": 3}   (a member joined; wrap your sender key for them)
+        {"type": "key_rotation", "epoch": 4}   (a member left; upload new sender keys)
+        {"type": "batch", "events": [...]}   (only with ?coalesce=1)
+        {"type": "replay" | "snapshot", "last_seq": 42, "events": [...]}
+        {"type": "error", "code": "rate_limited" | "overloaded", "retry_after": 1.5}
+        {"type": "error", "code": "invalid_message", "fields": ["nonce"]}   ("fields" only when validation failed)
+        {"type": "error", "code": "invalid_attachment" | "forbidden"}
+        {"type": "error", "code": "stale_key_epoch", "epoch": 4}   (fetch the sender keys of that epoch and resend)
+
+    Sends are validated like REST sends (MessageCreateSerializer). They are
+    refused with `forbidden` (and the socket closed with 4003) once
+    the user has left the room or the room was deleted, and with
+    `invalid_attachment` when the attachment is unknown, incomplete or from
+    another room. A nonzero key_epoch must be the room's current epoch.
+
+    New connections are closed with 1013 while admission control is shedding.
+    """
+
+    async def connect(self):
+        self.outbox = None
+        try:
+            # The route also matches dashless hex; rate limit and presence keys use the dashed form
+            self.room_id = str(uuid.UUID(self.scope['url_route']['kwargs']['room_id']))
+        except ValueError:
+            await self.close(code=CLOSE_FORBIDDEN)
+            return
+        self.room_group_name = room_group_name(self.room_id)
+        self.params = parse_qs(self.scope.get('query_string', b'').decode())
+        self.replaying = False
+        self.held_events = []
+        self.replayed_seq = 0
+        self.seen_seq = self.saved_seq = 0
+        self.presence_task = None
+        # Context ids for every record logged while handling this connection
+        bind(request_id=new_request_id(), room_id=self.room_id, user_id=None)
+
+        if not admission.admit():
+            await self.close(code=CLOSE_TRY_AGAIN_LATER)
+            return
+
+        self.user = await self.authenticate()
+        if self.user is None or not await self.is_member():
+            await self.close(code=CLOSE_FORBIDDEN)
+            return
+        bind(user_id=self.user.id)
+
+        broadcast_settings = settings.CHAT_BROADCAST
+        window = 0
+        if self.params.get('coalesce', ['0'])[0] == '1':
+            window = broadcast_settings['COALESCE_WINDOW_MS'] / 1000
+        self.outbox = Outbox(self.send_frame, window, broadcast_settings['MAX_PENDING'])
+
+        # Join the group before reading the gap so nothing published in
+        # between is lost; live events are held until the replay is sent.
+        resume = self.resume_cursor()
+        self.replaying = resume is not None
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.accept()
+        if self.replaying:
+            await self.replay(resume)
+        self.presence_task = asyncio.create_task(self.keep_presence())
+        await self.broadcast_presence('online')
+
+    async def disconnect(self, close_code):
+        if self.outbox is None:
+            return
+        self.outbox.close()
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if self.presence_task is not None:
+            self.presence_task.cancel()
+        await sync_to_async(leave, thread_sensitive=False)(self.room_id, self.user.id, self.channel_name)
+        await self.save_watermark()
+        await self.broadcast_presence('offline')
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data or '')
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            await self.send_error('invalid_message')
+            return
+
+        if data.get('type') == 'message' and data.get('encrypted_content'):
+            key_epoch = data.get('key_epoch', 0)
+            if type(key_epoch) is not int or not 0 <= key_epoch <= MAX_KEY_EPOCH:
+                await self.send_error('invalid_message')
+                return
+            if not await self.admit_message():
+                return
+            started = time.perf_counter()
+            try:
+                event = await self.create_message(data)
+            except Rejected as e:
+                await self.send_error(e.code, **e.fields)
+                if e.code == 'forbidden':
+                    await self.close(code=CLOSE_FORBIDDEN)
+                return
+            await self.channel_layer.group_send(self.room_group_name, event)
+            logger.info('Message %s sent', event['seq'], extra={
+                'latency_ms': round((time.perf_counter() - started) * 1000, 1)
+            })
+        elif data.get('type') == 'typing':
+            await self.channel_layer.group_send(
+                self.room_group_name,
+                make_room_event('typing', {'type': 'typing', 'user_id': self.user.id}, key=f'typing:{self.user.id}'),
+            )
+
+    async def admit_message(self):
+        """Apply admission control and the shared send limits, telling the client when refused"""
+        if not admission.admit():
+            code, retry_after = 'overloaded', settings.ADMISSION_CONTROL['RETRY_AFTER']
+        else:
+            allowed, retry_after = await sync_to_async(limiter.hit, thread_sensitive=False)(
+                'message', user=self.user.id, room=self.room_id
+            )
+            if allowed:
+                return True
+            code = 'rate_limited'
+        await self.send_error(code, retry_after=retry_after)
+        return False
+
+    async def send_error(self, code, **fields):
+        await self.send_frame(json.dumps({'type': 'error', 'code': code, **fields}))
+
+    async def room_event(self, event):
+        if self.replaying:
+            self.held_events.append(event)
+            return
+        seq = event.get('seq')
+        if seq is not None and seq <= self.replayed_seq:
+            return  # Already part of the replay
+        await self.outbox.push(event['kind'], event['payload'], event.get('key'))
+        if seq is not None:
+            self.seen_seq = max(self.seen_seq, seq)
+        if self.outbox.overflowed:
+            await self.close(code=CLOSE_SLOW_CONSUMER)
+
+    async def replay(self, after_seq):
+        frame, last_seq = await database_sync_to_async(resume_frame)(self.room_id, after_seq)
+        await self.send_frame(frame)
+        self.replayed_seq = last_seq
+        self.seen_seq = max(self.seen_seq, last_seq)
+        self.replaying = False
+        held, self.held_events = self.held_events, []
+        for event in held:
+            await self.room_event(event)
+
+    async def keep_presence(self):
+        """Heartbeat presence and persist the watermark while connected"""
+        interval = settings.CHAT_PRESENCE['TTL'] / 3
+        while True:
+            await sync_to_async(heartbeat, thread_sensitive=False)(self.room_id, self.user.id, self.channel_name)
+            await self.save_watermark()
+            await asyncio.sleep(interval)
+
+    async def save_watermark(self):
+        """Record the newest message delivered here, so offline notifications skip it"""
+        if self.seen_seq > self.saved_seq:
+            seq = self.seen_seq
+            await database_sync_to_async(RoomMembership.mark_seen)(self.room_id, self.user.id, seq)
+            self.saved_seq = seq
+
+    def resume_cursor(self):
+        try:
+            return int(self.params['resume'][0])
+        except (KeyError, ValueError):
+            return None
+
+    async def send_frame(self, text):
+        await self.send(text_data=text)
+
+    async def broadcast_presence(self, status):
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            make_room_event(
+                'presence',
+                {'type': 'presence', 'user_id': self.user.id, 'status': status},
+                key=f'presence:{self.user.id}',
+            ),
+        )
+
+    @database_sync_to_async
+    def authenticate(self):
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated:
+            return user
+
+        token = self.params.get('token', [None])[0]
+        if not token:
+            return None
+        authentication = JWTAuthentication()
+        try:
+            return authentication.get_user(authentication.get_validated_token(token))
+        except (InvalidToken, TokenError):
+            return None
+
+    @database_sync_to_async
+    def is_member(self):
+        # Timed, so connects admitted as probes while shedding measure the database
+        with track_queries():
+            return RoomMembership.objects.filter(
+                room_id=self.room_id,
+                room__is_active=True,
+                user=self.user,
+                is_active=True
+            ).exists()
+
+    @database_sync_to_async
+    def create_message(self, data):
+        with track_queries():
+            # Membership is checked again: the user may have left since connecting
+            room = Room.objects.filter(
+                id=self.room_id, is_active=True, memberships__user=self.user, memberships__is_active=True
+            ).first()
+            if room is None:
+                raise Rejected('forbidden')
+            # Same validation as REST sends
+            serializer = MessageCreateSerializer(data={
+                'room': room.id,
+                'encrypted_content': data['encrypted_content'],
+                'nonce': data.get('nonce', ''),
+                'key_epoch': data.get('key_epoch', 0),
+                'attachment': data.get('attachment'),
+            }, context={'room_id': room.id})
+            if not serializer.is_valid():
+                if 'attachment' in serializer.errors:
+                    raise Rejected('invalid_attachment')
+                if [error.code for error in serializer.errors.get('key_epoch', [])] == ['stale_epoch']:
+                    raise Rejected('stale_key_epoch', epoch=room.key_epoch)
+                raise Rejected('invalid_message', fields=sorted(serializer.errors))
+            attachment = serializer.validated_data.get('attachment')
+            message = serializer.save(
+                room=room, sender=self.user, message_type='attachment' if attachment else 'text'
+            )
+        notify_new_message(message)
+        return publish_message(message)
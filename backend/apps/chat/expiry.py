@@ -0,0 +1,174 @@
+"""
+Disappearing messages.
+
+Rooms with a `message_ttl` have their next expiry deadline (oldest message
+timestamp + ttl) in a Redis sorted set, so the expiry worker only touches
+rooms that are due instead of scanning every room's messages. Sending a
+message adds the room with ZADD LT, which keeps the earliest deadline.
+
+A due room is claimed with ZREM (only one worker wins), its expired messages
+are deleted oldest first in batches bounded by the cutoff timestamp through
+the (room, timestamp) index, together with the attachments (and stored
+blobs) only they referenced. Each batch is broadcast and dropped from the
+resume cache, and the room is put back with its next deadline.
+"""
+import logging
+import time
+from datetime import timedelta
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from apps.rooms.models import Room
+from .attachments import delete_orphaned_blobs
+from .broadcast import broadcast_to_room, make_room_event
+from .history import forget_through
+from .models import Attachment, Message
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = 'porcupine:expiry:rooms'
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.MESSAGE_EXPIRY['QUEUE_URL'])
+    return _client
+
+
+def schedule(room_id, deadline):
+    """Make sure the room is looked at no later than `deadline` (a datetime)"""
+    try:
+        get_client().zadd(QUEUE_KEY, {str(room_id): deadline.timestamp()}, lt=True)
+    except redis.RedisError:
+        logger.warning('Could not schedule expiry for room %s', room_id, exc_info=True)
+
+
+def schedule_message(message, room):
+    if room.message_ttl:
+        schedule(room.id, message.timestamp + timedelta(seconds=room.message_ttl))
+
+
+def reschedule_room(room):
+    """Recompute a room's deadline, e.g. after its TTL changed"""
+    try:
+        get_client().zrem(QUEUE_KEY, str(room.id))
+    except redis.RedisError:
+        logger.warning('Could not reschedule expiry for room %s', room.id, exc_info=True)
+        return
+    if room.message_ttl:
+        oldest = Message.objects.filter(room=room).aggregate(oldest=Min('timestamp'))['oldest']
+        if oldest is not None:
+            schedule(room.id, oldest + timedelta(seconds=room.message_ttl))
+
+
+def rebuild_schedule():
+    """Schedule every room with a TTL from the database, e.g. after Redis lost its data"""
+    rooms = Room.objects.filter(message_ttl__isnull=False).annotate(oldest=Min('messages__timestamp'))
+    count = 0
+    for room in rooms.exclude(oldest=None):
+        schedule(room.id, room.oldest + timedelta(seconds=room.message_ttl))
+        count += 1
+    return count
+
+
+def claim_due(now, limit):
+    """Room ids whose deadline has passed, removed from the queue for this worker"""
+    client = get_client()
+    due = client.zrangebyscore(QUEUE_KEY, '-inf', now.timestamp(), start=0, num=limit)
+    return [room_id.decode() for room_id in due if client.zrem(QUEUE_KEY, room_id)]
+
+
+def expire_room(room_id, now=None):
+    """
+    Delete a room's expired messages and schedule its next deadline.
+
+    Returns the number of messages deleted. A room with more than
+    BATCH_SIZE * MAX_BATCHES expired messages is requeued as due right away
+    so other rooms get their turn.
+    """
+    now = now or timezone.now()
+    room = Room.objects.filter(id=room_id).only('id', 'message_ttl').first()
+    if room is None or not room.message_ttl:
+        return 0
+
+    cutoff = now - timedelta(seconds=room.message_ttl)
+    batch_size = settings.MESSAGE_EXPIRY['BATCH_SIZE']
+    deleted = 0
+    for _ in range(settings.MESSAGE_EXPIRY['MAX_BATCHES']):
+        batch = expire_batch(room.id, cutoff, batch_size)
+        deleted += batch
+        if batch < batch_size:
+            break
+    else:
+        schedule(room.id, now)
+        return deleted
+
+    oldest = Message.objects.filter(room=room).aggregate(oldest=Min('timestamp'))['oldest']
+    if oldest is not None:
+        schedule(room.id, oldest + timedelta(seconds=room.message_ttl))
+    return deleted
+
+
+def expire_batch(room_id, cutoff, batch_size):
+    """Delete up to `batch_size` of the room's messages older than `cutoff`, oldest first"""
+    with transaction.atomic():
+        expired = list(
+            Message.objects.filter(room_id=room_id, timestamp__lt=cutoff)
+            .order_by('timestamp').values_list('id', 'seq', 'attachment_id')[:batch_size]
+        )
+        if not expired:
+            return 0
+        ids = [message_id for message_id, _, _ in expired]
+        up_to_seq = max(seq for _, seq, _ in expired)
+        attachment_ids = {attachment_id for _, _, attachment_id in expired if attachment_id}
+        Message.objects.filter(id__in=ids).delete()
+        # The files disappear with the messages, unless another message still shares them
+        attachments = Attachment.objects.filter(id__in=attachment_ids, messages__isnull=True)
+        sha256s = set(attachments.exclude(blob=None).values_list('blob_id', flat=True))
+        attachments.delete()
+
+    if sha256s:
+        delete_orphaned_blobs(sha256s)
+
+    forget_through(room_id, up_to_seq)
+    broadcast_to_room(room_id, make_room_event('expired', {
+        'type': 'expired', 'message_ids': ids, 'up_to_seq': up_to_seq
+    }))
+    return len(ids)
+
+
+def run_due(limit=100):
+    """
+    Expire every due room; returns (rooms, messages) processed.
+
+    A room that fails is logged and put back to be retried after
+    POLL_INTERVAL, and the other claimed rooms are still processed, since
+    they are no longer in the queue.
+    """
+    now = timezone.now()
+    retry_at = now + timedelta(seconds=settings.MESSAGE_EXPIRY['POLL_INTERVAL'])
+    rooms = messages = 0
+    for room_id in claim_due(now, limit):
+        try:
+            messages += expire_room(room_id, now)
+        except Exception:
+            logger.exception('Could not expire messages in room %s', room_id)
+            schedule(room_id, retry_at)
+            continue
+        rooms += 1
+    return rooms, messages
+
+
+def seconds_until_next(default):
+    """Time until the earliest deadline in the queue, capped at `default`"""
+    first = get_client().zrange(QUEUE_KEY, 0, 0, withscores=True)
+    if not first:
+        return default
+    return max(0, min(default, first[0][1] - time.time()))
@@ -0,0 +1,118 @@
+"""
+Reconnect resume.
+
+Every broadcast message is also kept in a per-room Redis sorted set scored by
+its sequence number. A reconnecting client sends the last sequence number it
+saw; the gap is replayed from that hot cache when it holds every missing
+message, otherwise from the (room, seq) index. Gaps larger than MAX_GAP get
+a snapshot of the latest messages instead.
+
+The same hooks bump the room's history version, which invalidates its cached
+REST history pages.
+"""
+import logging
+
+import redis
+from django.conf import settings
+
+from apps.rooms.caching import bump, room_history_version_key
+from apps.rooms.models import Room
+from .broadcast import encode_event, make_room_event, room_group_name
+from .models import Message
+from .serializers import MessageSerializer
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.CHAT_RESUME['CACHE_URL'])
+    return _client
+
+
+def cache_key(room_id):
+    return f'porcupine:recent:{room_group_name(room_id)}'
+
+
+def message_event(message):
+    """Encoded `message` event as sent to clients"""
+    return encode_event({'type': 'message', 'message': MessageSerializer(message).data})
+
+
+def remember(message, payload):
+    """Add an encoded message event to the room's hot cache"""
+    key = cache_key(message.room_id)
+    try:
+        pipe = get_client().pipeline()
+        pipe.zadd(key, {payload: message.seq})
+        pipe.zremrangebyrank(key, 0, -settings.CHAT_RESUME['CACHE_SIZE'] - 1)
+        pipe.expire(key, settings.CHAT_RESUME['CACHE_TTL'])
+        pipe.execute()
+    except redis.RedisError:
+        logger.warning('Could not cache message %s for resume', message.id, exc_info=True)
+
+
+def publish_message(message):
+    """Encode a new message once, cache it for resume and return its room event"""
+    payload = message_event(message)
+    remember(message, payload)
+    bump(room_history_version_key(message.room_id))
+    return make_room_event('message', payload, seq=message.seq)
+
+
+def forget(message):
+    """Drop a message from the hot cache, e.g. after it was deleted or edited"""
+    bump(room_history_version_key(message.room_id))
+    try:
+        get_client().zremrangebyscore(cache_key(message.room_id), message.seq, message.seq)
+    except redis.RedisError:
+        logger.warning('Could not remove message %s from resume cache', message.id, exc_info=True)
+
+
+def forget_through(room_id, seq):
+    """Drop every cached message up to `seq`, e.g. after they expired"""
+    bump(room_history_version_key(room_id))
+    try:
+        get_client().zremrangebyscore(cache_key(room_id), '-inf', seq)
+    except redis.RedisError:
+        logger.warning('Could not remove expired messages of room %s from resume cache', room_id, exc_info=True)
+
+
+def cached_gap(room_id, after_seq, last_seq):
+    """Cached events in (after_seq, last_seq], or None unless every one is cached"""
+    try:
+        payloads = get_client().zrangebyscore(cache_key(room_id), f'({after_seq}', last_seq)
+    except redis.RedisError:
+        return None
+    if len(payloads) != last_seq - after_seq:
+        return None
+    return [payload.decode() for payload in payloads]
+
+
+def resume_frame(room_id, after_seq):
+    """
+    Build the frame sent to a client resuming after `after_seq`.
+
+    Returns (frame, last_seq): a `replay` frame with the missed messages, or a
+    `snapshot` frame with the latest messages when the gap is too large.
+    """
+    last_seq = Room.objects.values_list('last_message_seq', flat=True).get(id=room_id)
+    gap = last_seq - after_seq
+    messages = Message.objects.filter(room_id=room_id, is_active=True).select_related('sender')
+
+    if gap > settings.CHAT_RESUME['MAX_GAP'] or after_seq < 0:
+        kind = 'snapshot'
+        latest = messages.filter(seq__lte=last_seq).order_by('-seq')[:settings.CHAT_RESUME['SNAPSHOT_SIZE']]
+        payloads = [message_event(message) for message in reversed(latest)]
+    else:
+        kind = 'replay'
+        payloads = [] if gap <= 0 else cached_gap(room_id, after_seq, last_seq)
+        if payloads is None:
+            gap_messages = messages.filter(seq__gt=after_seq, seq__lte=last_seq).order_by('seq')
+            payloads = [message_event(message) for message in gap_messages]
+
+    frame = f'{{"type":"{kind}","last_seq":{last_seq},"events":[{",".join(payloads)}]}}'
+    return frame, last_seq
@@ -0,0 +1,41 @@
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from porcupine_backend.channel_layers import configured_shards
+
+
+class Command(BaseCommand):
+    help = 'List, add or remove Redis shards of the channel layer without restarting workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['list', 'add', 'remove'])
+        parser.add_argument('addresses', nargs='*', help='Shard addresses, e.g. redis://redis-2:6379')
+
+    def handle(self, *args, **options):
+        layer_config = settings.CHANNEL_LAYERS['default']['CONFIG']
+        registry = layer_config.get('registry')
+        if not registry:
+            raise CommandError('The channel layer has no shard registry configured')
+
+        client = redis.Redis.from_url(registry['address'])
+        key = registry['key']
+        action = options['action']
+
+        if action != 'list' and not options['addresses']:
+            raise CommandError(f'{action} needs at least one shard address')
+
+        # Seed the registry with the statically configured shards on first use
+        if not client.exists(key):
+            client.sadd(key, *configured_shards(layer_config['hosts']))
+
+        if action == 'add':
+            client.sadd(key, *options['addresses'])
+        elif action == 'remove':
+            remaining = client.smembers(key) - {a.encode() for a in options['addresses']}
+            if not remaining:
+                raise CommandError('Refusing to remove every shard')
+            client.srem(key, *options['addresses'])
+
+        for address in sorted(member.decode() for member in client.smembers(key)):
+            self.stdout.write(address)
@@ -0,0 +1,40 @@
+import time
+
+import redis
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.chat.expiry import rebuild_schedule, run_due, seconds_until_next
+
+
+class Command(BaseCommand):
+    help = 'Delete messages past their room TTL (disappearing messages)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep running, waking up for each deadline')
+        parser.add_argument('--rebuild', action='store_true',
+                            help='Re-queue every room with a TTL from the database first')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.stdout.write(f'Scheduled {rebuild_schedule()} rooms')
+
+        interval = settings.MESSAGE_EXPIRY['POLL_INTERVAL']
+        while True:
+            try:
+                rooms, messages = run_due()
+                if rooms:
+                    self.stdout.write(f'Expired {messages} messages in {rooms} rooms')
+                delay = seconds_until_next(interval)
+            except redis.RedisError as e:
+                self.stderr.write(f'Expiry queue unavailable: {e}')
+                delay = interval
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                # Keep the worker alive through e.g. a database restart
+                self.stderr.write(f'Expiry failed: {e}')
+                delay = interval
+            if not options['loop']:
+                break
+            time.sleep(delay)
@@ -0,0 +1,42 @@
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.chat.attachments import delete_orphaned_blobs, partial_path
+from apps.chat.models import Attachment, Blob
+
+
+class Command(BaseCommand):
+    help = 'Delete abandoned attachment uploads and stored blobs no attachment references'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(seconds=settings.ATTACHMENTS['UPLOAD_EXPIRY'])
+        dry_run = options['dry_run']
+
+        abandoned = Attachment.objects.filter(completed_at__isnull=True, created_at__lt=cutoff)
+        abandoned_ids = list(abandoned.values_list('id', flat=True))
+        # Unreferenced blobs are left alone while fresh, so a concurrent
+        # upload of the same content can still link to them
+        orphaned = list(Blob.objects.filter(attachments__isnull=True, created_at__lt=cutoff)
+                        .values_list('sha256', flat=True))
+
+        if not dry_run:
+            for attachment_id in abandoned_ids:
+                self.remove(partial_path(attachment_id))
+            Attachment.objects.filter(id__in=abandoned_ids).delete()
+            delete_orphaned_blobs(orphaned)
+
+        verb = 'Would delete' if dry_run else 'Deleted'
+        self.stdout.write(f'{verb} {len(abandoned_ids)} abandoned uploads and {len(orphaned)} orphaned blobs')
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,13 +1,79 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 import uuid
 
 
+class MessageManager(models.Manager):
+    def create_for_room(self, room, sender, **fields):
+        """Create a message with the room's next sequence number and its recipient rows"""
+        from apps.rooms.models import Room
+
+        with transaction.atomic():
+            # The row lock taken by the update serializes sends within a room
+            Room.objects.filter(id=room.id).update(last_message_seq=F('last_message_seq') + 1)
+            room.last_message_seq = Room.objects.values_list('last_message_seq', flat=True).get(id=room.id)
+            message = self.create(room=room, sender=sender, seq=room.last_message_seq, **fields)
+
+            # Create message recipients for all active room members except the sender
+            member_ids = room.memberships.filter(is_active=True).exclude(
+                user=sender
+            ).values_list('user_id', flat=True)
+            MessageRecipient.objects.bulk_create([
+                MessageRecipient(message=message, user_id=user_id) for user_id in member_ids
+            ])
+
+            if room.message_ttl:
+                from .expiry import schedule_message
+                transaction.on_commit(lambda: schedule_message(message, room))
+
+        return message
+
+
+class Blob(models.Model):
+    """Stored attachment content, addressed by its SHA-256 so identical uploads share one file"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    size = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'attachment_blobs'
+
+    def __str__(self):
+        return self.sha256
+
+
+class Attachment(models.Model):
+    """A client-encrypted file uploaded to a room, referenced from messages by id"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey('rooms.Room', on_delete=models.CASCADE, related_name='attachments')
+    uploaded_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='attachments')
+    size = models.BigIntegerField()  # Declared size of the encrypted content
+    received = models.BigIntegerField(default=0)  # Bytes written so far, the resume offset
+    blob = models.ForeignKey(Blob, on_delete=models.PROTECT, null=True, blank=True, related_name='attachments')
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        db_table = 'attachments'
+        indexes = [
+            models.Index(fields=['completed_at', 'created_at']),
+        ]
+
+    @property
+    def is_complete(self):
+        return self.blob_id is not None
+
+    def __str__(self):
+        return f"Attachment {self.id} in {self.room.name}"
+
+
 class Message(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     room = models.ForeignKey('rooms.Room', on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='sent_messages')
     encrypted_content = models.TextField()
+    nonce = models.CharField(max_length=64, blank=True, default='')  # Base64 encoded AES-GCM nonce
     timestamp = models.DateTimeField(auto_now_add=True)
     message_type = models.CharField(
         max_length=20,
@@ -15,15 +81,24 @@ class Message(models.Model):
             ('text', 'Text'),
             ('system', 'System'),
             ('key_exchange', 'Key Exchange'),
+            ('attachment', 'Attachment'),
         ],
         default='text'
     )
     is_active = models.BooleanField(default=True)
+    seq = models.BigIntegerField(default=0)  # Per-room sequence number, used as resume cursor
+    key_epoch = models.IntegerField(default=0)  # Sender key epoch used; 0 for pairwise encryption
+    attachment = models.ForeignKey(
+        Attachment, on_delete=models.SET_NULL, null=True, blank=True, related_name='messages'
+    )
+
+    objects = MessageManager()
 
     class Meta:
         ordering = ['timestamp']
         indexes = [
             models.Index(fields=['room', 'timestamp']),
+            models.Index(fields=['room', 'seq']),
             models.Index(fields=['sender', 'timestamp']),
         ]
 
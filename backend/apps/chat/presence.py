@@ -0,0 +1,53 @@
+"""
+Room presence.
+
+Each open chat connection keeps a `<user_id>:<channel_name>` entry in a
+per-room Redis sorted set, scored by its last heartbeat. A user is online in
+a room while any of their entries is fresher than PRESENCE_TTL, so
+connections of a crashed worker age out on their own.
+"""
+import logging
+import time
+
+import redis
+from django.conf import settings
+
+from .broadcast import room_group_name
+from .history import get_client
+
+logger = logging.getLogger(__name__)
+
+
+def presence_key(room_id):
+    return f'porcupine:presence:{room_group_name(room_id)}'
+
+
+def heartbeat(room_id, user_id, channel_name):
+    ttl = settings.CHAT_PRESENCE['TTL']
+    key = presence_key(room_id)
+    try:
+        pipe = get_client().pipeline()
+        pipe.zadd(key, {f'{user_id}:{channel_name}': time.time()})
+        pipe.zremrangebyscore(key, '-inf', time.time() - ttl)
+        pipe.expire(key, ttl * 2)
+        pipe.execute()
+    except redis.RedisError:
+        logger.warning('Could not record presence in room %s', room_id, exc_info=True)
+
+
+def leave(room_id, user_id, channel_name):
+    try:
+        get_client().zrem(presence_key(room_id), f'{user_id}:{channel_name}')
+    except redis.RedisError:
+        logger.warning('Could not clear presence in room %s', room_id, exc_info=True)
+
+
+def online_users(room_id):
+    """Ids of users with a live connection to the room; empty if unknown"""
+    since = time.time() - settings.CHAT_PRESENCE['TTL']
+    try:
+        entries = get_client().zrangebyscore(presence_key(room_id), since, '+inf')
+    except redis.RedisError:
+        logger.warning('Could not read presence in room %s', room_id, exc_info=True)
+        return set()
+    return {int(entry.split(b':', 1)[0]) for entry in entries}
@@ -0,0 +1,6 @@
+from django.urls import re_path
+from . import consumers
+
+websocket_urlpatterns = [
+    re_path(r'ws/chat/(?P<room_id>[0-9a-f-]{32,36})/$', consumers.ChatConsumer.as_asgi()),
+]
@@ -1,7 +1,9 @@
 from rest_framework import serializers
+from django.conf import settings
 from django.contrib.auth.models import User
-from .models import Message, MessageRecipient
+from .models import Attachment, Message, MessageRecipient
 from apps.accounts.serializers import UserSerializer
+from apps.rooms.models import Room
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -11,10 +13,10 @@ class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
         fields = [
-            'id', 'room', 'sender', 'sender_id', 'encrypted_content', 
-            'timestamp', 'message_type', 'is_active'
+            'id', 'room', 'sender', 'sender_id', 'encrypted_content', 'nonce',
+            'timestamp', 'message_type', 'is_active', 'seq', 'key_epoch', 'attachment'
         ]
-        read_only_fields = ['id', 'timestamp', 'sender']
+        read_only_fields = ['id', 'timestamp', 'sender', 'seq']
 
     def create(self, validated_data):
         validated_data['sender'] = self.context['request'].user
@@ -24,11 +26,33 @@ class MessageSerializer(serializers.ModelSerializer):
 class MessageCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ['room', 'encrypted_content', 'message_type']
+        fields = ['room', 'encrypted_content', 'nonce', 'message_type', 'key_epoch', 'attachment']
+        extra_kwargs = {'key_epoch': {'min_value': 0}}
+
+    def validate(self, data):
+        # Views save the message to the room in their URL, passed as `room_id`
+        room_id = str(self.context.get('room_id', data['room'].id))
+        attachment = data.get('attachment')
+        if attachment is not None and (not attachment.is_complete or str(attachment.room_id) != room_id):
+            raise serializers.ValidationError({'attachment': 'Attachment is not uploaded to this room'})
+        # Sender-key messages must use the room's current epoch; 0 marks pairwise encryption
+        key_epoch = data.get('key_epoch', 0)
+        if key_epoch:
+            if str(data['room'].id) == room_id:
+                current = data['room'].key_epoch
+            else:
+                current = Room.objects.filter(id=room_id).values_list('key_epoch', flat=True).first()
+            if current is not None and key_epoch != current:
+                raise serializers.ValidationError(
+                    {'key_epoch': f'Key epoch {key_epoch} is stale, current epoch is {current}'},
+                    code='stale_epoch'
+                )
+        return data
 
     def create(self, validated_data):
-        validated_data['sender'] = self.context['request'].user
-        return super().create(validated_data)
+        if 'sender' not in validated_data:
+            validated_data['sender'] = self.context['request'].user
+        return Message.objects.create_for_room(**validated_data)
 
 
 class MessageRecipientSerializer(serializers.ModelSerializer):
@@ -37,4 +61,26 @@ class MessageRecipientSerializer(serializers.ModelSerializer):
     class Meta:
         model = MessageRecipient
         fields = ['id', 'message', 'user', 'delivered_at', 'read_at']
-        read_only_fields = ['id']
\ No newline at end of file
+        read_only_fields = ['id']
+
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    complete = serializers.BooleanField(source='is_complete', read_only=True)
+
+    class Meta:
+        model = Attachment
+        fields = ['id', 'room', 'uploaded_by', 'size', 'received', 'complete', 'created_at', 'completed_at']
+        read_only_fields = fields
+
+
+class AttachmentCreateSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Attachment
+        fields = ['size']
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.ATTACHMENTS['MAX_SIZE']:
+            raise serializers.ValidationError(
+                f"Size must be between 1 and {settings.ATTACHMENTS['MAX_SIZE']} bytes"
+            )
+        return value
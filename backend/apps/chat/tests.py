@@ -0,0 +1,623 @@
+import asyncio
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.db.backends.utils import CursorWrapper
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.accounts.authentication import active_user_key
+from apps.rooms.models import Room, RoomMembership
+from porcupine_backend.ratelimit import admission
+from porcupine_backend.testing import SEED_PASSWORD, QueryPlanTestCase, SeededAPITestCase
+from .attachments import OffsetMismatch, blob_path, write_chunk
+from .broadcast import Outbox, encode_event, room_group_name
+from .consumers import ChatConsumer
+from .expiry import expire_room, run_due
+from .models import Attachment, Blob, Message, MessageRecipient
+
+
+class MessageQueryTests(SeededAPITestCase):
+
+    def test_message_list(self):
+        response = self.assertQueryBaseline('chat.messages.list', lambda: self.client.get(
+            reverse('message-list-create', args=[self.room.id])
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    def test_message_list_after_seq(self):
+        response = self.assertQueryBaseline('chat.messages.after_seq', lambda: self.client.get(
+            reverse('message-list-create', args=[self.room.id]), {'after_seq': 15}
+        ))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 5)
+
+    def test_message_create(self):
+        response = self.assertQueryBaseline('chat.messages.create', lambda: self.client.post(
+            reverse('message-list-create', args=[self.room.id]),
+            {'room': self.room.id, 'encrypted_content': 'ciphertext', 'nonce': 'nonce'}
+        ))
+        self.assertEqual(response.status_code, 201)
+
+    def test_message_create_checks_key_epoch(self):
+        url = reverse('message-list-create', args=[self.room.id])
+        Room.objects.filter(id=self.room.id).update(key_epoch=3)
+        for key_epoch, status in ((2, 409), (4, 409), (3, 201), (0, 201)):
+            response = self.client.post(url, {
+                'room': self.room.id, 'encrypted_content': 'ciphertext', 'nonce': 'nonce', 'key_epoch': key_epoch
+            })
+            self.assertEqual(response.status_code, status, key_epoch)
+        response = self.client.post(url, {'room': self.room.id, 'encrypted_content': 'c', 'key_epoch': -1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_message_detail(self):
+        response = self.assertQueryBaseline('chat.message.detail', lambda: self.client.get(
+            reverse('message-detail', args=[self.message.id])
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    def test_message_delete(self):
+        response = self.assertQueryBaseline('chat.message.delete', lambda: self.client.delete(
+            reverse('message-detail', args=[self.message.id])
+        ))
+        self.assertEqual(response.status_code, 204)
+
+    @mock.patch('apps.chat.views.forget')
+    def test_message_edit_drops_resume_cache(self, forget):
+        response = self.client.patch(
+            reverse('message-detail', args=[self.message.id]), {'encrypted_content': 'edited'}
+        )
+        self.assertEqual(response.status_code, 200)
+        forget.assert_called_once()
+        self.assertEqual(forget.call_args.args[0].id, self.message.id)
+
+    def test_mark_delivered(self):
+        message = Message.objects.filter(room=self.room).exclude(sender=self.user).first()
+        response = self.assertQueryBaseline('chat.message.delivered', lambda: self.client.post(
+            reverse('message-delivered', args=[message.id])
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    def test_mark_read(self):
+        message = Message.objects.filter(room=self.room).exclude(sender=self.user).first()
+        response = self.assertQueryBaseline('chat.message.read', lambda: self.client.post(
+            reverse('message-read', args=[message.id])
+        ))
+        self.assertEqual(response.status_code, 200)
+
+
+class HistoryPageCacheTests(SeededAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('message-list-create', args=[self.room.id])
+
+    def test_page_is_shared_and_stored_compressed(self):
+        first = self.client.get(self.url, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(first['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(first.content))['count'], 20)
+
+        # Another member gets the stored bytes without touching the messages table
+        other = self.client_for(self.users[1])
+        second = self.assertQueryBaseline('chat.messages.list.cached', lambda: other.get(
+            self.url, HTTP_ACCEPT_ENCODING='gzip'
+        ))
+        self.assertEqual(second.content, first.content)
+
+        plain = other.get(self.url)
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertEqual(plain.content, gzip.decompress(first.content))
+
+        not_modified = other.get(self.url, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_writes_invalidate_pages(self):
+        self.client.get(self.url)
+        self.client.post(self.url, {'room': self.room.id, 'encrypted_content': 'ciphertext', 'nonce': 'nonce'})
+        self.assertEqual(self.client.get(self.url).json()['count'], 21)
+
+        self.client.patch(reverse('message-detail', args=[self.message.id]), {'encrypted_content': 'edited'})
+        edited = [m for m in self.client.get(self.url).json()['results'] if m['id'] == str(self.message.id)]
+        self.assertEqual(edited[0]['encrypted_content'], 'edited')
+
+        self.client.delete(reverse('message-detail', args=[self.message.id]))
+        self.assertEqual(self.client.get(self.url).json()['count'], 20)
+
+    def test_non_member_is_not_served_the_page(self):
+        self.client.get(self.url)
+        outsider = User.objects.create_user(username='outsider', password=SEED_PASSWORD)
+        self.assertEqual(self.client_for(outsider).get(self.url).json()['count'], 0)
+
+
+class ConsumerTests(SeededAPITestCase):
+    """Frame handling of ChatConsumer, with the database calls run in the test thread"""
+
+    def make_consumer(self, user=None):
+        consumer = ChatConsumer()
+        consumer.room_id = str(self.room.id)
+        consumer.room_group_name = room_group_name(self.room.id)
+        consumer.user = user or self.user
+        consumer.send_frame = mock.AsyncMock()
+        consumer.close = mock.AsyncMock()
+        consumer.channel_layer = mock.AsyncMock()
+        consumer.create_message = self.run_in_test_thread(ChatConsumer.__dict__['create_message'].func, consumer)
+        return consumer
+
+    def run_in_test_thread(self, func, consumer):
+        # Thread-sensitive sync_to_async runs in the thread blocked in async_to_sync,
+        # which holds the test transaction
+        async def call(*args):
+            return await sync_to_async(func)(consumer, *args)
+        return call
+
+    def receive(self, consumer, data):
+        async_to_sync(consumer.receive)(text_data=json.dumps(data))
+        return [json.loads(call.args[0]) for call in consumer.send_frame.await_args_list]
+
+    def connect(self, room_id):
+        consumer = ChatConsumer()
+        consumer.scope = {'url_route': {'kwargs': {'room_id': room_id}}, 'query_string': b''}
+        consumer.close = mock.AsyncMock()
+        consumer.authenticate = mock.AsyncMock(return_value=None)
+        async_to_sync(consumer.connect)()
+        return consumer
+
+    def test_room_id_is_normalized(self):
+        consumer = self.connect(self.room.id.hex)
+        self.assertEqual(consumer.room_id, str(self.room.id))
+        self.assertEqual(consumer.room_group_name, room_group_name(self.room.id))
+
+    def test_malformed_room_id_is_closed(self):
+        consumer = self.connect('-' * 32)
+        consumer.close.assert_awaited_once_with(code=4003)
+        consumer.authenticate.assert_not_awaited()
+
+    @override_settings(RATE_LIMITS={'message': {'user': (100, 100), 'room': (0.01, 1)}})
+    def test_room_limit_is_shared_with_rest(self):
+        response = self.client.post(
+            reverse('message-list-create', args=[self.room.id]),
+            {'room': self.room.id, 'encrypted_content': 'ciphertext', 'nonce': 'nonce'}
+        )
+        self.assertEqual(response.status_code, 201)
+
+        consumer = self.make_consumer(self.users[1])
+        consumer.room_id = self.connect(self.room.id.hex).room_id
+        frames = self.receive(consumer, {'type': 'message', 'encrypted_content': 'ciphertext'})
+        self.assertEqual(frames[-1]['code'], 'rate_limited')
+
+    def test_non_object_frames_are_rejected(self):
+        consumer = self.make_consumer()
+        for data in ([], 'x', 1):
+            self.assertEqual(self.receive(consumer, data)[-1], {'type': 'error', 'code': 'invalid_message'})
+
+    def test_send_after_leaving_is_refused(self):
+        consumer = self.make_consumer()
+        RoomMembership.objects.filter(room=self.room, user=self.user).update(is_active=False)
+        count = Message.objects.count()
+
+        frames = self.receive(consumer, {'type': 'message', 'encrypted_content': 'ciphertext'})
+
+        self.assertEqual(frames, [{'type': 'error', 'code': 'forbidden'}])
+        consumer.close.assert_awaited_once_with(code=4003)
+        self.assertEqual(Message.objects.count(), count)
+
+    def test_invalid_key_epoch_is_refused(self):
+        consumer = self.make_consumer()
+        count = Message.objects.count()
+        for key_epoch in ('3', -1, 1.5, True, 2 ** 40):
+            frames = self.receive(consumer, {'type': 'message', 'encrypted_content': 'c', 'key_epoch': key_epoch})
+            self.assertEqual(frames[-1], {'type': 'error', 'code': 'invalid_message'})
+        self.assertEqual(Message.objects.count(), count)
+
+    def test_stale_key_epoch_is_refused(self):
+        consumer = self.make_consumer()
+        Room.objects.filter(id=self.room.id).update(key_epoch=3)
+        count = Message.objects.count()
+
+        frames = self.receive(consumer, {'type': 'message', 'encrypted_content': 'c', 'key_epoch': 2})
+        self.assertEqual(frames[-1], {'type': 'error', 'code': 'stale_key_epoch', 'epoch': 3})
+        consumer.close.assert_not_awaited()
+        self.assertEqual(Message.objects.count(), count)
+
+        self.receive(consumer, {'type': 'message', 'encrypted_content': 'c', 'key_epoch': 3})
+        self.assertEqual(Message.objects.filter(room=self.room).order_by('-seq').first().key_epoch, 3)
+
+    def test_send_is_validated_like_rest(self):
+        consumer = self.make_consumer()
+        count = Message.objects.count()
+        for data, field in (
+            ({'encrypted_content': {'not': 'text'}}, 'encrypted_content'),
+            ({'encrypted_content': ['x']}, 'encrypted_content'),
+            ({'encrypted_content': 'c', 'nonce': 'n' * 65}, 'nonce'),
+        ):
+            frames = self.receive(consumer, {'type': 'message', **data})
+            self.assertEqual(frames[-1], {'type': 'error', 'code': 'invalid_message', 'fields': [field]})
+        consumer.close.assert_not_awaited()
+        self.assertEqual(Message.objects.count(), count)
+
+    def test_unusable_attachment_is_refused(self):
+        consumer = self.make_consumer()
+        count = Message.objects.count()
+        for attachment in ('not-a-uuid', '00000000-0000-0000-0000-000000000000'):
+            frames = self.receive(consumer, {'type': 'message', 'encrypted_content': 'key', 'attachment': attachment})
+            self.assertEqual(frames[-1], {'type': 'error', 'code': 'invalid_attachment'})
+        consumer.close.assert_not_awaited()
+        self.assertEqual(Message.objects.count(), count)
+
+    def test_member_can_send(self):
+        consumer = self.make_consumer()
+        self.assertEqual(self.receive(consumer, {'type': 'message', 'encrypted_content': 'ciphertext'}), [])
+        consumer.channel_layer.group_send.assert_awaited_once()
+
+
+class OutboxTests(SimpleTestCase):
+
+    def setUp(self):
+        self.frames = []
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    def event(self, kind, n):
+        return encode_event({'type': kind, 'n': n})
+
+    def batch(self):
+        return [(event['type'], event['n']) for event in json.loads(self.frames[-1])['events']]
+
+    async def test_sends_immediately_without_window(self):
+        outbox = Outbox(self.send)
+        await outbox.push('message', self.event('message', 1))
+        await outbox.push('message', self.event('message', 2))
+        self.assertEqual(self.frames, [self.event('message', 1), self.event('message', 2)])
+
+    async def test_coalesces_within_window(self):
+        outbox = Outbox(self.send, window=0.01)
+        for n in range(3):
+            await outbox.push('message', self.event('message', n))
+        self.assertEqual(self.frames, [])
+        await asyncio.sleep(0.05)
+        self.assertEqual(len(self.frames), 1)
+        self.assertEqual(self.batch(), [('message', 0), ('message', 1), ('message', 2)])
+
+        # A lone event is sent as itself, not as a batch
+        await outbox.push('message', self.event('message', 3))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.frames[-1], self.event('message', 3))
+
+    async def test_newer_state_replaces_queued_one(self):
+        outbox = Outbox(self.send, window=0.01)
+        await outbox.push('typing', self.event('typing', 1), key='typing:1')
+        await outbox.push('message', self.event('message', 2))
+        await outbox.push('typing', self.event('typing', 3), key='typing:1')
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.batch(), [('message', 2), ('typing', 3)])
+
+    async def test_sheds_ephemeral_events_first(self):
+        outbox = Outbox(self.send, window=0.01, max_pending=2)
+        await outbox.push('presence', self.event('presence', 1), key='presence:1')
+        await outbox.push('message', self.event('message', 2))
+        await outbox.push('typing', self.event('typing', 3), key='typing:2')
+        await outbox.push('message', self.event('message', 4))
+        self.assertEqual((outbox.dropped, outbox.overflowed), (2, False))
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.batch(), [('message', 2), ('message', 4)])
+
+    async def test_overflows_on_messages_alone(self):
+        outbox = Outbox(self.send, window=0.01, max_pending=2)
+        for n in range(3):
+            await outbox.push('message', self.event('message', n))
+        self.assertTrue(outbox.overflowed)
+        outbox.close()
+
+    async def test_close_drops_pending_events(self):
+        outbox = Outbox(self.send, window=0.01)
+        await outbox.push('message', self.event('message', 1))
+        outbox.close()
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.frames, [])
+
+
+class MessageQueryPlanTests(QueryPlanTestCase):
+
+    def test_history_plan(self):
+        self.assertUsesIndex(
+            'message_history',
+            Message.objects.filter(room=self.room, is_active=True).order_by('timestamp')[:10]
+        )
+
+    def test_resume_gap_plan(self):
+        self.assertUsesIndex(
+            'message_resume_gap',
+            Message.objects.filter(room=self.room, seq__gt=10, seq__lte=15, is_active=True).order_by('seq')
+        )
+
+    def test_expiry_plan(self):
+        self.assertUsesIndex(
+            'message_expiry',
+            Message.objects.filter(room=self.room, timestamp__lt=timezone.now()).order_by('timestamp')[:10]
+        )
+
+    def test_unread_plan(self):
+        self.assertUsesIndex(
+            'unread_receipts',
+            MessageRecipient.objects.filter(user=self.user, read_at__isnull=True)
+        )
+
+
+class MessageExpiryTests(SeededAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Ten messages an hour old, ten fresh
+        old = Message.objects.filter(room=self.room).order_by('seq')[:10]
+        Message.objects.filter(id__in=list(old.values_list('id', flat=True))).update(
+            timestamp=timezone.now() - timedelta(hours=1)
+        )
+        self.room.message_ttl = 600
+        self.room.save()
+
+    @mock.patch('apps.chat.expiry.broadcast_to_room')
+    @override_settings(MESSAGE_EXPIRY={**settings.MESSAGE_EXPIRY, 'BATCH_SIZE': 4})
+    def test_expires_in_batches(self, broadcast):
+        with mock.patch('apps.chat.expiry.schedule') as schedule:
+            self.assertEqual(expire_room(self.room.id), 10)
+
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 10)
+        self.assertEqual(Message.objects.filter(room=self.room).order_by('seq').first().seq, 11)
+        self.assertEqual(Message.objects.filter(room=self.rooms[1]).count(), 20)
+        self.assertFalse(MessageRecipient.objects.filter(message__room=self.room, message__seq__lte=10).exists())
+
+        events = [json.loads(call.args[1]['payload']) for call in broadcast.call_args_list]
+        self.assertEqual([len(event['message_ids']) for event in events], [4, 4, 2])
+        self.assertEqual(events[-1]['up_to_seq'], 10)
+
+        # Next deadline is the oldest remaining message + ttl
+        oldest = Message.objects.filter(room=self.room).order_by('timestamp').first().timestamp
+        schedule.assert_called_once_with(self.room.id, oldest + timedelta(seconds=600))
+
+    @mock.patch('apps.chat.expiry.broadcast_to_room')
+    @override_settings(MESSAGE_EXPIRY={**settings.MESSAGE_EXPIRY, 'BATCH_SIZE': 3, 'MAX_BATCHES': 2})
+    def test_large_backlog_is_requeued(self, broadcast):
+        now = timezone.now()
+        with mock.patch('apps.chat.expiry.schedule') as schedule:
+            self.assertEqual(expire_room(self.room.id, now), 6)
+        schedule.assert_called_once_with(self.room.id, now)
+
+    @mock.patch('apps.chat.expiry.broadcast_to_room')
+    def test_expired_attachments_are_deleted(self, broadcast):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        old, shared_old = Message.objects.filter(room=self.room).order_by('seq')[:2]
+        fresh = Message.objects.filter(room=self.room).order_by('-seq').first()
+
+        attachments = []
+        with override_settings(ATTACHMENTS={**settings.ATTACHMENTS, 'ROOT': root}):
+            for sha256 in ('a' * 64, 'b' * 64):
+                path = blob_path(sha256)
+                os.makedirs(os.path.dirname(path))
+                open(path, 'wb').close()
+                attachments.append(Attachment.objects.create(
+                    room=self.room, uploaded_by=self.user, size=0, blob=Blob.objects.create(sha256=sha256, size=0)
+                ))
+            expired, shared = attachments
+            Message.objects.filter(id=old.id).update(attachment=expired)
+            # Also sent in a message that has not expired yet
+            Message.objects.filter(id__in=[shared_old.id, fresh.id]).update(attachment=shared)
+
+            with mock.patch('apps.chat.expiry.schedule'):
+                expire_room(self.room.id)
+
+            self.assertFalse(Attachment.objects.filter(id=expired.id).exists())
+            self.assertFalse(Blob.objects.filter(sha256='a' * 64).exists())
+            self.assertFalse(os.path.exists(blob_path('a' * 64)))
+            self.assertEqual(Message.objects.get(id=fresh.id).attachment_id, shared.id)
+            self.assertTrue(os.path.exists(blob_path('b' * 64)))
+
+    def test_rooms_without_ttl_are_kept(self):
+        self.room.message_ttl = None
+        self.room.save()
+        self.assertEqual(expire_room(self.room.id), 0)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 20)
+
+    @mock.patch('apps.chat.expiry.schedule')
+    def test_failing_room_does_not_stop_the_others(self, schedule):
+        failing, other = self.rooms[1].id, self.room.id
+        with mock.patch('apps.chat.expiry.claim_due', return_value=[str(failing), str(other)]), \
+                mock.patch('apps.chat.expiry.expire_room', side_effect=[DatabaseError('gone'), 10]):
+            self.assertEqual(run_due(), (1, 10))
+
+        room_id, retry_at = schedule.call_args.args
+        self.assertEqual(room_id, str(failing))
+        self.assertGreater(retry_at, timezone.now())
+
+
+class MessageRateLimitTests(SeededAPITestCase):
+
+    def send(self, client, room=None):
+        room = room or self.room
+        return client.post(
+            reverse('message-list-create', args=[room.id]),
+            {'room': room.id, 'encrypted_content': 'ciphertext', 'nonce': 'nonce'}
+        )
+
+    @override_settings(RATE_LIMITS={'message': {'user': (0.01, 3)}})
+    def test_user_burst(self):
+        for _ in range(3):
+            self.assertEqual(self.send(self.client).status_code, 201)
+        response = self.send(self.client)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # Other users keep their own bucket
+        self.assertEqual(self.send(self.client_for(self.users[1])).status_code, 201)
+
+    @override_settings(RATE_LIMITS={'message': {'user': (100, 100), 'room': (0.01, 4)}})
+    def test_room_shared_by_members(self):
+        for user in self.users[:4]:
+            self.assertEqual(self.send(self.client_for(user)).status_code, 201)
+        self.assertEqual(self.send(self.client_for(self.users[4])).status_code, 429)
+        self.assertEqual(self.send(self.client, self.rooms[1]).status_code, 201)
+
+    @override_settings(ADMISSION_CONTROL={
+        **settings.ADMISSION_CONTROL,
+        'DB_LATENCY_THRESHOLD_MS': 5, 'RECOVERY_RATIO': 0.5, 'SMOOTHING': 0.5, 'RETRY_AFTER': 7
+    })
+    def test_sheds_sends_under_database_overload(self):
+        execute = CursorWrapper._execute
+
+        def slow(cursor, *args):
+            time.sleep(0.02)
+            return execute(cursor, *args)
+
+        # Every sender has authenticated recently, so sends do not query on their own
+        for user in self.users:
+            cache.set(active_user_key(user.id), True)
+
+        # Synthetic overload: every query takes 20ms while history is read
+        with mock.patch.object(CursorWrapper, '_execute', slow):
+            self.client.get(reverse('message-list-create', args=[self.room.id]))
+        self.assertFalse(admission.admit())
+
+        count = Message.objects.count()
+        responses = [self.send(self.client_for(user)) for user in self.users]
+        self.assertEqual({response.status_code for response in responses}, {429})
+        self.assertEqual(responses[0]['Retry-After'], '7')
+        self.assertEqual(Message.objects.count(), count)
+
+        # Fast queries bring the smoothed latency back under the recovery level
+        for _ in range(5):
+            self.client.get(reverse('message-list-create', args=[self.room.id]))
+        self.assertTrue(admission.admit())
+        self.assertEqual(self.send(self.client).status_code, 201)
+
+
+class AttachmentTests(SeededAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        override = override_settings(ATTACHMENTS={**settings.ATTACHMENTS, 'ROOT': root, 'SENDFILE': ''})
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def start(self, size, client=None):
+        response = (client or self.client).post(
+            reverse('attachment-create', args=[self.room.id]), {'size': size}, format='json'
+        )
+        self.assertEqual(response.status_code, 201)
+        return response.data['id']
+
+    def upload(self, attachment_id, offset, data, client=None):
+        return (client or self.client).generic(
+            'PATCH', reverse('attachment-upload', args=[attachment_id]), data,
+            content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset)
+        )
+
+    def test_chunked_resumable_upload(self):
+        content = os.urandom(1000)
+        attachment_id = self.start(len(content))
+        self.assertEqual(self.upload(attachment_id, 0, content[:400]).status_code, 200)
+
+        # A retried or out-of-order chunk is refused with the offset to resume from
+        response = self.upload(attachment_id, 0, content[:400])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Upload-Offset'], '400')
+
+        status = self.client.get(reverse('attachment-upload', args=[attachment_id]))
+        self.assertEqual((status.data['received'], status.data['complete']), (400, False))
+
+        response = self.upload(attachment_id, 400, content[400:])
+        self.assertTrue(response.data['complete'])
+        download = self.client_for(self.users[1]).get(reverse('attachment-download', args=[attachment_id]))
+        self.assertEqual(download.status_code, 200)
+        self.assertEqual(b''.join(download.streaming_content), content)
+
+    def test_stale_retry_does_not_cut_off_later_chunks(self):
+        content = os.urandom(1000)
+        attachment_id = self.start(len(content))
+        test = self
+
+        class SlowRetry(io.BytesIO):
+            """A retry of the first chunk whose body arrives after the upload moved on"""
+            def read(self, size=-1):
+                if not self.tell():
+                    test.upload(attachment_id, 0, content[:400])
+                    test.upload(attachment_id, 400, content[400:700])
+                return super().read(size)
+
+        with self.assertRaises(OffsetMismatch):
+            write_chunk(attachment_id, 0, SlowRetry(content[:400]), 400)
+        self.assertTrue(self.upload(attachment_id, 700, content[700:]).data['complete'])
+        download = self.client.get(reverse('attachment-download', args=[attachment_id]))
+        self.assertEqual(b''.join(download.streaming_content), content)
+
+    def test_identical_content_is_stored_once(self):
+        content = os.urandom(300)
+        first, second = self.start(len(content)), self.start(len(content), self.client_for(self.users[2]))
+        self.upload(first, 0, content)
+        self.upload(second, 0, content, self.client_for(self.users[2]))
+
+        self.assertEqual(Blob.objects.count(), 1)
+        self.assertEqual(Attachment.objects.get(id=first).blob_id, Attachment.objects.get(id=second).blob_id)
+        blobs = os.path.join(settings.ATTACHMENTS['ROOT'], 'blobs')
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(blobs)), 1)
+
+    def test_range_download(self):
+        content = os.urandom(500)
+        attachment_id = self.start(len(content))
+        self.upload(attachment_id, 0, content)
+        url = reverse('attachment-download', args=[attachment_id])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/500')
+        self.assertEqual(b''.join(response.streaming_content), content[100:200])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-50')
+        self.assertEqual(b''.join(response.streaming_content), content[-50:])
+        self.assertEqual(self.client.get(url, HTTP_RANGE='bytes=600-').status_code, 416)
+
+        with override_settings(ATTACHMENTS={**settings.ATTACHMENTS, 'SENDFILE': 'nginx'}):
+            response = self.client.get(url)
+        sha256 = Attachment.objects.get(id=attachment_id).blob_id
+        self.assertEqual(
+            response['X-Accel-Redirect'], f'/protected/attachments/blobs/{sha256[:2]}/{sha256[2:4]}/{sha256}'
+        )
+
+    def test_message_references_attachment(self):
+        attachment_id = self.start(10)
+        url = reverse('message-list-create', args=[self.room.id])
+        message = {'room': self.room.id, 'encrypted_content': 'key-and-name', 'attachment': attachment_id}
+
+        # Incomplete uploads and other rooms' attachments cannot be referenced
+        self.assertEqual(self.client.post(url, message).status_code, 400)
+        self.upload(attachment_id, 0, b'0123456789')
+        other_room = reverse('message-list-create', args=[self.rooms[1].id])
+        self.assertEqual(self.client.post(other_room, {**message, 'room': self.rooms[1].id}).status_code, 400)
+
+        self.assertEqual(self.client.post(url, message).status_code, 201)
+        self.assertTrue(Message.objects.filter(attachment_id=attachment_id).exists())
+
+    def test_attachment_room_is_checked_against_the_url(self):
+        # Uploaded to room A and named in the body, but posted to room B's URL
+        attachment_id = self.start(10)
+        self.upload(attachment_id, 0, b'0123456789')
+        response = self.client.post(
+            reverse('message-list-create', args=[self.rooms[1].id]),
+            {'room': self.room.id, 'encrypted_content': 'key-and-name', 'attachment': attachment_id}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.filter(attachment_id=attachment_id).exists())
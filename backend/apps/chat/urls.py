@@ -0,0 +1,17 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    # Messages
+    path('rooms/<uuid:room_id>/messages/', views.MessageListCreateView.as_view(), name='message-list-create'),
+    path('messages/<uuid:pk>/', views.MessageDetailView.as_view(), name='message-detail'),
+
+    # Delivery receipts
+    path('messages/<uuid:message_id>/delivered/', views.mark_message_delivered, name='message-delivered'),
+    path('messages/<uuid:message_id>/read/', views.mark_message_read, name='message-read'),
+
+    # Attachments
+    path('rooms/<uuid:room_id>/attachments/', views.AttachmentCreateView.as_view(), name='attachment-create'),
+    path('attachments/<uuid:pk>/', views.AttachmentUploadView.as_view(), name='attachment-upload'),
+    path('attachments/<uuid:pk>/content/', views.download_attachment, name='attachment-download'),
+]
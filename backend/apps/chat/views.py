@@ -1,17 +1,29 @@
 from rest_framework import generics, status
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from django.conf import settings
+from django.db.models.query import EmptyQuerySet
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
+from apps.notifications.tasks import notify_new_message
+from apps.rooms.caching import cached_page, room_history_version_key
 from apps.rooms.models import Room, RoomMembership
-from .models import Message, MessageRecipient
-from .serializers import MessageSerializer, MessageCreateSerializer, MessageRecipientSerializer
+from porcupine_backend.ratelimit import MessageSendThrottle
+from .attachments import OffsetMismatch, download_response, write_chunk
+from .broadcast import broadcast_to_room
+from .history import forget, publish_message
+from .models import Attachment, Message, MessageRecipient
+from .serializers import (
+    MessageSerializer, MessageCreateSerializer, MessageRecipientSerializer,
+    AttachmentSerializer, AttachmentCreateSerializer
+)
 
 
 class MessageListCreateView(generics.ListCreateAPIView):
     """
-    GET: List messages in a room
+    GET: List messages in a room (?after_seq=N for only newer messages)
     POST: Send a new message
     """
     permission_classes = [IsAuthenticated]
@@ -20,6 +32,23 @@ class MessageListCreateView(generics.ListCreateAPIView):
         if self.request.method == 'POST':
             return MessageCreateSerializer
         return MessageSerializer
+
+    def get_throttles(self):
+        if self.request.method == 'POST':
+            return [MessageSendThrottle()]
+        return super().get_throttles()
+
+    def get_serializer_context(self):
+        return {**super().get_serializer_context(), 'room_id': self.kwargs['room_id']}
+
+    def create(self, request, *args, **kwargs):
+        try:
+            return super().create(request, *args, **kwargs)
+        except ValidationError as exc:
+            # Like sender key uploads: a stale epoch is a conflict, the client must fetch the new keys
+            if exc.get_codes().get('key_epoch') == ['stale_epoch']:
+                return Response(exc.detail, status=status.HTTP_409_CONFLICT)
+            raise
     
     def get_queryset(self):
         room_id = self.kwargs['room_id']
@@ -34,10 +63,27 @@ class MessageListCreateView(generics.ListCreateAPIView):
         if not membership:
             return Message.objects.none()
         
-        return Message.objects.filter(
+        messages = Message.objects.filter(
             room=room,
             is_active=True
         ).select_related('sender').prefetch_related('recipients')
+
+        after_seq = self.request.query_params.get('after_seq')
+        if after_seq is not None and after_seq.isdigit():
+            messages = messages.filter(seq__gt=int(after_seq)).order_by('seq')
+        return messages
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.get_queryset()
+
+        def build():
+            page = self.paginate_queryset(queryset)
+            return self.get_paginated_response(self.get_serializer(page, many=True).data)
+
+        if isinstance(queryset, EmptyQuerySet):
+            return build()  # Not a member
+        # Pages are the same for every member: serialize and compress once per history version
+        return cached_page(request, 'messages', [room_history_version_key(self.kwargs['room_id'])], build)
     
     def perform_create(self, serializer):
         room_id = self.kwargs['room_id']
@@ -55,21 +101,12 @@ class MessageListCreateView(generics.ListCreateAPIView):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        # Save message
+        # Save message (assigns its sequence number and recipient rows)
         message = serializer.save(room=room)
-        
-        # Create message recipients for all active room members
-        active_members = room.memberships.filter(is_active=True).select_related('user')
-        recipients = []
-        for member in active_members:
-            if member.user != self.request.user:  # Don't create recipient for sender
-                recipients.append(MessageRecipient(
-                    message=message,
-                    user=member.user
-                ))
-        
-        if recipients:
-            MessageRecipient.objects.bulk_create(recipients)
+
+        # Deliver to connected clients, and notify members who are offline
+        broadcast_to_room(room.id, publish_message(message))
+        notify_new_message(message)
 
 
 class MessageDetailView(generics.RetrieveUpdateDestroyAPIView):
@@ -87,10 +124,15 @@ class MessageDetailView(generics.RetrieveUpdateDestroyAPIView):
             is_active=True
         ).select_related('sender', 'room')
     
+    def perform_update(self, serializer):
+        serializer.save()
+        forget(serializer.instance)
+
     def perform_destroy(self, instance):
         # Soft delete
         instance.is_active = False
         instance.save()
+        forget(instance)
 
 
 @api_view(['POST'])
@@ -121,6 +163,7 @@ def mark_message_delivered(request, message_id):
     if not created and not recipient.delivered_at:
         recipient.delivered_at = timezone.now()
         recipient.save()
+    RoomMembership.mark_seen(message.room_id, request.user.id, message.seq)
     
     return Response({'message': 'Message marked as delivered'}, status=status.HTTP_200_OK)
 
@@ -159,5 +202,83 @@ def mark_message_read(request, message_id):
         if not recipient.read_at:
             recipient.read_at = timezone.now()
         recipient.save()
+    RoomMembership.mark_seen(message.room_id, request.user.id, message.seq)
     
-    return Response({'message': 'Message marked as read'}, status=status.HTTP_200_OK)
\ No newline at end of file
+    return Response({'message': 'Message marked as read'}, status=status.HTTP_200_OK)
+
+
+class AttachmentCreateView(generics.CreateAPIView):
+    """POST: Start an upload of an encrypted attachment to a room"""
+    permission_classes = [IsAuthenticated]
+    serializer_class = AttachmentCreateSerializer
+
+    def create(self, request, room_id):
+        room = get_object_or_404(Room, id=room_id, is_active=True)
+
+        # Verify user is member of this room
+        if not room.memberships.filter(user=request.user, is_active=True).exists():
+            return Response(
+                {'error': 'You are not a member of this room'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        attachment = serializer.save(room=room, uploaded_by=request.user)
+        return Response(AttachmentSerializer(attachment).data, status=status.HTTP_201_CREATED)
+
+
+class AttachmentUploadView(generics.GenericAPIView):
+    """
+    GET: Upload status; `received` is the offset to resume from
+    PATCH: Upload the next chunk as the raw request body, with an
+           `Upload-Offset` header equal to the current `received`
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, pk):
+        attachment = get_object_or_404(
+            Attachment, id=pk, room__memberships__user=request.user, room__memberships__is_active=True
+        )
+        return Response(AttachmentSerializer(attachment).data)
+
+    def patch(self, request, pk):
+        attachment = get_object_or_404(Attachment, id=pk, uploaded_by=request.user)
+
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers['Content-Length'])
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'Upload-Offset and Content-Length headers are required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if length > settings.ATTACHMENTS['MAX_CHUNK_SIZE']:
+            return Response(
+                {'error': f"Chunks are limited to {settings.ATTACHMENTS['MAX_CHUNK_SIZE']} bytes"},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+
+        # Read the body as a stream; DRF never parses it
+        try:
+            attachment = write_chunk(attachment.id, offset, request._request, length)
+        except OffsetMismatch as e:
+            return Response(
+                {'error': 'Upload-Offset does not match', 'received': e.args[0]},
+                status=status.HTTP_409_CONFLICT,
+                headers={'Upload-Offset': str(e.args[0])}
+            )
+        return Response(AttachmentSerializer(attachment).data, headers={'Upload-Offset': str(attachment.received)})
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def download_attachment(request, pk):
+    """Download attachment content; supports Range requests"""
+    attachment = get_object_or_404(
+        Attachment.objects.select_related('blob'),
+        id=pk, room__memberships__user=request.user, room__memberships__is_active=True
+    )
+    if not attachment.is_complete:
+        return Response({'error': 'Upload is not complete'}, status=status.HTTP_409_CONFLICT)
+    return download_response(attachment, request.headers.get('Range', ''))
@@ -0,0 +1,24 @@
+from django.db import models
+from django.contrib.auth.models import User
+
+
+class PendingNotification(models.Model):
+    """
+    New messages in a room for a member who was offline, waiting for the
+    member's next digest. One row per (user, room); `first_at` starts the
+    coalescing window and `last_seq` is the newest message to report.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='pending_notifications')
+    room = models.ForeignKey('rooms.Room', on_delete=models.CASCADE, related_name='pending_notifications')
+    last_seq = models.BigIntegerField()
+    first_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'pending_notifications'
+        unique_together = ['user', 'room']
+        indexes = [
+            models.Index(fields=['first_at']),
+        ]
+
+    def __str__(self):
+        return f"Pending notification for {self.user_id} in room {self.room_id}"
@@ -0,0 +1,68 @@
+"""
+Notification sinks.
+
+A digest is a dict:
+
+    {'user_id': 3, 'username': 'alice', 'unread': 5,
+     'rooms': [{'room_id': '...', 'room_name': '...', 'unread': 5, 'last_seq': 42}]}
+
+It never contains message content, which only clients can decrypt. Sinks
+are configured in settings.NOTIFICATIONS['SINKS'] as
+{'BACKEND': dotted path, 'OPTIONS': {...}} and get a list of digests per
+call.
+"""
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationSink:
+    def deliver(self, digests):
+        raise NotImplementedError
+
+
+class LogSink(NotificationSink):
+    """Write each digest to the log"""
+
+    def deliver(self, digests):
+        for digest in digests:
+            logger.info('Digest for user %s: %s unread', digest['user_id'], digest['unread'], extra={'digest': digest})
+
+
+class JsonLinesSink(NotificationSink):
+    """Append digests as JSON lines to a local file, e.g. for a push gateway to tail"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def deliver(self, digests):
+        lines = ''.join(json.dumps(digest) + '\n' for digest in digests)
+        with self.lock, open(self.path, 'a') as f:
+            f.write(lines)
+
+
+class MemorySink(NotificationSink):
+    """Keep digests in `MemorySink.outbox` (tests and benchmarks)"""
+    outbox = []
+
+    def deliver(self, digests):
+        MemorySink.outbox.extend(digests)
+
+
+_sinks = None
+_sinks_config = None
+
+
+def get_sinks():
+    global _sinks, _sinks_config
+    config = settings.NOTIFICATIONS['SINKS']
+    if _sinks is None or config is not _sinks_config:
+        _sinks = [import_string(sink['BACKEND'])(**sink.get('OPTIONS', {})) for sink in config]
+        _sinks_config = config
+    return _sinks
@@ -0,0 +1,135 @@
+"""
+Offline notification fan-out.
+
+When a message is sent, `fan_out_message` finds the room's members who are
+neither connected to the room (presence) nor caught up to the message
+(`RoomMembership.last_seen_seq`) and upserts one PendingNotification per
+member and room, so a burst of messages costs one row per recipient rather
+than one per message. A row's `last_seq` only moves forward, even when
+fan-outs run out of order. Every few seconds `flush_digests` takes the users
+whose oldest pending row is older than DIGEST_WINDOW and delivers one digest
+per user, covering all of their rooms, to the configured sinks. Rooms the
+user has read in the meantime are dropped at that point.
+"""
+import logging
+from datetime import timedelta
+
+from celery import shared_task
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from apps.chat.presence import online_users
+from apps.rooms.models import RoomMembership
+from .models import PendingNotification
+from .sinks import get_sinks
+
+logger = logging.getLogger(__name__)
+
+
+def notify_new_message(message):
+    """Queue the fan-out once the message is committed; never fails the send"""
+    args = (str(message.room_id), message.seq, message.sender_id)
+
+    def enqueue():
+        try:
+            fan_out_message.apply_async(args, retry=False)
+        except Exception:
+            logger.warning('Could not queue notifications for room %s', message.room_id, exc_info=True)
+
+    transaction.on_commit(enqueue)
+
+
+@shared_task
+def fan_out_message(room_id, seq, sender_id):
+    """Record message `seq` for every offline member who has not seen it; returns the count"""
+    online = online_users(room_id)
+    recipients = [
+        user_id for user_id in RoomMembership.objects.filter(
+            room_id=room_id, is_active=True, last_seen_seq__lt=seq
+        ).exclude(user_id=sender_id).values_list('user_id', flat=True)
+        if user_id not in online
+    ]
+    # Fan-outs can run out of order, so last_seq only ever moves forward;
+    # first_at keeps the window start. Existing rows are moved first and
+    # stay locked, then missing rows are inserted, then any row a concurrent
+    # fan-out inserted in between is moved forward too.
+    with transaction.atomic():
+        advance(room_id, recipients, seq)
+        PendingNotification.objects.bulk_create(
+            [PendingNotification(user_id=user_id, room_id=room_id, last_seq=seq) for user_id in recipients],
+            batch_size=settings.NOTIFICATIONS['BATCH_SIZE'],
+            ignore_conflicts=True,
+        )
+        advance(room_id, recipients, seq)
+    return len(recipients)
+
+
+def advance(room_id, user_ids, seq):
+    PendingNotification.objects.filter(
+        room_id=room_id, user_id__in=user_ids, last_seq__lt=seq
+    ).update(last_seq=seq)
+
+
+@shared_task
+def flush_digests(now=None):
+    """Deliver digests to every user with a notification older than the window; returns the count"""
+    now = now or timezone.now()
+    cutoff = now - timedelta(seconds=settings.NOTIFICATIONS['DIGEST_WINDOW'])
+    batch_size = settings.NOTIFICATIONS['BATCH_SIZE']
+    delivered = 0
+    while True:
+        user_ids = list(
+            PendingNotification.objects.filter(first_at__lte=cutoff)
+            .order_by().values_list('user_id', flat=True).distinct()[:batch_size]
+        )
+        if not user_ids:
+            return delivered
+        delivered += deliver_digests(user_ids)
+
+
+def deliver_digests(user_ids):
+    """
+    Deliver and clear all pending notifications of `user_ids`.
+
+    Rows are locked and deleted in the same transaction as the delivery, so a
+    failing sink leaves them for the next flush, and a message fanned out
+    meanwhile waits for the lock and then starts a new window.
+    """
+    with transaction.atomic():
+        pending = list(
+            PendingNotification.objects.select_for_update(of=('self',))
+            .filter(user_id__in=user_ids)
+            .select_related('user', 'room')
+            .order_by('user_id', 'room_id')
+        )
+        if not pending:
+            return 0
+        seen = {
+            (membership['user_id'], membership['room_id']): membership['last_seen_seq']
+            for membership in RoomMembership.objects.filter(
+                user_id__in=user_ids, room_id__in={row.room_id for row in pending}, is_active=True
+            ).values('user_id', 'room_id', 'last_seen_seq')
+        }
+
+        digests = {}
+        for row in pending:
+            last_seen = seen.get((row.user_id, row.room_id))
+            # Left the room or read it since
+            if last_seen is None or last_seen >= row.last_seq:
+                continue
+            digest = digests.setdefault(row.user_id, {
+                'user_id': row.user_id, 'username': row.user.username, 'unread': 0, 'rooms': []
+            })
+            unread = row.last_seq - last_seen
+            digest['unread'] += unread
+            digest['rooms'].append({
+                'room_id': str(row.room_id), 'room_name': row.room.name,
+                'unread': unread, 'last_seq': row.last_seq,
+            })
+
+        PendingNotification.objects.filter(id__in=[row.id for row in pending]).delete()
+        if digests:
+            for sink in get_sinks():
+                sink.deliver(list(digests.values()))
+    return len(digests)
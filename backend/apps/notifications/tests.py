@@ -0,0 +1,114 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+
+from apps.rooms.models import RoomMembership
+from porcupine_backend.celery import app
+from porcupine_backend.testing import QueryPlanTestCase, SeededAPITestCase
+from .models import PendingNotification
+from .sinks import MemorySink
+from .tasks import fan_out_message, flush_digests
+
+TEST_NOTIFICATIONS = {
+    **settings.NOTIFICATIONS,
+    'DIGEST_WINDOW': 60,
+    'SINKS': [{'BACKEND': 'apps.notifications.sinks.MemorySink'}],
+}
+
+
+@override_settings(NOTIFICATIONS=TEST_NOTIFICATIONS)
+@mock.patch('apps.notifications.tasks.online_users', return_value=set())
+class NotificationTests(SeededAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Run tasks inline instead of through the broker
+        self.addCleanup(setattr, app.conf, 'CELERY_TASK_ALWAYS_EAGER', app.conf.task_always_eager)
+        app.conf.CELERY_TASK_ALWAYS_EAGER = True
+        MemorySink.outbox.clear()
+
+    def pending(self, room=None):
+        return dict(
+            PendingNotification.objects.filter(room=room or self.room).values_list('user_id', 'last_seq')
+        )
+
+    def age_pending(self, seconds=120):
+        PendingNotification.objects.update(first_at=timezone.now() - timedelta(seconds=seconds))
+
+    def test_send_notifies_offline_members_only(self, online_users):
+        online, caught_up = self.users[1], self.users[2]
+        online_users.return_value = {online.id}
+        RoomMembership.mark_seen(self.room.id, caught_up.id, 100)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('message-list-create', args=[self.room.id]),
+                {'room': self.room.id, 'encrypted_content': 'ciphertext', 'nonce': 'nonce'}
+            )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.pending(), {user.id: 21 for user in self.users[3:]})
+
+    def test_burst_is_coalesced(self, online_users):
+        for seq in (21, 22, 23):
+            fan_out_message.delay(str(self.room.id), seq, self.user.id)
+
+        self.assertEqual(PendingNotification.objects.count(), len(self.users) - 1)
+        self.assertEqual(set(self.pending().values()), {23})
+
+    def test_out_of_order_fan_out_keeps_newest_seq(self, online_users):
+        for seq in (23, 21, 22):
+            fan_out_message.delay(str(self.room.id), seq, self.user.id)
+        self.assertEqual(set(self.pending().values()), {23})
+
+    def test_flush_delivers_one_digest_per_user(self, online_users):
+        reader, member = self.users[1], self.users[2]
+        for room in self.rooms[:2]:
+            fan_out_message.delay(str(room.id), 20, self.user.id)
+        RoomMembership.mark_seen(self.room.id, member.id, 15)
+        RoomMembership.mark_seen(self.room.id, reader.id, 20)
+        RoomMembership.mark_seen(self.rooms[1].id, reader.id, 20)
+
+        # Nothing is due until the window has passed
+        self.assertEqual(flush_digests.delay().get(), 0)
+        self.age_pending()
+        self.assertEqual(flush_digests.delay().get(), len(self.users) - 2)
+
+        digests = {digest['user_id']: digest for digest in MemorySink.outbox}
+        self.assertNotIn(reader.id, digests)
+        self.assertEqual(digests[member.id]['unread'], 5 + 20)
+        self.assertEqual(
+            sorted((room['room_id'], room['unread']) for room in digests[member.id]['rooms']),
+            sorted([(str(self.room.id), 5), (str(self.rooms[1].id), 20)])
+        )
+        self.assertFalse(PendingNotification.objects.exists())
+
+    def test_failed_delivery_keeps_pending(self, online_users):
+        fan_out_message.delay(str(self.room.id), 20, self.user.id)
+        self.age_pending()
+
+        with mock.patch.object(MemorySink, 'deliver', side_effect=OSError):
+            with self.assertRaises(OSError):
+                flush_digests()
+        self.assertEqual(PendingNotification.objects.count(), len(self.users) - 1)
+
+    def test_broker_down_does_not_fail_send(self, online_users):
+        with mock.patch.object(fan_out_message, 'apply_async', side_effect=OperationalError):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    reverse('message-list-create', args=[self.room.id]),
+                    {'room': self.room.id, 'encrypted_content': 'ciphertext', 'nonce': 'nonce'}
+                )
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(PendingNotification.objects.exists())
+
+
+class NotificationQueryPlanTests(QueryPlanTestCase):
+
+    def test_due_digests_plan(self):
+        self.assertUsesIndex('due_digests', PendingNotification.objects.filter(first_at__lte=timezone.now()))
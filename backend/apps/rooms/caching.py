@@ -0,0 +1,153 @@
+"""
+Versioned response caching for room endpoints.
+
+Every room and user has a version counter in the shared cache. Writes bump
+the counters they affect after the change is committed; cached responses
+and ETags are keyed by the versions current when they were built, so a bump
+invalidates them on every node at once. A request whose If-None-Match still
+matches gets a 304 from the cache alone.
+
+`cached_page` additionally stores a page already rendered and compressed,
+so a hot page is serialized and compressed once per version rather than on
+every request.
+
+Counters start at a random value so that an evicted counter can never come
+back at a version an old cached response was stored under.
+"""
+import hashlib
+import secrets
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from porcupine_backend.compression import available_encodings, compress, negotiate
+
+RESPONSE_CACHE_TIMEOUT = 60 * 10
+
+
+def room_version_key(room_id):
+    return f'version:room:{room_id}'
+
+
+def room_keys_version_key(room_id):
+    return f'version:room-keys:{room_id}'
+
+
+def room_history_version_key(room_id):
+    return f'version:room-history:{room_id}'
+
+
+def room_code_key(room_code):
+    return f'room-code:{room_code.upper()}'
+
+
+def user_version_key(user_id):
+    return f'version:user:{user_id}'
+
+
+def get_versions(keys):
+    """Current values of version counters, initializing missing ones"""
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            cache.add(key, secrets.randbits(48), timeout=None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump(*keys):
+    for key in keys:
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, secrets.randbits(48), timeout=None)
+
+
+def room_invalidation_keys(room):
+    """Versions to bump when a room or its membership changes: the room and every member's room list"""
+    member_ids = room.memberships.values_list('user_id', flat=True)
+    return [room_version_key(room.id)] + [user_version_key(user_id) for user_id in member_ids]
+
+
+def bump_user(user_id):
+    bump(user_version_key(user_id))
+
+
+def make_etag(name, scope, request, version_keys):
+    versions = get_versions(version_keys)
+    fingerprint = f'{name}|{scope}|{request.get_full_path()}|{versions}'
+    return f'"{hashlib.md5(fingerprint.encode()).hexdigest()}"'
+
+
+def etag_matches(request, etag):
+    """If-None-Match check; weak tags match too, as compression weakens ours"""
+    if_none_match = request.headers.get('If-None-Match', '')
+    return etag in [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+
+
+def cached_response(request, name, version_keys, build):
+    """
+    Serve a GET response from the versioned cache.
+
+    `build` produces the response on a miss; only 200 responses are cached.
+    """
+    etag = make_etag(name, request.user.id, request, version_keys)
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+    if etag_matches(request, etag):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    cache_key = f'response:{etag.strip(chr(34))}'
+    data = cache.get(cache_key)
+    if data is None:
+        response = build()
+        if response.status_code != status.HTTP_200_OK:
+            return response
+        data = response.data
+        cache.set(cache_key, data, RESPONSE_CACHE_TIMEOUT)
+
+    return Response(data, headers=headers)
+
+
+def cached_page(request, name, version_keys, build):
+    """
+    Serve a GET response shared by everyone allowed to see it (the caller
+    checks access first), stored rendered and precompressed.
+
+    The page is kept as JSON bytes plus one compressed copy per supported
+    encoding, compressed at COMPRESSION['CACHED_LEVELS'], and the variant
+    the client accepts is sent as is.
+    """
+    etag = make_etag(name, 'shared', request, version_keys)
+    if etag_matches(request, etag):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        cache_key = f'page:{etag.strip(chr(34))}'
+        variants = cache.get(cache_key)
+        if variants is None:
+            response = build()
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            body = JSONRenderer().render(response.data)
+            variants = {'identity': body}
+            if len(body) >= settings.COMPRESSION['MIN_SIZE']:
+                for encoding in available_encodings():
+                    variants[encoding] = compress(body, encoding, settings.COMPRESSION['CACHED_LEVELS'])
+            cache.set(cache_key, variants, RESPONSE_CACHE_TIMEOUT)
+
+        encoding = negotiate(request.headers.get('Accept-Encoding', ''), [e for e in variants if e != 'identity'])
+        response = HttpResponse(variants[encoding or 'identity'], content_type='application/json')
+        if encoding:
+            response['Content-Encoding'] = encoding
+            etag = 'W/' + etag
+        if len(variants) > 1:
+            patch_vary_headers(response, ('Accept-Encoding',))
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,392 @@
+"""
+Bulk import of the legacy Supabase tables (rooms, room_members, messages).
+
+Rows are streamed with COPY into unlogged staging tables and then moved into
+the Django tables with set-based INSERT ... SELECT batches keyed on the
+staging sequence. Each batch commits together with its checkpoint, so an
+interrupted run resumes where it stopped and re-running it is a no-op.
+Sequence numbers are assigned in batches too, and the cached responses of
+the imported rooms and their members are invalidated at the end.
+
+    python manage.py import_supabase --source-dsn postgresql://...
+    python manage.py import_supabase --csv-dir ./export   # rooms.csv, room_members.csv, messages.csv
+"""
+import csv
+import os
+import threading
+import time
+
+import psycopg2
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from apps.accounts.models import SupabaseIdentity
+from apps.chat.models import Message
+from apps.rooms.caching import bump, room_history_version_key, room_version_key, user_version_key
+from apps.rooms.models import Room, RoomMembership
+
+# Columns we understand in each legacy table, in staging order
+LEGACY_COLUMNS = {
+    'rooms': ['id', 'name', 'room_code', 'created_by', 'created_at'],
+    'room_members': ['id', 'room_id', 'user_id', 'user_name', 'public_key', 'joined_at'],
+    'messages': ['id', 'room_id', 'uid', 'name', 'text', 'encrypted_content', 'nonce', 'created_at'],
+}
+
+REQUIRED_COLUMNS = {
+    'rooms': {'id', 'name', 'room_code', 'created_by'},
+    'room_members': {'room_id', 'user_id', 'public_key'},
+    'messages': {'id', 'room_id', 'uid'},
+}
+
+STAGING_PREFIX = 'legacy_import_'
+PROGRESS_TABLE = 'legacy_import_progress'
+
+
+def staging_table(table):
+    return f'{STAGING_PREFIX}{table}'
+
+
+class Command(BaseCommand):
+    help = 'Import rooms, memberships and messages from the legacy Supabase schema'
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--source-dsn', help='DSN of the legacy Supabase Postgres database')
+        source.add_argument('--csv-dir', help='Directory with rooms.csv, room_members.csv and messages.csv (with header)')
+        parser.add_argument('--batch-size', type=int, default=50000)
+        parser.add_argument('--username-prefix', default='sb_',
+                            help='Prefix for usernames of users created from Supabase uids')
+        parser.add_argument('--restage', action='store_true',
+                            help='Discard staged rows and checkpoints and load the source again')
+        parser.add_argument('--keep-staging', action='store_true',
+                            help='Keep staging tables and checkpoints after a successful import')
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        if self.batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+
+        if options['restage']:
+            self.drop_staging()
+        self.create_staging()
+
+        for table in LEGACY_COLUMNS:
+            self.stage(table, options)
+
+        self.import_users(options['username_prefix'])
+        self.import_batches('rooms', self.rooms_sql())
+        self.import_batches('room_members', self.memberships_sql())
+        self.import_batches('messages', self.messages_sql())
+        self.assign_sequences()
+        self.invalidate_caches()
+
+        if not options['keep_staging']:
+            self.drop_staging()
+        self.stdout.write(self.style.SUCCESS('Legacy import complete'))
+
+    # Staging
+
+    def create_staging(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} '
+                '(phase text PRIMARY KEY, position bigint NOT NULL)'
+            )
+            for table, columns in LEGACY_COLUMNS.items():
+                column_sql = ', '.join(f'{column} text' for column in columns)
+                cursor.execute(
+                    f'CREATE UNLOGGED TABLE IF NOT EXISTS {staging_table(table)} '
+                    f'(seq bigserial PRIMARY KEY, {column_sql})'
+                )
+
+    def drop_staging(self):
+        with connection.cursor() as cursor:
+            for table in LEGACY_COLUMNS:
+                cursor.execute(f'DROP TABLE IF EXISTS {staging_table(table)}')
+            cursor.execute(f'DROP TABLE IF EXISTS {PROGRESS_TABLE}')
+
+    def stage(self, table, options):
+        phase = f'stage:{table}'
+        if self.get_position(phase) is not None:
+            self.stdout.write(f'{table}: already staged, skipping load')
+            return
+
+        started = time.monotonic()
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f'TRUNCATE {staging_table(table)} RESTART IDENTITY')
+            if options['source_dsn']:
+                self.stage_from_dsn(options['source_dsn'], table)
+            else:
+                self.stage_from_csv(options['csv_dir'], table)
+            with connection.cursor() as cursor:
+                cursor.execute(f'SELECT count(*) FROM {staging_table(table)}')
+                rows = cursor.fetchone()[0]
+            self.set_position(phase, rows)
+        self.report(f'{table}: {rows} rows staged', rows, started)
+
+    def check_columns(self, table, columns):
+        unknown = set(columns) - set(LEGACY_COLUMNS[table])
+        if unknown:
+            raise CommandError(f'{table}: unexpected columns {", ".join(sorted(unknown))}')
+        missing = REQUIRED_COLUMNS[table] - set(columns)
+        if missing:
+            raise CommandError(f'{table}: missing required columns {", ".join(sorted(missing))}')
+
+    def stage_from_csv(self, csv_dir, table):
+        path = os.path.join(csv_dir, f'{table}.csv')
+        if not os.path.exists(path):
+            raise CommandError(f'{path} does not exist')
+
+        with open(path, newline='') as source:
+            columns = next(csv.reader([source.readline()]))
+            columns = [column.strip() for column in columns]
+            self.check_columns(table, columns)
+            with connection.cursor() as cursor:
+                cursor.copy_expert(
+                    f'COPY {staging_table(table)} ({", ".join(columns)}) FROM STDIN WITH CSV',
+                    source,
+                )
+
+    def stage_from_dsn(self, dsn, table):
+        source = psycopg2.connect(dsn)
+        try:
+            with source.cursor() as cursor:
+                cursor.execute(
+                    'SELECT column_name FROM information_schema.columns '
+                    "WHERE table_schema = 'public' AND table_name = %s",
+                    [table],
+                )
+                available = {row[0] for row in cursor.fetchall()}
+            columns = [column for column in LEGACY_COLUMNS[table] if column in available]
+            self.check_columns(table, columns)
+            column_sql = ', '.join(columns)
+
+            # Pipe COPY TO STDOUT on the source straight into COPY FROM STDIN
+            # here, so rows are never buffered in memory or on disk.
+            read_fd, write_fd = os.pipe()
+            reader = os.fdopen(read_fd, 'rb')
+            writer = os.fdopen(write_fd, 'wb')
+            errors = []
+
+            def produce():
+                try:
+                    with source.cursor() as cursor:
+                        cursor.copy_expert(
+                            f'COPY (SELECT {column_sql} FROM public.{table}) TO STDOUT WITH CSV',
+                            writer,
+                        )
+                except Exception as exc:
+                    errors.append(exc)
+                finally:
+                    writer.close()
+
+            producer = threading.Thread(target=produce, daemon=True)
+            producer.start()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(
+                        f'COPY {staging_table(table)} ({column_sql}) FROM STDIN WITH CSV',
+                        reader,
+                    )
+            finally:
+                reader.close()
+                producer.join()
+            if errors:
+                raise CommandError(f'{table}: reading from source failed: {errors[0]}')
+        finally:
+            source.close()
+
+    # Import
+
+    def import_users(self, prefix):
+        """Create one unusable-password user per Supabase uid not mapped yet"""
+        started = time.monotonic()
+        user_table = User._meta.db_table
+        identity_table = SupabaseIdentity._meta.db_table
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f'''
+                CREATE TEMP TABLE legacy_users ON COMMIT DROP AS
+                SELECT DISTINCT ON (uid) uid, name FROM (
+                    SELECT user_id AS uid, user_name AS name FROM {staging_table('room_members')}
+                    UNION ALL
+                    SELECT uid, name FROM {staging_table('messages')}
+                    UNION ALL
+                    SELECT created_by, NULL FROM {staging_table('rooms')}
+                ) AS seen
+                WHERE uid IS NOT NULL
+                  AND NOT EXISTS (SELECT 1 FROM {identity_table} i WHERE i.supabase_uid = seen.uid)
+                ORDER BY uid, name NULLS LAST
+            ''')
+            cursor.execute(f'''
+                INSERT INTO {user_table}
+                    (password, is_superuser, username, first_name, last_name,
+                     email, is_staff, is_active, date_joined)
+                SELECT '!' || md5(random()::text), false, %s || l.uid, left(coalesce(l.name, ''), 150), '',
+                       '', false, true, now()
+                FROM legacy_users l
+                ON CONFLICT (username) DO NOTHING
+            ''', [prefix])
+            cursor.execute(f'''
+                INSERT INTO {identity_table} (supabase_uid, user_id, imported_at)
+                SELECT l.uid, u.id, now()
+                FROM legacy_users l
+                JOIN {user_table} u ON u.username = %s || l.uid
+                ON CONFLICT DO NOTHING
+            ''', [prefix])
+            created = cursor.rowcount
+        self.report(f'users: {created} mapped', created, started)
+
+    def rooms_sql(self):
+        default_max_members = Room._meta.get_field('max_members').default
+        return f'''
+            INSERT INTO {Room._meta.db_table}
+                (id, name, room_code, created_by_id, created_at, updated_at, is_active, max_members,
+                 last_message_seq, key_epoch)
+            SELECT s.id::uuid, left(s.name, 100), upper(left(s.room_code, 10)), i.user_id,
+                   coalesce(s.created_at::timestamptz, now()), coalesce(s.created_at::timestamptz, now()),
+                   true, {int(default_max_members)}, 0, 1
+            FROM {staging_table('rooms')} s
+            JOIN {SupabaseIdentity._meta.db_table} i ON i.supabase_uid = s.created_by
+            WHERE s.seq > %s AND s.seq <= %s
+            ON CONFLICT DO NOTHING
+        '''
+
+    def memberships_sql(self):
+        return f'''
+            INSERT INTO {RoomMembership._meta.db_table}
+                (id, room_id, user_id, public_key, joined_at, is_active, is_admin, last_seen_seq)
+            SELECT coalesce(s.id::uuid, gen_random_uuid()), r.id, i.user_id, s.public_key,
+                   coalesce(s.joined_at::timestamptz, now()), true, r.created_by_id = i.user_id, 0
+            FROM {staging_table('room_members')} s
+            JOIN {SupabaseIdentity._meta.db_table} i ON i.supabase_uid = s.user_id
+            JOIN {Room._meta.db_table} r ON r.id = s.room_id::uuid
+            WHERE s.seq > %s AND s.seq <= %s
+            ON CONFLICT DO NOTHING
+        '''
+
+    def messages_sql(self):
+        # Pre-room plaintext messages have no room and no ciphertext; they are skipped
+        return f'''
+            INSERT INTO {Message._meta.db_table}
+                (id, room_id, sender_id, encrypted_content, nonce, timestamp, message_type, is_active, seq,
+                 key_epoch)
+            SELECT s.id::uuid, r.id, i.user_id, s.encrypted_content, left(coalesce(s.nonce, ''), 64),
+                   coalesce(s.created_at::timestamptz, now()), 'text', true, 0, 0
+            FROM {staging_table('messages')} s
+            JOIN {SupabaseIdentity._meta.db_table} i ON i.supabase_uid = s.uid
+            JOIN {Room._meta.db_table} r ON r.id = s.room_id::uuid
+            WHERE s.seq > %s AND s.seq <= %s
+              AND s.encrypted_content IS NOT NULL
+            ON CONFLICT (id) DO NOTHING
+        '''
+
+    def assign_sequences(self):
+        """
+        Number imported messages per room (resume cursors) after any existing ones.
+
+        Each batch takes the next `batch_size` unnumbered messages in (room,
+        timestamp) order and commits with the rooms' new last_message_seq, so
+        an interrupted run continues with the rows still at seq 0.
+        """
+        started = time.monotonic()
+        message_table = Message._meta.db_table
+        room_table = Room._meta.db_table
+        numbered = 0
+        while True:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(f'''
+                    WITH batch AS (
+                        SELECT id, room_id,
+                               row_number() OVER (PARTITION BY room_id ORDER BY timestamp, id) AS n
+                        FROM (
+                            SELECT id, room_id, timestamp FROM {message_table}
+                            WHERE seq = 0
+                            ORDER BY room_id, timestamp, id
+                            LIMIT %s
+                        ) AS unnumbered
+                    ), numbered AS (
+                        UPDATE {message_table} m
+                        SET seq = r.last_message_seq + b.n
+                        FROM batch b
+                        JOIN {room_table} r ON r.id = b.room_id
+                        WHERE m.id = b.id
+                        RETURNING m.room_id, m.seq
+                    )
+                    UPDATE {room_table} r
+                    SET last_message_seq = latest.seq
+                    FROM (SELECT room_id, max(seq) AS seq, count(*) AS batch_rows FROM numbered GROUP BY room_id) AS latest
+                    WHERE r.id = latest.room_id
+                    RETURNING latest.batch_rows
+                ''', [self.batch_size])
+                rows = sum(row[0] for row in cursor.fetchall())
+            if not rows:
+                break
+            numbered += rows
+            self.report(f'messages: {numbered} sequence numbers assigned', numbered, started)
+
+    def invalidate_caches(self):
+        """Bump the cached-response versions of every room the import touched and of its members"""
+        with connection.cursor() as cursor:
+            cursor.execute(f'''
+                SELECT r.id FROM {Room._meta.db_table} r
+                JOIN (
+                    SELECT id AS room_id FROM {staging_table('rooms')}
+                    UNION SELECT room_id FROM {staging_table('room_members')}
+                    UNION SELECT room_id FROM {staging_table('messages')}
+                ) AS staged ON staged.room_id = r.id::text
+            ''')
+            room_ids = [row[0] for row in cursor.fetchall()]
+        user_ids = set(
+            RoomMembership.objects.filter(room_id__in=room_ids).values_list('user_id', flat=True)
+        )
+        bump(
+            *[room_version_key(room_id) for room_id in room_ids],
+            *[room_history_version_key(room_id) for room_id in room_ids],
+            *[user_version_key(user_id) for user_id in user_ids],
+        )
+        self.stdout.write(f'caches: {len(room_ids)} rooms and {len(user_ids)} users invalidated')
+
+    def import_batches(self, table, sql):
+        phase = f'import:{table}'
+        total = self.get_position(f'stage:{table}') or 0
+        position = self.get_position(phase) or 0
+        if position:
+            self.stdout.write(f'{table}: resuming after row {position} of {total}')
+
+        started = time.monotonic()
+        processed = inserted = 0
+        while position < total:
+            end = min(position + self.batch_size, total)
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(sql, [position, end])
+                inserted += cursor.rowcount
+                self.set_position(phase, end, cursor)
+            processed += end - position
+            position = end
+            self.report(f'{table}: {position}/{total} rows, {inserted} inserted', processed, started)
+
+    # Checkpoints
+
+    def get_position(self, phase):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT position FROM {PROGRESS_TABLE} WHERE phase = %s', [phase])
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def set_position(self, phase, position, cursor=None):
+        sql = (
+            f'INSERT INTO {PROGRESS_TABLE} (phase, position) VALUES (%s, %s) '
+            'ON CONFLICT (phase) DO UPDATE SET position = EXCLUDED.position'
+        )
+        if cursor is not None:
+            cursor.execute(sql, [phase, position])
+            return
+        with connection.cursor() as own_cursor:
+            own_cursor.execute(sql, [phase, position])
+
+    def report(self, label, rows, started):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(f'{label} ({rows / elapsed:,.0f} rows/s)')
@@ -2,7 +2,10 @@ import uuid
 import string
 import secrets
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 
 
@@ -20,6 +23,9 @@ class Room(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=True)
     max_members = models.IntegerField(default=100)
+    last_message_seq = models.BigIntegerField(default=0)
+    key_epoch = models.IntegerField(default=1)  # Bumped whenever sender keys must be rotated
+    message_ttl = models.PositiveIntegerField(null=True, blank=True)  # Seconds until messages disappear
 
     class Meta:
         db_table = 'rooms'
@@ -45,6 +51,7 @@ class RoomMembership(models.Model):
     joined_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
     is_admin = models.BooleanField(default=False)
+    last_seen_seq = models.BigIntegerField(default=0)  # Watermark: newest message seq the member has seen
 
     class Meta:
         db_table = 'room_memberships'
@@ -60,6 +67,32 @@ class RoomMembership(models.Model):
             self.is_admin = True
         super().save(*args, **kwargs)
 
+    @classmethod
+    def mark_seen(cls, room_id, user_id, seq):
+        """Advance a member's watermark; it never moves backwards"""
+        cls.objects.filter(room_id=room_id, user_id=user_id, last_seen_seq__lt=seq).update(last_seen_seq=seq)
+
+
+class SenderKeyBundle(models.Model):
+    """A member's sender key for one epoch, encrypted for one recipient"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='sender_keys')
+    epoch = models.IntegerField()
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    recipient = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    encrypted_key = models.TextField()  # Sender key wrapped with the pairwise ECDH secret
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'room_sender_keys'
+        unique_together = ['room', 'epoch', 'sender', 'recipient']
+        indexes = [
+            models.Index(fields=['room', 'epoch', 'recipient']),
+        ]
+
+    def __str__(self):
+        return f"Sender key of {self.sender_id} for {self.recipient_id} in {self.room.name} (epoch {self.epoch})"
+
 
 class RoomInvite(models.Model):
     """Optional: Track room invites with expiration"""
@@ -87,4 +120,12 @@ class RoomInvite(models.Model):
 
     @property
     def is_valid(self):
-        return not self.is_expired and (self.uses_remaining == -1 or self.uses_remaining > 0)
\ No newline at end of file
+        return not self.is_expired and (self.uses_remaining == -1 or self.uses_remaining > 0)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    """The code is free for a new room now; forget the cached code lookup and responses"""
+    from .caching import bump, room_code_key, room_version_key
+    cache.delete(room_code_key(instance.room_code))
+    bump(room_version_key(instance.id))
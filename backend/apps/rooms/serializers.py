@@ -1,6 +1,8 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
-from .models import Room, RoomMembership, RoomInvite
+from .models import Room, RoomMembership, RoomInvite, SenderKeyBundle
+
+MIN_MESSAGE_TTL = 30
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -30,9 +32,14 @@ class RoomSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'name', 'room_code', 'created_by', 'created_at', 
             'updated_at', 'is_active', 'max_members', 'member_count',
-            'is_member', 'is_creator'
+            'is_member', 'is_creator', 'key_epoch', 'message_ttl'
         ]
-        read_only_fields = ['id', 'room_code', 'created_by', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'room_code', 'created_by', 'created_at', 'updated_at', 'key_epoch']
+
+    def validate_message_ttl(self, value):
+        if value is not None and value < MIN_MESSAGE_TTL:
+            raise serializers.ValidationError(f'Message TTL must be at least {MIN_MESSAGE_TTL} seconds')
+        return value
 
     def get_is_member(self, obj):
         request = self.context.get('request')
@@ -100,7 +107,8 @@ class JoinRoomSerializer(serializers.Serializer):
             user=user,
             defaults={
                 'public_key': public_key,
-                'is_active': True
+                'is_active': True,
+                'last_seen_seq': room.last_message_seq  # Earlier messages are not "new" to them
             }
         )
         
@@ -108,6 +116,7 @@ class JoinRoomSerializer(serializers.Serializer):
             # Reactivate membership
             membership.public_key = public_key
             membership.is_active = True
+            membership.last_seen_seq = max(membership.last_seen_seq, room.last_message_seq)
             membership.save()
         
         return room
@@ -130,4 +139,58 @@ class RoomInviteSerializer(serializers.ModelSerializer):
         request = self.context.get('request')
         if request:
             return request.build_absolute_uri(f'/join?code={obj.room.room_code}&name={obj.room.name}')
-        return None
\ No newline at end of file
+        return None
+
+
+class SenderKeyBundleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SenderKeyBundle
+        fields = ['sender', 'recipient', 'epoch', 'encrypted_key', 'created_at']
+        read_only_fields = fields
+
+
+class SenderKeyInputSerializer(serializers.Serializer):
+    recipient_id = serializers.IntegerField()
+    encrypted_key = serializers.CharField()
+
+
+class SenderKeyUploadSerializer(serializers.Serializer):
+    epoch = serializers.IntegerField()
+    bundles = SenderKeyInputSerializer(many=True, allow_empty=False)
+
+    def validate(self, attrs):
+        room = self.context['room']
+        if attrs['epoch'] != room.key_epoch:
+            raise serializers.ValidationError(
+                {'epoch': f'Key epoch {attrs["epoch"]} is stale, current epoch is {room.key_epoch}'}
+            )
+        member_ids = set(
+            room.memberships.filter(is_active=True).values_list('user_id', flat=True)
+        )
+        unknown = {bundle['recipient_id'] for bundle in attrs['bundles']} - member_ids
+        if unknown:
+            raise serializers.ValidationError({'bundles': 'Every recipient must be an active room member'})
+        return attrs
+
+    def save(self):
+        room = self.context['room']
+        sender = self.context['request'].user
+        epoch = self.validated_data['epoch']
+        bundles = [
+            SenderKeyBundle(
+                room=room,
+                epoch=epoch,
+                sender=sender,
+                recipient_id=bundle['recipient_id'],
+                encrypted_key=bundle['encrypted_key']
+            )
+            for bundle in self.validated_data['bundles']
+        ]
+        # Re-uploading for the same epoch replaces the previous bundles
+        SenderKeyBundle.objects.bulk_create(
+            bundles,
+            update_conflicts=True,
+            unique_fields=['room', 'epoch', 'sender', 'recipient'],
+            update_fields=['encrypted_key'],
+        )
+        return bundles
@@ -0,0 +1,300 @@
+import csv
+import json
+import os
+import tempfile
+import uuid
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+
+from apps.chat.models import Message
+from porcupine_backend.testing import TEST_SETTINGS, QueryPlanTestCase, SeededAPITestCase
+from .caching import get_versions, room_history_version_key, user_version_key
+from .management.commands.import_supabase import Command as ImportCommand
+from .models import Room, RoomMembership, SenderKeyBundle
+
+
+class RoomQueryTests(SeededAPITestCase):
+
+    def test_room_list(self):
+        url = reverse('room-list-create')
+        response = self.assertQueryBaseline('rooms.list', lambda: self.client.get(url))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], len(self.rooms))
+
+        # Served from the versioned cache afterwards
+        self.assertQueryBaseline('rooms.list.cached', lambda: self.client.get(url))
+        not_modified = self.assertQueryBaseline(
+            'rooms.list.not_modified', lambda: self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        )
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_deactivated_user_loses_cached_access(self):
+        url = reverse('room-list-create')
+        response = self.client.get(url)
+        self.client.get(url)
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 401)
+
+    def test_deleted_user_loses_cached_access(self):
+        other = self.users[1]
+        client = self.client_for(other)
+        client.get(reverse('room-list-create'))
+        other.delete()
+        self.assertEqual(client.get(reverse('room-list-create')).status_code, 401)
+
+    def test_room_create(self):
+        response = self.assertQueryBaseline('rooms.create', lambda: self.client.post(
+            reverse('room-list-create'), {'name': 'New room', 'public_key': 'pk'}
+        ))
+        self.assertEqual(response.status_code, 201)
+
+    def test_room_detail(self):
+        url = reverse('room-detail', args=[self.room.id])
+        response = self.assertQueryBaseline('rooms.detail', lambda: self.client.get(url))
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBaseline('rooms.detail.cached', lambda: self.client.get(url))
+
+    def test_room_update(self):
+        response = self.assertQueryBaseline('rooms.update', lambda: self.client.patch(
+            reverse('room-detail', args=[self.room.id]), {'name': 'Renamed'}
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch('apps.rooms.views.reschedule_room')
+    def test_room_message_ttl(self, reschedule_room):
+        url = reverse('room-detail', args=[self.room.id])
+        self.assertEqual(self.client.patch(url, {'message_ttl': 5}).status_code, 400)
+
+        response = self.client.patch(url, {'message_ttl': 3600})
+        self.assertEqual(response.data['message_ttl'], 3600)
+        reschedule_room.assert_called_once()
+        self.client.patch(url, {'name': 'Renamed'})
+        reschedule_room.assert_called_once()
+
+    def test_room_delete(self):
+        response = self.assertQueryBaseline('rooms.delete', lambda: self.client.delete(
+            reverse('room-detail', args=[self.room.id])
+        ))
+        self.assertEqual(response.status_code, 204)
+
+    def test_room_members(self):
+        url = reverse('room-members', args=[self.room.id])
+        response = self.assertQueryBaseline('rooms.members', lambda: self.client.get(url))
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBaseline('rooms.members.cached', lambda: self.client.get(url))
+
+    def test_join_room(self):
+        RoomMembership.objects.filter(room=self.room, user=self.users[1]).update(is_active=False)
+        response = self.assertQueryBaseline('rooms.join', lambda: self.client_for(self.users[1]).post(
+            reverse('join-room'), {'room_code': self.room.room_code, 'public_key': 'pk'}
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch('apps.rooms.views.broadcast_to_room')
+    def test_join_requests_sender_keys(self, broadcast):
+        RoomMembership.objects.filter(room=self.room, user=self.users[1]).update(is_active=False)
+        self.client_for(self.users[1]).post(
+            reverse('join-room'), {'room_code': self.room.room_code, 'public_key': 'pk'}
+        )
+        room_id, event = broadcast.call_args.args
+        self.assertEqual(room_id, self.room.id)
+        self.assertEqual(json.loads(event['payload']), {
+            'type': 'key_request', 'user_id': self.users[1].id, 'epoch': self.room.key_epoch
+        })
+
+    def test_leave_room(self):
+        response = self.assertQueryBaseline('rooms.leave', lambda: self.client_for(self.users[1]).post(
+            reverse('leave-room', args=[self.room.id])
+        ))
+        self.assertEqual(response.status_code, 200)
+
+    def test_leave_room_prunes_earlier_sender_keys(self):
+        SenderKeyBundle.objects.create(
+            room=self.room, epoch=2, sender=self.user, recipient=self.users[2], encrypted_key='early'
+        )
+        self.client_for(self.users[1]).post(reverse('leave-room', args=[self.room.id]))
+        self.assertEqual(
+            set(SenderKeyBundle.objects.filter(room=self.room).values_list('epoch', flat=True)), {2}
+        )
+        self.assertTrue(SenderKeyBundle.objects.filter(room=self.rooms[1], epoch=1).exists())
+
+    def test_create_invite(self):
+        response = self.assertQueryBaseline('rooms.invite', lambda: self.client.post(
+            reverse('create-invite', args=[self.room.id])
+        ))
+        self.assertEqual(response.status_code, 201)
+
+    def test_room_by_code(self):
+        url = reverse('room-by-code', args=[self.room.room_code.lower()])
+        response = self.assertQueryBaseline('rooms.by_code', lambda: self.client.get(url))
+        self.assertEqual(response.status_code, 200)
+        self.assertQueryBaseline('rooms.by_code.cached', lambda: self.client.get(url))
+
+    def test_room_by_code_after_code_is_reused(self):
+        url = reverse('room-by-code', args=[self.room.room_code])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.delete(reverse('room-detail', args=[self.room.id])).status_code, 204)
+        room = Room.objects.create(name='Reused', room_code=self.room.room_code, created_by=self.users[1])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], str(room.id))
+
+    def test_room_by_code_after_creator_is_deleted(self):
+        url = reverse('room-by-code', args=[self.room.room_code])
+        self.assertEqual(self.client.get(url).status_code, 200)
+        # The room goes with its creator, without passing through the API
+        self.user.delete()
+        self.assertEqual(self.client_for(self.users[1]).get(url).status_code, 404)
+
+        room = Room.objects.create(name='Reused', room_code=self.room.room_code, created_by=self.users[1])
+        response = self.client_for(self.users[1]).get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['id'], str(room.id))
+
+    def test_sender_keys_fetch(self):
+        url = reverse('room-keys', args=[self.room.id])
+        response = self.assertQueryBaseline('rooms.keys.fetch', lambda: self.client.get(url))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['bundles']), len(self.users) - 1)
+
+    def test_sender_keys_upload(self):
+        bundles = [{'recipient_id': user.id, 'encrypted_key': 'rewrapped'} for user in self.users[1:]]
+        response = self.assertQueryBaseline('rooms.keys.upload', lambda: self.client.post(
+            reverse('room-keys', args=[self.room.id]),
+            {'epoch': self.room.key_epoch, 'bundles': bundles},
+            format='json'
+        ))
+        self.assertEqual(response.status_code, 201)
+
+    @override_settings(RATE_LIMITS={'join': {'user': (0.01, 2)}})
+    def test_join_rate_limited(self):
+        client = self.client_for(self.users[1])
+        for _ in range(2):
+            response = client.post(reverse('join-room'), {'room_code': 'NOPE00', 'public_key': 'pk'})
+            self.assertEqual(response.status_code, 400)
+        response = client.post(reverse('join-room'), {'room_code': self.room.room_code, 'public_key': 'pk'})
+        self.assertEqual(response.status_code, 429)
+
+
+class RoomQueryPlanTests(QueryPlanTestCase):
+
+    def test_room_by_code_plan(self):
+        self.assertUsesIndex('room_by_code', Room.objects.filter(room_code='ROOM00', is_active=True))
+
+    def test_user_memberships_plan(self):
+        self.assertUsesIndex(
+            'user_memberships',
+            RoomMembership.objects.filter(user=self.user, is_active=True)
+        )
+
+    def test_sender_keys_plan(self):
+        self.assertUsesIndex(
+            'sender_keys_for_recipient',
+            SenderKeyBundle.objects.filter(room=self.room, epoch=1, recipient=self.user)
+        )
+
+
+@override_settings(**TEST_SETTINGS)
+class ImportSupabaseTests(TransactionTestCase):
+    """Fixture import from CSV; the command commits per batch, hence TransactionTestCase"""
+
+    def setUp(self):
+        self.csv_dir = tempfile.mkdtemp()
+        self.addCleanup(self.remove_csv_dir)
+        self.room_ids = [str(uuid.uuid4()), str(uuid.uuid4())]
+        self.write('rooms', ['id', 'name', 'room_code', 'created_by'], [
+            [self.room_ids[0], 'First', 'FIRST1', 'uid-a'],
+            [self.room_ids[1], 'Second', 'SECND2', 'uid-b'],
+        ])
+        self.write('room_members', ['room_id', 'user_id', 'user_name', 'public_key'], [
+            [self.room_ids[0], 'uid-a', 'Alice', 'pk-a'],
+            [self.room_ids[0], 'uid-b', 'Bob', 'pk-b'],
+            [self.room_ids[1], 'uid-b', 'Bob', 'pk-b'],
+        ])
+        # Out of timestamp order, plus one pre-room plaintext message (empty CSV cells are NULL) that is skipped
+        rows = []
+        for i in range(5):
+            for room_id, uid in ((self.room_ids[0], 'uid-a'), (self.room_ids[1], 'uid-b')):
+                rows.append([str(uuid.uuid4()), room_id, uid, 'ct', 'nonce', f'2023-01-01T00:00:{9 - i:02d}Z'])
+        rows.append([str(uuid.uuid4()), self.room_ids[0], 'uid-a', '', 'n', '2023-01-01T00:00:00Z'])
+        self.write('messages', ['id', 'room_id', 'uid', 'encrypted_content', 'nonce', 'created_at'], rows)
+
+    def remove_csv_dir(self):
+        for name in os.listdir(self.csv_dir):
+            os.remove(os.path.join(self.csv_dir, name))
+        os.rmdir(self.csv_dir)
+
+    def write(self, table, header, rows):
+        with open(os.path.join(self.csv_dir, f'{table}.csv'), 'w', newline='') as target:
+            writer = csv.writer(target)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    def run_import(self):
+        out = StringIO()
+        call_command('import_supabase', csv_dir=self.csv_dir, batch_size=2, stdout=out)
+        return out.getvalue()
+
+    def snapshot(self):
+        return (
+            sorted(Room.objects.values_list('id', 'room_code', 'last_message_seq')),
+            sorted(RoomMembership.objects.values_list('room_id', 'user__username', 'is_admin')),
+            sorted(Message.objects.values_list('id', 'room_id', 'seq')),
+        )
+
+    def assertImported(self):
+        self.assertEqual(Room.objects.count(), 2)
+        self.assertEqual(RoomMembership.objects.count(), 3)
+        for room_id in self.room_ids:
+            room = Room.objects.get(id=room_id)
+            messages = list(Message.objects.filter(room=room).order_by('timestamp', 'id'))
+            self.assertEqual([message.seq for message in messages], [1, 2, 3, 4, 5])
+            self.assertEqual(room.last_message_seq, 5)
+
+    def test_import_is_idempotent(self):
+        output = self.run_import()
+        self.assertIn('Legacy import complete', output)
+        self.assertImported()
+        self.assertTrue(RoomMembership.objects.get(room_id=self.room_ids[0], user__username='sb_uid-a').is_admin)
+
+        before = self.snapshot()
+        self.run_import()
+        self.assertEqual(self.snapshot(), before)
+
+    def test_interrupted_import_resumes_from_checkpoint(self):
+        report = ImportCommand.report
+
+        def fail_midway(command, label, rows, started):
+            if label.startswith('messages: 4/'):
+                raise RuntimeError('interrupted')
+            report(command, label, rows, started)
+
+        with mock.patch.object(ImportCommand, 'report', fail_midway):
+            with self.assertRaises(RuntimeError):
+                self.run_import()
+        self.assertEqual(Message.objects.count(), 4)
+
+        output = self.run_import()
+        self.assertIn('messages: resuming after row 4 of 11', output)
+        self.assertIn('already staged', output)
+        self.assertEqual(Message.objects.count(), 10)
+        self.assertImported()
+
+    def test_import_invalidates_cached_versions(self):
+        room_key = room_history_version_key(self.room_ids[0])
+        before = get_versions([room_key])
+        self.run_import()
+        self.assertNotEqual(get_versions([room_key]), before)
+
+        user_key = user_version_key(RoomMembership.objects.filter(room_id=self.room_ids[0]).first().user_id)
+        versions = get_versions([room_key, user_key])
+        self.run_import()
+        self.assertNotEqual(get_versions([room_key, user_key]), versions)
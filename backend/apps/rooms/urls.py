@@ -6,6 +6,7 @@ urlpatterns = [
     path('', views.RoomListCreateView.as_view(), name='room-list-create'),
     path('<uuid:pk>/', views.RoomDetailView.as_view(), name='room-detail'),
     path('<uuid:room_id>/members/', views.RoomMembersView.as_view(), name='room-members'),
+    path('<uuid:room_id>/keys/', views.RoomKeysView.as_view(), name='room-keys'),
     
     # Room actions
     path('join/', views.join_room, name='join-room'),
@@ -1,14 +1,26 @@
 from rest_framework import generics, status
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, permission_classes, throttle_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from django.core.cache import cache
+from django.db.models import F
 from django.shortcuts import get_object_or_404
-from .models import Room, RoomMembership, RoomInvite
+from apps.chat.broadcast import broadcast_to_room, make_room_event
+from apps.chat.expiry import reschedule_room
+from porcupine_backend.ratelimit import JoinRoomThrottle
+from .caching import (
+    bump, bump_user, cached_response, room_code_key, room_invalidation_keys,
+    room_keys_version_key, room_version_key, user_version_key
+)
+from .models import Room, RoomMembership, RoomInvite, SenderKeyBundle
 from .serializers import (
     RoomSerializer, RoomCreateSerializer, JoinRoomSerializer,
-    RoomMembershipSerializer, RoomInviteSerializer
+    RoomMembershipSerializer, RoomInviteSerializer,
+    SenderKeyBundleSerializer, SenderKeyUploadSerializer
 )
 
+ROOM_CODE_CACHE_TIMEOUT = 60 * 60 * 24
+
 
 class RoomListCreateView(generics.ListCreateAPIView):
     """
@@ -30,6 +42,16 @@ class RoomListCreateView(generics.ListCreateAPIView):
             is_active=True
         ).distinct().prefetch_related('memberships__user')
 
+    def list(self, request, *args, **kwargs):
+        return cached_response(
+            request, 'room-list', [user_version_key(request.user.id)],
+            lambda: super(RoomListCreateView, self).list(request, *args, **kwargs)
+        )
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        bump_user(self.request.user.id)
+
 
 class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
     """
@@ -46,7 +68,13 @@ class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
             memberships__is_active=True,
             is_active=True
         ).distinct()
-    
+
+    def retrieve(self, request, *args, **kwargs):
+        return cached_response(
+            request, 'room-detail', [room_version_key(kwargs['pk'])],
+            lambda: super(RoomDetailView, self).retrieve(request, *args, **kwargs)
+        )
+
     def update(self, request, *args, **kwargs):
         room = self.get_object()
         # Check if user is admin
@@ -56,7 +84,15 @@ class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
                 {'error': 'Only room admins can update room settings'},
                 status=status.HTTP_403_FORBIDDEN
             )
-        return super().update(request, *args, **kwargs)
+        response = super().update(request, *args, **kwargs)
+        bump(*room_invalidation_keys(room))
+        return response
+
+    def perform_update(self, serializer):
+        ttl = serializer.instance.message_ttl
+        room = serializer.save()
+        if room.message_ttl != ttl:
+            reschedule_room(room)
     
     def destroy(self, request, *args, **kwargs):
         room = self.get_object()
@@ -65,16 +101,26 @@ class RoomDetailView(generics.RetrieveUpdateDestroyAPIView):
                 {'error': 'Only room creator can delete the room'},
                 status=status.HTTP_403_FORBIDDEN
             )
-        return super().destroy(request, *args, **kwargs)
+        # Collected first: the memberships are deleted along with the room
+        keys = room_invalidation_keys(room)
+        response = super().destroy(request, *args, **kwargs)
+        bump(*keys)
+        return response
 
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
+@throttle_classes([JoinRoomThrottle])
 def join_room(request):
     """Join a room using room code"""
     serializer = JoinRoomSerializer(data=request.data, context={'request': request})
     if serializer.is_valid():
         room = serializer.save()
+        bump(*room_invalidation_keys(room))
+        # Members wrap their current sender keys for the newcomer
+        broadcast_to_room(room.id, make_room_event('key_request', {
+            'type': 'key_request', 'user_id': request.user.id, 'epoch': room.key_epoch
+        }))
         room_serializer = RoomSerializer(room, context={'request': request})
         return Response({
             'message': f'Successfully joined room "{room.name}"',
@@ -97,7 +143,15 @@ def leave_room(request, room_id):
         )
         membership.is_active = False
         membership.save()
-        
+
+        # The leaving member knows the current sender keys; start a new epoch
+        Room.objects.filter(id=room.id).update(key_epoch=F('key_epoch') + 1)
+        epoch = Room.objects.values_list('key_epoch', flat=True).get(id=room.id)
+        # Messages can no longer be sent with older sender keys; drop their bundles
+        SenderKeyBundle.objects.filter(room=room, epoch__lt=epoch).delete()
+        bump(*room_invalidation_keys(room), room_keys_version_key(room.id))
+        broadcast_to_room(room.id, make_room_event('key_rotation', {'type': 'key_rotation', 'epoch': epoch}))
+
         return Response({
             'message': f'Successfully left room "{room.name}"'
         }, status=status.HTTP_200_OK)
@@ -127,6 +181,70 @@ class RoomMembersView(generics.ListAPIView):
         
         return room.memberships.filter(is_active=True).select_related('user')
 
+    def list(self, request, *args, **kwargs):
+        return cached_response(
+            request, 'room-members', [room_version_key(kwargs['room_id'])],
+            lambda: super(RoomMembersView, self).list(request, *args, **kwargs)
+        )
+
+
+class RoomKeysView(generics.GenericAPIView):
+    """
+    GET: Sender keys addressed to the current user (?epoch=N, default current epoch)
+    POST: Upload the current user's sender key, wrapped for each active member
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get_room(self):
+        room = get_object_or_404(Room, id=self.kwargs['room_id'], is_active=True)
+        if not room.memberships.filter(user=self.request.user, is_active=True).exists():
+            return None
+        return room
+
+    def get(self, request, room_id):
+        return cached_response(
+            request, 'room-keys', [room_version_key(room_id), room_keys_version_key(room_id)],
+            lambda: self.list_bundles(request)
+        )
+
+    def list_bundles(self, request):
+        room = self.get_room()
+        if room is None:
+            return Response(
+                {'error': 'You are not a member of this room'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        epoch = request.query_params.get('epoch', '')
+        epoch = int(epoch) if epoch.isdigit() else room.key_epoch
+        bundles = SenderKeyBundle.objects.filter(room=room, epoch=epoch, recipient=request.user)
+        return Response({
+            'epoch': epoch,
+            'current_epoch': room.key_epoch,
+            'bundles': SenderKeyBundleSerializer(bundles, many=True).data
+        })
+
+    def post(self, request, room_id):
+        room = self.get_room()
+        if room is None:
+            return Response(
+                {'error': 'You are not a member of this room'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        serializer = SenderKeyUploadSerializer(data=request.data, context={'request': request, 'room': room})
+        if not serializer.is_valid():
+            code = status.HTTP_409_CONFLICT if 'epoch' in serializer.errors else status.HTTP_400_BAD_REQUEST
+            return Response(serializer.errors, status=code)
+        bundles = serializer.save()
+
+        epoch = serializer.validated_data['epoch']
+        bump(room_keys_version_key(room.id))
+        broadcast_to_room(room.id, make_room_event(
+            'sender_key', {'type': 'sender_key', 'sender_id': request.user.id, 'epoch': epoch}
+        ))
+        return Response({'epoch': epoch, 'count': len(bundles)}, status=status.HTTP_201_CREATED)
+
 
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -156,6 +274,24 @@ def create_invite(request, room_id):
 @api_view(['GET'])
 def room_by_code(request, room_code):
     """Get room info by code (for invite links)"""
-    room = get_object_or_404(Room, room_code=room_code.upper(), is_active=True)
-    serializer = RoomSerializer(room, context={'request': request})
-    return Response(serializer.data)
\ No newline at end of file
+    room_code = room_code.upper()
+    # A room keeps its code, so the code -> id lookup is cached on its own.
+    # Deleting the room frees the code for reuse and drops the entry (see
+    # room_deleted); build() still re-resolves an entry that went stale.
+    code_key = room_code_key(room_code)
+    room_id = cache.get(code_key)
+    if room_id is None:
+        room = get_object_or_404(Room, room_code=room_code, is_active=True)
+        room_id = room.id
+        cache.set(code_key, room_id, ROOM_CODE_CACHE_TIMEOUT)
+
+    def build():
+        room = Room.objects.filter(id=room_id, room_code=room_code, is_active=True).first()
+        if room is None:
+            cache.delete(code_key)
+            room = get_object_or_404(Room, room_code=room_code, is_active=True)
+            cache.set(code_key, room.id, ROOM_CODE_CACHE_TIMEOUT)
+        serializer = RoomSerializer(room, context={'request': request})
+        return Response(serializer.data)
+
+    return cached_response(request, 'room-by-code', [room_version_key(room_id)], build)
@@ -0,0 +1,60 @@
+"""
+Startup time and resident memory of the full and WebSocket-only ASGI apps.
+
+Each profile is imported in a fresh interpreter several times; the median
+import time and peak RSS are printed. No database or Redis is needed.
+
+    python benchmarks/asgi_profiles.py --runs 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROFILES = {
+    'full (asgi)': ('porcupine_backend.asgi', 'porcupine_backend.settings'),
+    'websocket (asgi_ws)': ('porcupine_backend.asgi_ws', 'porcupine_backend.settings_ws'),
+}
+
+PROBE = '''
+import resource, sys, time
+started = time.perf_counter()
+import {module}
+if {warm}:
+    from apps.chat.routing import websocket_urlpatterns
+elapsed = time.perf_counter() - started
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(elapsed, rss_kb, len(sys.modules))
+'''
+
+
+def measure(module, settings_module, warm):
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module, warm=warm)],
+        cwd=BACKEND_DIR, env=env, check=True, capture_output=True, text=True,
+    ).stdout.split()
+    return float(output[0]), int(output[1]), int(output[2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--warm', action='store_true',
+                        help='Also import the chat consumers, as after the first connection')
+    args = parser.parse_args()
+
+    print(f'{"profile":<22} {"startup ms":>10} {"max RSS MB":>10} {"modules":>8}')
+    for name, (module, settings_module) in PROFILES.items():
+        samples = [measure(module, settings_module, args.warm) for _ in range(args.runs)]
+        startup = statistics.median(sample[0] for sample in samples) * 1000
+        rss = statistics.median(sample[1] for sample in samples) / 1024
+        modules = statistics.median(sample[2] for sample in samples)
+        print(f'{name:<22} {startup:>10.1f} {rss:>10.1f} {modules:>8.0f}')
+
+
+if __name__ == '__main__':
+    main()
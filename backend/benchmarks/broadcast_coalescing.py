@@ -0,0 +1,90 @@
+"""
+Microbenchmark of room broadcast coalescing.
+
+Simulates one busy room: every connection's Outbox receives the same burst of
+chat messages interleaved with typing events, and frames are written to a
+no-op socket. Prints frames and CPU time per delivered event for immediate
+delivery and for a few coalescing windows.
+
+    python benchmarks/broadcast_coalescing.py --members 100 --rate 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.chat.broadcast import Outbox, encode_event  # noqa: E402
+
+
+class FakeSocket:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send(self, text):
+        self.frames += 1
+        self.bytes += len(text)
+        # Yield like a real transport write does
+        await asyncio.sleep(0)
+
+
+async def run(window, args):
+    sockets = [FakeSocket() for _ in range(args.members)]
+    outboxes = [Outbox(socket.send, window, args.max_pending) for socket in sockets]
+    message = encode_event({'type': 'message', 'message': {'encrypted_content': 'x' * args.payload}})
+    typing = [encode_event({'type': 'typing', 'user_id': user_id}) for user_id in range(args.members)]
+
+    interval = 1 / args.rate
+    events = 0
+    cpu_started = time.process_time()
+    started = time.monotonic()
+    for i in range(int(args.rate * args.duration)):
+        if i % 3 == 2:
+            kind, payload, key = 'typing', typing[i % args.members], f'typing:{i % args.members}'
+        else:
+            kind, payload, key = 'message', message, None
+        # One group_send fans out to every member's handler
+        for outbox in outboxes:
+            await outbox.push(kind, payload, key)
+        events += 1
+        delay = started + (i + 1) * interval - time.monotonic()
+        await asyncio.sleep(max(delay, 0))
+    for outbox in outboxes:
+        await outbox.flush()
+    cpu = time.process_time() - cpu_started
+
+    delivered = events * args.members
+    frames = sum(socket.frames for socket in sockets)
+    dropped = sum(outbox.dropped for outbox in outboxes)
+    return {
+        'frames_per_event': frames / delivered,
+        'cpu_us_per_event': cpu / delivered * 1e6,
+        'bytes': sum(socket.bytes for socket in sockets),
+        'dropped': dropped,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--rate', type=int, default=2000, help='Room events per second')
+    parser.add_argument('--duration', type=float, default=2.0)
+    parser.add_argument('--payload', type=int, default=256)
+    parser.add_argument('--max-pending', type=int, default=500)
+    parser.add_argument('--windows', type=int, nargs='+', default=[0, 10, 25, 50], help='Windows in ms')
+    args = parser.parse_args()
+
+    print(f'{"window":>8} {"frames/event":>13} {"cpu us/event":>13} {"MB sent":>8} {"dropped":>8}')
+    for window_ms in args.windows:
+        result = asyncio.run(run(window_ms / 1000, args))
+        print(
+            f'{window_ms:>6}ms {result["frames_per_event"]:>13.3f} {result["cpu_us_per_event"]:>13.2f} '
+            f'{result["bytes"] / 1e6:>8.1f} {result["dropped"]:>8}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""
+Fan-out throughput of the sharded channel layer against local Redis instances.
+
+Start a few Redis servers first, e.g.
+
+    for port in 6379 6380 6381 6382; do redis-server --port $port --daemonize yes; done
+    python benchmarks/channel_fanout.py --hosts redis://localhost:6379 redis://localhost:6380 \\
+        redis://localhost:6381 redis://localhost:6382
+
+For every shard count from 1 to len(--hosts) the benchmark runs subscriber
+and publisher processes over room groups and prints delivered messages per
+second.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from porcupine_backend.channel_layers import ShardedPubSubChannelLayer  # noqa: E402
+
+
+def subscriber(hosts, groups, counter, ready, stop):
+    async def run():
+        layer = ShardedPubSubChannelLayer(hosts=hosts)
+        channel = await layer.new_channel()
+        for group in groups:
+            await layer.group_add(group, channel)
+        ready.release()
+        received = 0
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(layer.receive(channel), timeout=0.5)
+            except asyncio.TimeoutError:
+                continue
+            received += 1
+            if received % 100 == 0:
+                with counter.get_lock():
+                    counter.value += 100
+        with counter.get_lock():
+            counter.value += received % 100
+        await layer.flush()
+
+    asyncio.run(run())
+
+
+def publisher(hosts, groups, payload_size, stop):
+    async def run():
+        layer = ShardedPubSubChannelLayer(hosts=hosts)
+        message = {'type': 'chat.message', 'encrypted_content': 'x' * payload_size}
+        i = 0
+        while not stop.is_set():
+            await layer.group_send(groups[i % len(groups)], message)
+            i += 1
+        await layer.flush()
+
+    asyncio.run(run())
+
+
+def run_round(hosts, args):
+    groups = [f'room.{uuid.uuid4().hex}' for _ in range(args.rooms)]
+    counter = multiprocessing.Value('q', 0)
+    ready = multiprocessing.Semaphore(0)
+    stop = multiprocessing.Event()
+
+    # Every subscriber process joins every room, so one publish fans out
+    # to --subscribers deliveries.
+    subscribers = [
+        multiprocessing.Process(target=subscriber, args=(hosts, groups, counter, ready, stop))
+        for _ in range(args.subscribers)
+    ]
+    for process in subscribers:
+        process.start()
+    for _ in subscribers:
+        ready.acquire()
+
+    publishers = [
+        multiprocessing.Process(target=publisher, args=(hosts, groups, args.payload, stop))
+        for _ in range(args.publishers)
+    ]
+    started = time.monotonic()
+    for process in publishers:
+        process.start()
+    time.sleep(args.duration)
+    stop.set()
+    elapsed = time.monotonic() - started
+
+    for process in publishers + subscribers:
+        process.join()
+    return counter.value / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hosts', nargs='+', required=True)
+    parser.add_argument('--rooms', type=int, default=256)
+    parser.add_argument('--subscribers', type=int, default=4)
+    parser.add_argument('--publishers', type=int, default=8)
+    parser.add_argument('--payload', type=int, default=256, help='Bytes of ciphertext per message')
+    parser.add_argument('--duration', type=float, default=10.0)
+    args = parser.parse_args()
+
+    baseline = None
+    print(f'{"shards":>6} {"delivered/s":>12} {"speedup":>8}')
+    for count in range(1, len(args.hosts) + 1):
+        rate = run_round(args.hosts[:count], args)
+        baseline = baseline or rate
+        print(f'{count:>6} {rate:>12,.0f} {rate / baseline:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Chat latency under a login flood.
+
+One event loop handles a steady stream of chat messages (encoding each event
+for every room member) while a burst of logins hashes passwords the way a
+daphne worker runs sync views: in a thread pool. Prints chat handling
+latency percentiles with hashing done in the request threads and in the
+low-priority process pool.
+
+    python benchmarks/login_flood.py --logins 48 --concurrency 16
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.configure(
+    PASSWORD_HASHERS=['apps.accounts.hashers.PooledPBKDF2PasswordHasher'],
+    PASSWORD_HASHING={'WORKERS': 0, 'MAX_QUEUE': 1000, 'TIMEOUT': 600, 'RETRY_AFTER': 2, 'NICE': 10},
+)
+django.setup()
+
+from django.test.utils import override_settings  # noqa: E402
+
+from apps.accounts.hashers import PooledPBKDF2PasswordHasher, pool  # noqa: E402
+from apps.chat.broadcast import encode_event  # noqa: E402
+
+
+async def chat(stop, args):
+    """Handle one room message every `interval`; return handling latencies in ms"""
+    message = {'type': 'message', 'message': {'encrypted_content': 'x' * args.payload}}
+    interval = 1 / args.rate
+    latencies = []
+    scheduled = time.perf_counter()
+    while not stop.is_set():
+        scheduled += interval
+        await asyncio.sleep(max(0, scheduled - time.perf_counter()))
+        for _ in range(args.members):
+            encode_event(message)
+        latencies.append((time.perf_counter() - scheduled) * 1000)
+    return latencies
+
+
+async def run(workers, args):
+    hasher = PooledPBKDF2PasswordHasher()
+    hasher.iterations = args.iterations
+    loop = asyncio.get_running_loop()
+
+    with override_settings(PASSWORD_HASHING={**settings.PASSWORD_HASHING, 'WORKERS': workers}):
+        if workers:
+            # Start the workers before measuring
+            await asyncio.gather(*[
+                loop.run_in_executor(None, hasher.encode, 'warmup', 'salt', 1) for _ in range(workers)
+            ])
+
+        stop = asyncio.Event()
+        chat_task = asyncio.create_task(chat(stop, args))
+        await asyncio.sleep(0.5)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as threads:
+            await asyncio.gather(*[
+                loop.run_in_executor(threads, hasher.encode, f'password-{i}', f'salt{i}')
+                for i in range(args.logins)
+            ])
+        login_seconds = time.perf_counter() - started
+
+        stop.set()
+        latencies = await chat_task
+        pool.shutdown()
+
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies),
+        'p99': latencies[int(len(latencies) * 0.99) - 1],
+        'max': latencies[-1],
+        'logins_per_s': args.logins / login_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--logins', type=int, default=48)
+    parser.add_argument('--concurrency', type=int, default=16, help='Request threads hashing at once')
+    parser.add_argument('--iterations', type=int, default=600000, help='PBKDF2 iterations')
+    parser.add_argument('--rate', type=int, default=200, help='Chat messages per second')
+    parser.add_argument('--members', type=int, default=50, help='Recipients encoded per message')
+    parser.add_argument('--payload', type=int, default=512)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2],
+                        help='Pool sizes to compare; 0 hashes in the request threads')
+    args = parser.parse_args()
+
+    print(f'cpus: {os.cpu_count()}')
+    print(f'{"hashing":>10} {"chat p50 ms":>12} {"chat p99 ms":>12} {"chat max ms":>12} {"logins/s":>9}')
+    for workers in args.workers:
+        result = asyncio.run(run(workers, args))
+        label = f'pool x{workers}' if workers else 'inline'
+        print(
+            f'{label:>10} {result["p50"]:>12.2f} {result["p99"]:>12.2f} '
+            f'{result["max"]:>12.2f} {result["logins_per_s"]:>9.1f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Notification fan-out throughput.
+
+Seeds an in-memory SQLite database with rooms of `--members` members, sends
+`--messages` messages per room through the fan-out task (Celery in eager
+mode, so tasks run inline without a broker) with `--online` of each room
+connected, then flushes the digests. Prints messages and pending
+notifications handled per second, and how many digests the burst was
+coalesced into.
+
+    python benchmarks/notification_fanout.py --rooms 20 --members 200 --messages 50
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.configure(
+    INSTALLED_APPS=[
+        'django.contrib.auth', 'django.contrib.contenttypes',
+        'apps.accounts', 'apps.rooms', 'apps.chat', 'apps.notifications',
+    ],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    USE_TZ=True,
+    CELERY_TASK_ALWAYS_EAGER=True,
+    NOTIFICATIONS={
+        'DIGEST_WINDOW': 60,
+        'BATCH_SIZE': 500,
+        'SINKS': [{'BACKEND': 'apps.notifications.sinks.MemorySink'}],
+    },
+)
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.utils import timezone  # noqa: E402
+
+from apps.notifications.models import PendingNotification  # noqa: E402
+from apps.notifications.sinks import MemorySink  # noqa: E402
+from apps.notifications.tasks import fan_out_message, flush_digests  # noqa: E402
+from apps.rooms.models import Room, RoomMembership  # noqa: E402
+import porcupine_backend  # noqa: E402,F401  (the Celery app, configured from settings above)
+
+
+def seed(args):
+    users = User.objects.bulk_create([User(username=f'user{i}') for i in range(args.members * 2)])
+    rooms = []
+    for i in range(args.rooms):
+        room = Room.objects.create(name=f'Room {i}', room_code=f'B{i:05d}', created_by=users[0])
+        members = random.sample(users, args.members)
+        RoomMembership.objects.bulk_create([
+            RoomMembership(room=room, user=user, public_key='pk') for user in members
+        ])
+        rooms.append((room, [user.id for user in members]))
+    return rooms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--members', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=50, help='Messages per room')
+    parser.add_argument('--online', type=float, default=0.2, help='Fraction of members connected')
+    args = parser.parse_args()
+
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    rooms = seed(args)
+    online = {
+        str(room.id): set(random.sample(members, int(len(members) * args.online)))
+        for room, members in rooms
+    }
+
+    with mock.patch('apps.notifications.tasks.online_users', lambda room_id: online[room_id]):
+        started = time.perf_counter()
+        notifications = 0
+        for seq in range(1, args.messages + 1):
+            for room, members in rooms:
+                notifications += fan_out_message.delay(str(room.id), seq, random.choice(members)).get()
+        fan_out_seconds = time.perf_counter() - started
+
+    PendingNotification.objects.update(first_at=timezone.now() - timedelta(minutes=5))
+    pending = PendingNotification.objects.count()
+    started = time.perf_counter()
+    digests = flush_digests.delay().get()
+    flush_seconds = time.perf_counter() - started
+
+    messages = args.rooms * args.messages
+    print(f'messages:       {messages} ({messages / fan_out_seconds:.0f}/s fanned out)')
+    print(f'notifications:  {notifications} ({notifications / fan_out_seconds:.0f}/s)')
+    print(f'pending rows:   {pending}')
+    print(f'digests:        {digests} ({digests / flush_seconds:.0f}/s flushed, {len(MemorySink.outbox)} delivered)')
+    print(f'coalescing:     {notifications / max(digests, 1):.1f} notifications per digest')
+
+
+if __name__ == '__main__':
+    main()
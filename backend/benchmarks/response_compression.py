@@ -0,0 +1,147 @@
+"""
+Bytes on the wire and CPU per request for history pages and chat frames.
+
+Builds a history page shaped like the REST response (nested sender objects,
+base64 ciphertext) and prints, per request, the response size and the CPU
+spent rendering and compressing it: uncompressed, compressed by the
+middleware on every request, and served from the precompressed page cache
+(unpickling the stored variants, as the cache backend does on a hit).
+Then streams `message` events through permessage-deflate with the
+WebSocket compression settings to compare.
+
+    python benchmarks/response_compression.py --messages 50 --requests 500
+"""
+import argparse
+import base64
+import os
+import pickle
+import sys
+import time
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.configure(
+    COMPRESSION={
+        'MIN_SIZE': 1024,
+        'LEVELS': {'gzip': 6, 'br': 4},
+        'CACHED_LEVELS': {'gzip': 9, 'br': 9},
+        'TYPES': ['application/json'],
+        'EXCLUDE_PATHS': [],
+    },
+)
+django.setup()
+
+from rest_framework.renderers import JSONRenderer  # noqa: E402
+
+from apps.chat.broadcast import encode_event  # noqa: E402
+from porcupine_backend.compression import available_encodings, compress  # noqa: E402
+
+
+def make_messages(count, payload):
+    room = str(uuid.uuid4())
+    users = [
+        {'id': i, 'username': f'user{i}', 'email': f'user{i}@example.com', 'first_name': '', 'last_name': ''}
+        for i in range(1, 7)
+    ]
+    started = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    return [
+        {
+            'id': str(uuid.uuid4()), 'room': room, 'sender': users[seq % len(users)],
+            'encrypted_content': base64.b64encode(os.urandom(payload)).decode(),
+            'nonce': base64.b64encode(os.urandom(12)).decode(),
+            'timestamp': (started + timedelta(seconds=seq * 7)).isoformat(),
+            'message_type': 'text', 'is_active': True, 'seq': seq, 'key_epoch': 1, 'attachment': None,
+        }
+        for seq in range(1, count + 1)
+    ]
+
+
+def cpu_us(func, repeat):
+    started = time.process_time()
+    for _ in range(repeat):
+        result = func()
+    return (time.process_time() - started) / repeat * 1e6, result
+
+
+def history(args):
+    page = {'count': 500, 'next': 'http://api.example.com/api/chat/rooms/x/messages/?page=2', 'previous': None,
+            'results': make_messages(args.messages, args.payload)}
+    render = JSONRenderer().render
+
+    rows = []
+    cpu, body = cpu_us(lambda: render(page), args.requests)
+    rows.append(('identity', len(body), cpu))
+    for encoding in available_encodings():
+        cpu, compressed = cpu_us(lambda: compress(render(page), encoding), args.requests)
+        rows.append((f'{encoding} per request', len(compressed), cpu))
+
+    variants = {'identity': body}
+    for encoding in available_encodings():
+        variants[encoding] = compress(body, encoding, settings.COMPRESSION['CACHED_LEVELS'])
+    stored = pickle.dumps(variants)
+    best = available_encodings()[0]
+    cpu, _ = cpu_us(lambda: pickle.loads(stored)[best], args.requests)
+    rows.append((f'{best} precompressed', len(variants[best]), cpu))
+
+    print(f'history page: {args.messages} messages')
+    print(f'{"mode":>22} {"bytes":>8} {"ratio":>6} {"cpu us/req":>11}')
+    for label, size, cpu in rows:
+        print(f'{label:>22} {size:>8} {size / len(body):>6.2f} {cpu:>11.1f}')
+
+
+def deflate_frames(frames, window_bits, mem_level, context_takeover):
+    """Total permessage-deflate payload bytes for `frames` (RFC 7692)"""
+    total = 0
+    compressor = None
+    for frame in frames:
+        if compressor is None or not context_takeover:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -window_bits, mem_level)
+        data = compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        total += len(data) - 4  # Trailing 00 00 ff ff is stripped on the wire
+    return total
+
+
+def websocket(args):
+    frames = [
+        encode_event({'type': 'message', 'message': message}).encode()
+        for message in make_messages(args.frames, args.payload)
+    ]
+    raw = sum(len(frame) for frame in frames)
+    configs = [
+        ('window 11, mem 4', 11, 4, True),
+        ('window 15, mem 8', 15, 8, True),
+        ('no context takeover', 11, 4, False),
+    ]
+
+    print(f'\nwebsocket: {args.frames} message frames')
+    print(f'{"mode":>22} {"bytes/frame":>12} {"ratio":>6} {"cpu us/frame":>13} {"kB/conn":>8}')
+    print(f'{"off":>22} {raw / len(frames):>12.0f} {1:>6.2f} {0:>13.1f} {0:>8}')
+    for label, window_bits, mem_level, takeover in configs:
+        cpu, total = cpu_us(lambda: deflate_frames(frames, window_bits, mem_level, takeover), 5)
+        memory = (2 ** (window_bits + 2) + 2 ** (mem_level + 9)) // 1024 if takeover else 0
+        print(
+            f'{label:>22} {total / len(frames):>12.0f} {total / raw:>6.2f} '
+            f'{cpu / len(frames):>13.1f} {memory:>8}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=50, help='Messages per history page')
+    parser.add_argument('--payload', type=int, default=256, help='Ciphertext bytes per message')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--frames', type=int, default=1000, help='WebSocket message frames')
+    args = parser.parse_args()
+
+    history(args)
+    websocket(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Send-path and storage cost of per-recipient encryption vs room sender keys.
+
+Per-recipient: every message is encrypted once per member with the pairwise
+key and stored as one ciphertext row per member. Sender keys: every message
+is encrypted once; each member distributes its sender key to the others
+once per epoch (one wrapped key per member pair).
+
+The first table times client-side encryption with estimated row sizes. The
+second runs the server on an in-memory SQLite database: sends go through
+MessageCreateSerializer (validation, epoch check, sequence number and
+recipient rows), once per recipient for per-recipient encryption, and every
+member uploads its wrapped keys through SenderKeyUploadSerializer. Storage
+is what the message and key bundle tables hold afterwards.
+
+    python benchmarks/sender_keys.py --sizes 2 10 50 100 --messages 200 --server-messages 20
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.configure(
+    INSTALLED_APPS=[
+        'django.contrib.auth', 'django.contrib.contenttypes',
+        'apps.accounts', 'apps.rooms', 'apps.chat', 'apps.notifications',
+    ],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    USE_TZ=True,
+)
+django.setup()
+
+from django.contrib.auth.models import User  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db.models import Count, Sum  # noqa: E402
+from django.db.models.functions import Length  # noqa: E402
+
+from apps.chat.models import Message, MessageRecipient  # noqa: E402
+from apps.chat.serializers import MessageCreateSerializer  # noqa: E402
+from apps.rooms.models import Room, RoomMembership, SenderKeyBundle  # noqa: E402
+from apps.rooms.serializers import SenderKeyUploadSerializer  # noqa: E402
+
+# Approximate per-row overhead of a message / key bundle row in Postgres
+# (tuple header, UUIDs, foreign keys, timestamps)
+ROW_OVERHEAD = 120
+
+
+def encrypt(key, plaintext):
+    nonce = os.urandom(12)
+    ciphertext = AESGCM(key).encrypt(nonce, plaintext, None)
+    return base64.b64encode(ciphertext).decode(), base64.b64encode(nonce).decode()
+
+
+def per_recipient(members, messages, plaintext):
+    pairwise = [AESGCM.generate_key(bit_length=256) for _ in range(members - 1)]
+    stored = 0
+    started = time.perf_counter()
+    for _ in range(messages):
+        for key in pairwise:
+            ciphertext, nonce = encrypt(key, plaintext)
+            stored += len(ciphertext) + len(nonce) + ROW_OVERHEAD
+    return (time.perf_counter() - started) / messages, stored
+
+
+def sender_keys(members, messages, plaintext):
+    pairwise = [AESGCM.generate_key(bit_length=256) for _ in range(members - 1)]
+    sender_key = AESGCM.generate_key(bit_length=256)
+
+    # Distribution once per epoch: every member wraps its key for the others
+    stored = 0
+    for _ in range(members):
+        for key in pairwise:
+            wrapped, nonce = encrypt(key, sender_key)
+            stored += len(wrapped) + len(nonce) + ROW_OVERHEAD
+
+    started = time.perf_counter()
+    for _ in range(messages):
+        ciphertext, nonce = encrypt(sender_key, plaintext)
+        stored += len(ciphertext) + len(nonce) + ROW_OVERHEAD
+    return (time.perf_counter() - started) / messages, stored
+
+
+def seed_room(members):
+    offset = User.objects.count()
+    users = User.objects.bulk_create([User(username=f'user{offset + i}') for i in range(members)])
+    room = Room.objects.create(name=f'{members} members', room_code=f'B{offset:05d}', created_by=users[0])
+    RoomMembership.objects.bulk_create([RoomMembership(room=room, user=user, public_key='pk') for user in users])
+    return room, users
+
+
+def send(room, sender, ciphertext, nonce, epoch):
+    serializer = MessageCreateSerializer(data={
+        'room': room.id, 'encrypted_content': ciphertext, 'nonce': nonce, 'key_epoch': epoch
+    }, context={'room_id': room.id})
+    serializer.is_valid(raise_exception=True)
+    serializer.save(room=room, sender=sender)
+
+
+def stored_bytes(model, field, **filters):
+    totals = model.objects.filter(**filters).aggregate(rows=Count('pk'), size=Sum(Length(field)))
+    return totals['rows'], (totals['size'] or 0) + totals['rows'] * ROW_OVERHEAD
+
+
+def server_per_recipient(members, messages, plaintext):
+    room, users = seed_room(members)
+    pairwise = [AESGCM.generate_key(bit_length=256) for _ in range(members - 1)]
+    started = time.perf_counter()
+    for _ in range(messages):
+        for key in pairwise:
+            send(room, users[0], *encrypt(key, plaintext), epoch=0)
+    elapsed = (time.perf_counter() - started) / messages
+    _, message_bytes = stored_bytes(Message, 'encrypted_content', room=room)
+    return elapsed, message_bytes + MessageRecipient.objects.filter(message__room=room).count() * ROW_OVERHEAD
+
+
+def server_sender_keys(members, messages, plaintext):
+    room, users = seed_room(members)
+    pairwise = [AESGCM.generate_key(bit_length=256) for _ in range(members - 1)]
+    sender_key = AESGCM.generate_key(bit_length=256)
+
+    started = time.perf_counter()
+    for sender in users:
+        bundles = [
+            {'recipient_id': recipient.id, 'encrypted_key': encrypt(key, sender_key)[0]}
+            for recipient, key in zip([user for user in users if user != sender], pairwise)
+        ]
+        upload = SenderKeyUploadSerializer(
+            data={'epoch': room.key_epoch, 'bundles': bundles},
+            context={'room': room, 'request': SimpleNamespace(user=sender)},
+        )
+        upload.is_valid(raise_exception=True)
+        upload.save()
+    distribution = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(messages):
+        send(room, users[0], *encrypt(sender_key, plaintext), epoch=room.key_epoch)
+    elapsed = (time.perf_counter() - started) / messages
+    _, message_bytes = stored_bytes(Message, 'encrypted_content', room=room)
+    _, bundle_bytes = stored_bytes(SenderKeyBundle, 'encrypted_key', room=room)
+    recipient_bytes = MessageRecipient.objects.filter(message__room=room).count() * ROW_OVERHEAD
+    return elapsed, distribution, message_bytes + recipient_bytes, bundle_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2, 10, 50, 100])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--payload', type=int, default=256)
+    parser.add_argument('--server-messages', type=int, default=20,
+                        help='Messages per room size sent through the server (0 to skip)')
+    args = parser.parse_args()
+
+    plaintext = os.urandom(args.payload)
+    print(f'{"members":>7} {"pairwise us/send":>17} {"sender-key us/send":>19} '
+          f'{"pairwise KB":>12} {"sender-key KB":>14}')
+    for members in args.sizes:
+        pairwise_cost, pairwise_bytes = per_recipient(members, args.messages, plaintext)
+        sender_cost, sender_bytes = sender_keys(members, args.messages, plaintext)
+        print(f'{members:>7} {pairwise_cost * 1e6:>17.1f} {sender_cost * 1e6:>19.1f} '
+              f'{pairwise_bytes / 1024:>12.0f} {sender_bytes / 1024:>14.0f}')
+
+    if not args.server_messages:
+        return
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    print()
+    print(f'{"members":>7} {"pairwise ms/send":>17} {"sender-key ms/send":>19} {"key upload ms":>14} '
+          f'{"pairwise KB":>12} {"sender-key KB":>14} {"bundles KB":>11}')
+    for members in args.sizes:
+        pairwise_cost, pairwise_bytes = server_per_recipient(members, args.server_messages, plaintext)
+        sender_cost, distribution, sender_bytes, bundle_bytes = server_sender_keys(
+            members, args.server_messages, plaintext
+        )
+        print(f'{members:>7} {pairwise_cost * 1e3:>17.2f} {sender_cost * 1e3:>19.2f} {distribution * 1e3:>14.1f} '
+              f'{pairwise_bytes / 1024:>12.0f} {sender_bytes / 1024:>14.0f} {bundle_bytes / 1024:>11.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+ASGI config for dedicated WebSocket workers.
+
+    python -m porcupine_backend.serve -b 0.0.0.0 -p 8001 porcupine_backend.asgi_ws:application
+
+Uses the slim settings profile in ``settings_ws`` and skips Django's HTTP
+handler entirely; the only HTTP route is a health check. The chat routing is
+imported on the first WebSocket connection rather than at startup.
+"""
+
+import os
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'porcupine_backend.settings_ws')
+django.setup(set_prefix=False)
+
+from channels.routing import ProtocolTypeRouter, URLRouter
+
+
+class LazyWebSocketRouter:
+    """Import the consumers on first use so the worker starts serving sooner"""
+
+    def __init__(self):
+        self.router = None
+
+    async def __call__(self, scope, receive, send):
+        if self.router is None:
+            from apps.chat.routing import websocket_urlpatterns
+            self.router = URLRouter(websocket_urlpatterns)
+        return await self.router(scope, receive, send)
+
+
+async def health_check(scope, receive, send):
+    """Minimal HTTP handler for load balancer health checks"""
+    status = 200 if scope['path'] == '/healthz' else 404
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain')],
+    })
+    await send({'type': 'http.response.body', 'body': b'ok' if status == 200 else b''})
+
+
+application = ProtocolTypeRouter({
+    'http': health_check,
+    'websocket': LazyWebSocketRouter(),
+})
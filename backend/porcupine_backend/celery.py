@@ -0,0 +1,14 @@
+"""
+Celery application for background work (notification fan-out and digests).
+
+    celery -A porcupine_backend worker -B -l info
+"""
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'porcupine_backend.settings')
+
+app = Celery('porcupine_backend')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
@@ -0,0 +1,195 @@
+"""
+Sharded Redis pub/sub channel layer.
+
+Groups are placed on Redis shards with rendezvous hashing, so adding or
+removing a shard only moves the groups that hash to it. Group names of the
+form ``<kind>.<id>[.<suffix>]`` (e.g. ``room.<uuid>`` and
+``room.<uuid>.presence``) are placed by ``<kind>.<id>`` so everything that
+belongs to one room lives on the same shard.
+
+When a registry is configured, every worker polls a Redis set with the
+current shard addresses and rebalances its subscriptions without a restart.
+Moved subscriptions are kept on the old shard for a grace period, so
+messages that workers which have not refreshed yet publish to the old shard
+still arrive. The reverse is not covered: a worker that has not refreshed
+does not listen on the new shard yet, so for up to `refresh_interval` it
+misses what refreshed workers publish there. A client that sees a gap in
+message sequence numbers can reconnect with `resume` to fetch what it
+missed (see apps.chat.history).
+"""
+import asyncio
+import hashlib
+import logging
+
+from channels_redis.pubsub import (
+    RedisPubSubChannelLayer,
+    RedisPubSubLoopLayer,
+    RedisSingleShardConnection,
+)
+from channels_redis.utils import _close_redis, _wrap_close, create_pool, decode_hosts
+from redis import asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+GROUP_MARKER = '__group__'
+PLACEMENT_CACHE_SIZE = 100000
+
+
+def affinity_key(channel_or_group_name):
+    """Return the part of a channel or group name that decides its shard"""
+    name = channel_or_group_name.rsplit(GROUP_MARKER, 1)[-1]
+    parts = name.split('.', 2)
+    if len(parts) == 3:
+        return f'{parts[0]}.{parts[1]}'
+    return name
+
+
+def shard_address(host):
+    """Stable identifier for a decoded host entry"""
+    if 'address' in host:
+        return host['address']
+    if 'master_name' in host:
+        return f"sentinel://{host['master_name']}"
+    return f"redis://{host.get('host', 'localhost')}:{host.get('port', 6379)}"
+
+
+def rendezvous_pick(key, addresses):
+    """Highest-random-weight choice of a shard address for key"""
+    def weight(address):
+        digest = hashlib.blake2b(f'{address}|{key}'.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big')
+    return max(addresses, key=weight)
+
+
+class ShardedPubSubChannelLayer(RedisPubSubChannelLayer):
+    """
+    Drop-in replacement for RedisPubSubChannelLayer with room-affinity sharding.
+
+    CONFIG:
+        hosts: initial shard list (same format as channels_redis)
+        registry: optional {'address': 'redis://...', 'key': '...'} holding
+            the live shard set
+        refresh_interval: seconds between registry polls
+    """
+
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+
+        try:
+            layer = self._layers[loop]
+        except KeyError:
+            layer = ShardedPubSubLoopLayer(
+                *self._args,
+                **self._kwargs,
+                channel_layer=self,
+            )
+            self._layers[loop] = layer
+            _wrap_close(self, loop)
+
+        return layer
+
+
+class ShardedPubSubLoopLayer(RedisPubSubLoopLayer):
+
+    def __init__(self, hosts=None, registry=None, refresh_interval=5, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        self._shards_by_address = {
+            shard_address(shard.host): shard for shard in self._shards
+        }
+        self._placement = {}
+        self.registry = registry
+        self.refresh_interval = refresh_interval
+        self._refresh_task = None
+        # (deadline, shard, name) subscriptions kept alive on a previous
+        # shard; name is None for a shard that left the ring
+        self._draining = []
+
+    def _get_shard(self, channel_or_group_name):
+        if self.registry and self._refresh_task is None:
+            self._refresh_task = asyncio.ensure_future(self._refresh_shards())
+
+        key = affinity_key(channel_or_group_name)
+        shard = self._placement.get(key)
+        if shard is None:
+            if len(self._placement) >= PLACEMENT_CACHE_SIZE:
+                self._placement = {}
+            shard = self._shards_by_address[rendezvous_pick(key, self._shards_by_address)]
+            self._placement[key] = shard
+        return shard
+
+    async def _refresh_shards(self):
+        registry = dict(self.registry)
+        key = registry.pop('key')
+        redis = aioredis.Redis(connection_pool=create_pool(registry))
+        try:
+            while True:
+                try:
+                    addresses = await redis.smembers(key)
+                    if addresses:
+                        await self._apply_shards({address.decode() for address in addresses})
+                    await self._drain_expired()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception('Failed to refresh channel layer shards')
+                await asyncio.sleep(self.refresh_interval)
+        finally:
+            await _close_redis(redis)
+
+    async def _apply_shards(self, addresses):
+        if addresses == set(self._shards_by_address):
+            return
+
+        previous = self._shards_by_address
+        names = list(self.channels) + list(self.groups)
+        before = {name: self._get_shard(name) for name in names}
+
+        self._shards_by_address = {
+            address: previous.get(address) or RedisSingleShardConnection({'address': address}, self)
+            for address in sorted(addresses)
+        }
+        self._shards = list(self._shards_by_address.values())
+        self._placement = {}
+        logger.info('Channel layer shards changed: %s', ', '.join(sorted(addresses)))
+
+        deadline = asyncio.get_running_loop().time() + 2 * self.refresh_interval
+        for name in names:
+            shard = self._get_shard(name)
+            if shard is not before[name]:
+                await shard.subscribe(name)
+                self._draining.append((deadline, before[name], name))
+        for address, shard in previous.items():
+            if address not in self._shards_by_address:
+                self._draining.append((deadline, shard, None))
+
+    async def _drain_expired(self):
+        now = asyncio.get_running_loop().time()
+        pending = []
+        for deadline, shard, name in self._draining:
+            if deadline > now:
+                pending.append((deadline, shard, name))
+            elif name is None:
+                if shard not in self._shards:
+                    await shard.flush()
+            elif self._get_shard(name) is not shard:
+                await shard.unsubscribe(name)
+        self._draining = pending
+
+    async def flush(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+        for _, shard, _ in self._draining:
+            if shard not in self._shards:
+                await shard.flush()
+        self._draining = []
+        await super().flush()
+
+
+def configured_shards(hosts):
+    """Shard addresses for a channels_redis style hosts list"""
+    return [shard_address(host) for host in decode_hosts(hosts)]
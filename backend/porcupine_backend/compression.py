@@ -0,0 +1,94 @@
+"""
+Response compression.
+
+CompressionMiddleware compresses API responses of at least MIN_SIZE bytes
+with the best encoding the client accepts: brotli when the `brotli` package
+is installed, otherwise gzip. Responses that already carry a
+Content-Encoding (such as precompressed cached pages, see
+apps.rooms.caching.cached_page) are passed through untouched.
+
+Paths in EXCLUDE_PATHS are never compressed: their bodies carry tokens, and
+compressing secrets next to attacker-influenced input leaks them (BREACH).
+"""
+import gzip
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # Optional, gzip only without it
+    brotli = None
+
+
+def available_encodings():
+    """Supported encodings, most preferred first"""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def negotiate(accept_encoding, encodings=None):
+    """The first of `encodings` the Accept-Encoding header allows, or None"""
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    for encoding in encodings if encodings is not None else available_encodings():
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def compress(data, encoding, levels=None):
+    levels = levels or settings.COMPRESSION['LEVELS']
+    if encoding == 'br':
+        return brotli.compress(data, quality=levels['br'])
+    # mtime=0 keeps the output identical for identical input
+    return gzip.compress(data, compresslevel=levels['gzip'], mtime=0)
+
+
+def is_compressible(response):
+    content_type = response.get('Content-Type', '')
+    return any(content_type.startswith(prefix) for prefix in settings.COMPRESSION['TYPES'])
+
+
+class CompressionMiddleware:
+    """Negotiated gzip/brotli for API responses above COMPRESSION['MIN_SIZE']"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        config = settings.COMPRESSION
+        if (
+            response.streaming
+            or response.has_header('Content-Encoding')
+            or not is_compressible(response)
+            or len(response.content) < config['MIN_SIZE']
+            or request.path.startswith(tuple(config['EXCLUDE_PATHS']))
+        ):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = negotiate(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return response
+        body = compress(response.content, encoding)
+        if len(body) >= len(response.content):
+            return response
+
+        response.content = body
+        response['Content-Length'] = str(len(body))
+        response['Content-Encoding'] = encoding
+        # The compressed body is not byte-identical to the uncompressed one
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
@@ -0,0 +1,207 @@
+"""
+Non-blocking structured logging.
+
+Loggers write to a QueueLogHandler, which only puts the record on a bounded
+in-memory queue; a background listener thread formats it as one JSON line
+and does the actual I/O. If the queue is full the record is dropped and
+counted rather than making the request or event loop wait.
+
+Request, room and user ids are kept in context variables, bound by
+RequestLogMiddleware, the JWT authentication and the chat consumer, and
+copied onto every record. SamplingFilter rate-limits and samples chatty
+loggers; warnings and errors always pass.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+
+request_id_var = contextvars.ContextVar('request_id', default=None)
+room_id_var = contextvars.ContextVar('room_id', default=None)
+user_id_var = contextvars.ContextVar('user_id', default=None)
+
+CONTEXT_VARS = {'request_id': request_id_var, 'room_id': room_id_var, 'user_id': user_id_var}
+
+# Attributes of every LogRecord; anything else was passed in `extra`
+RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+# Request ids accepted from a proxy's X-Request-ID header
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+access_logger = logging.getLogger('porcupine.access')
+
+
+def bind(**values):
+    """Set context ids for the current request, task or connection"""
+    for name, value in values.items():
+        CONTEXT_VARS[name].set(str(value) if value is not None else None)
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+class ContextFilter(logging.Filter):
+    """Copy the bound context ids onto the record"""
+
+    def filter(self, record):
+        for name, var in CONTEXT_VARS.items():
+            if not hasattr(record, name):
+                setattr(record, name, var.get())
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Per-logger token bucket plus optional sampling for records below WARNING.
+
+    `loggers` maps a logger name prefix to its own {'rate', 'burst',
+    'sample'}; the longest matching prefix wins. The number of records
+    dropped is reported as `suppressed` on the next record that passes.
+    """
+
+    def __init__(self, rate=100, burst=500, sample=1.0, loggers=None):
+        super().__init__()
+        self.default = {'rate': rate, 'burst': burst, 'sample': sample}
+        self.loggers = loggers or {}
+        self.buckets = {}
+        self.suppressed = {}
+        self.lock = threading.Lock()
+
+    def limits(self, name):
+        match = ''
+        for prefix in self.loggers:
+            if (name == prefix or name.startswith(prefix + '.')) and len(prefix) > len(match):
+                match = prefix
+        return {**self.default, **self.loggers[match]} if match else self.default
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        limits = self.limits(record.name)
+        now = time.monotonic()
+        with self.lock:
+            allowed = limits['sample'] >= 1 or random.random() < limits['sample']
+            if allowed:
+                tokens, last = self.buckets.get(record.name, (limits['burst'], now))
+                tokens = min(limits['burst'], tokens + (now - last) * limits['rate'])
+                allowed = tokens >= 1
+                self.buckets[record.name] = (tokens - 1 if allowed else tokens, now)
+            if not allowed:
+                self.suppressed[record.name] = self.suppressed.get(record.name, 0) + 1
+                return False
+            suppressed = self.suppressed.pop(record.name, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including context ids and `extra` fields"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Hand records to a background listener writing JSON to stdout and,
+    if `filename` is set, to a file.
+    """
+
+    def __init__(self, filename='', queue_size=10000):
+        super().__init__(queue.Queue(queue_size))
+        self.dropped = 0
+
+        formatter = JsonFormatter()
+        targets = [logging.StreamHandler(sys.stdout)]
+        if filename:
+            targets.append(WatchedFileHandler(filename))
+        for target in targets:
+            target.setFormatter(formatter)
+
+        self.listener = QueueListener(self.queue, *targets, respect_handler_level=True)
+        self.listener.start()
+        self.running = True
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Write out what is still queued and stop the listener"""
+        if self.running:
+            self.running = False
+            self.listener.stop()
+
+    def prepare(self, record):
+        # Resolve the message and traceback now; the record is formatted
+        # on the listener thread after the arguments may have changed
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        dropped = self.dropped
+        if dropped:
+            record.dropped = dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped -= dropped
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+class RequestLogMiddleware:
+    """Bind request context ids and write one access log record per request"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_id = request.headers.get('X-Request-ID', '')
+        if not REQUEST_ID_RE.match(request_id):
+            request_id = new_request_id()
+        context = contextvars.copy_context()
+        started = time.perf_counter()
+        response = context.run(self.handle, request, request_id)
+        latency_ms = round((time.perf_counter() - started) * 1000, 1)
+
+        response['X-Request-ID'] = request_id
+        context.run(
+            access_logger.info, '%s %s %s', request.method, request.path, response.status_code,
+            extra={'status': response.status_code, 'latency_ms': latency_ms}
+        )
+        return response
+
+    def handle(self, request, request_id):
+        bind(request_id=request_id, room_id=None, user_id=None)
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if 'room_id' in view_kwargs:
+            bind(room_id=view_kwargs['room_id'])
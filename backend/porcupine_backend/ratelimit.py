@@ -0,0 +1,235 @@
+"""
+Rate limiting and admission control for message sends and room joins.
+
+Token buckets live in Redis and are checked with one Lua script call, so
+every worker (REST and WebSocket) shares the same per-user and per-room
+limits and a check is a single round-trip. All buckets named in a check
+must have a token; tokens are only taken when the whole check passes.
+
+Admission control watches how long database queries take on this worker.
+While the smoothed latency is above DB_LATENCY_THRESHOLD_MS, new sends and
+joins are shed (429 over REST, an error or close code 1013 over WebSocket)
+until it drops back below the recovery level.
+"""
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+from django.conf import settings
+from django.db import connection
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000 + tonumber(now[2]) / 1000
+local cost = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or burst
+    local ts = tonumber(bucket[2]) or now
+    available = math.min(burst, available + math.max(0, now - ts) * rate / 1000)
+    if available < cost then
+        wait = math.max(wait, (cost - available) * 1000 / rate)
+    end
+    tokens[i] = available
+end
+if wait > 0 then
+    return {0, math.ceil(wait)}
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[2 * i])
+    local burst = tonumber(ARGV[2 * i + 1])
+    redis.call('HSET', key, 'tokens', tostring(tokens[i] - cost), 'ts', tostring(now))
+    redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+end
+return {1, 0}
+"""
+
+
+class RateLimiter:
+    """
+    Token buckets per (action, subject), configured in settings.RATE_LIMITS:
+
+        RATE_LIMITS = {'message': {'user': (rate_per_second, burst), 'room': (...)}}
+
+    Without RATE_LIMIT_REDIS_URL the buckets are kept in process (tests and
+    single-process development). Redis errors fail open.
+    """
+
+    def __init__(self):
+        self._client = None
+        self._script = None
+        self._local = {}
+        self._lock = threading.Lock()
+
+    def buckets(self, action, subjects):
+        rules = settings.RATE_LIMITS.get(action, {})
+        return [
+            (f'ratelimit:{action}:{subject}:{value}', rules[subject])
+            for subject, value in subjects.items()
+            if subject in rules and value is not None
+        ]
+
+    def hit(self, action, **subjects):
+        """Take one token from each bucket; returns (allowed, retry_after_seconds)"""
+        buckets = self.buckets(action, subjects)
+        if not buckets:
+            return True, 0
+        if not settings.RATE_LIMIT_REDIS_URL:
+            return self._hit_local(buckets)
+
+        args = [1]
+        for _, (rate, burst) in buckets:
+            args += [rate, burst]
+        try:
+            allowed, wait_ms = self.script(keys=[key for key, _ in buckets], args=args)
+        except redis.RedisError:
+            logger.warning('Rate limiter unavailable, allowing %s', action, exc_info=True)
+            return True, 0
+        return bool(allowed), wait_ms / 1000
+
+    def script(self, keys, args):
+        if self._script is None:
+            self._client = redis.Redis.from_url(settings.RATE_LIMIT_REDIS_URL)
+            self._script = self._client.register_script(TOKEN_BUCKET_SCRIPT)
+        return self._script(keys=keys, args=args)
+
+    def _hit_local(self, buckets):
+        now = time.monotonic()
+        with self._lock:
+            states = []
+            wait = 0
+            for key, (rate, burst) in buckets:
+                tokens, ts = self._local.get(key, (burst, now))
+                tokens = min(burst, tokens + (now - ts) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                states.append((key, tokens))
+            if wait:
+                return False, math.ceil(wait * 1000) / 1000
+            for key, tokens in states:
+                self._local[key] = (tokens - 1, now)
+        return True, 0
+
+    def reset(self):
+        with self._lock:
+            self._local = {}
+
+
+class AdmissionController:
+    """
+    Sheds writes on this worker while database latency is too high.
+
+    Latency is only measured on requests that run, so while shedding one
+    request per PROBE_INTERVAL is let through to take fresh measurements;
+    otherwise a worker whose load is all shed would never recover.
+    """
+
+    def __init__(self):
+        self.latency_ms = 0.0
+        self.shedding = False
+        self.last_probe = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, duration_ms):
+        config = settings.ADMISSION_CONTROL
+        with self._lock:
+            self.latency_ms += config['SMOOTHING'] * (duration_ms - self.latency_ms)
+            threshold = config['DB_LATENCY_THRESHOLD_MS']
+            if self.latency_ms > threshold:
+                if not self.shedding:
+                    logger.warning('Database latency %.0f ms, shedding sends and joins', self.latency_ms)
+                    self.last_probe = time.monotonic()
+                self.shedding = True
+            elif self.latency_ms < threshold * config['RECOVERY_RATIO']:
+                self.shedding = False
+
+    def admit(self):
+        if not self.shedding:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if now - self.last_probe >= settings.ADMISSION_CONTROL['PROBE_INTERVAL']:
+                self.last_probe = now
+                return True
+        return False
+
+    def reset(self):
+        with self._lock:
+            self.latency_ms = 0.0
+            self.shedding = False
+            self.last_probe = 0.0
+
+
+limiter = RateLimiter()
+admission = AdmissionController()
+
+
+@contextmanager
+def track_queries():
+    """Feed the duration of every query run inside the block to admission control"""
+    def timed(execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            admission.record((time.perf_counter() - started) * 1000)
+
+    with connection.execute_wrapper(timed):
+        yield
+
+
+class DatabaseLatencyMiddleware:
+    """Measure query latency of every request for admission control"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with track_queries():
+            return self.get_response(request)
+
+
+class ActionThrottle(BaseThrottle):
+    """DRF throttle backed by the shared limiter and admission control"""
+    action = None
+
+    def get_subjects(self, request, view):
+        return {'user': request.user.id}
+
+    def allow_request(self, request, view):
+        self.retry_after = None
+        if not admission.admit():
+            self.retry_after = settings.ADMISSION_CONTROL['RETRY_AFTER']
+            return False
+        allowed, retry_after = limiter.hit(self.action, **self.get_subjects(request, view))
+        if not allowed:
+            self.retry_after = retry_after
+        return allowed
+
+    def wait(self):
+        return self.retry_after
+
+
+class MessageSendThrottle(ActionThrottle):
+    action = 'message'
+
+    def get_subjects(self, request, view):
+        return {'user': request.user.id, 'room': view.kwargs.get('room_id')}
+
+
+class JoinRoomThrottle(ActionThrottle):
+    action = 'join'
+
+    def get_subjects(self, request, view):
+        room_code = request.data.get('room_code')
+        return {'user': request.user.id, 'room': room_code.upper() if isinstance(room_code, str) else None}
@@ -0,0 +1,57 @@
+"""
+Daphne with configurable WebSocket permessage-deflate.
+
+    python -m porcupine_backend.serve -b 0.0.0.0 -p 8000 porcupine_backend.asgi:application
+
+Takes the same arguments as `daphne`. Plain daphne never negotiates
+compression; with settings.WEBSOCKET_COMPRESSION['ENABLED'] this accepts a
+client's permessage-deflate offer with the configured window size, memory
+level and context takeover.
+"""
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from django.conf import settings
+
+
+def accept_deflate(offers):
+    """autobahn perMessageCompressionAccept callback: the accepted offer or None"""
+    config = settings.WEBSOCKET_COMPRESSION
+    for offer in offers:
+        if not isinstance(offer, PerMessageDeflateOffer):
+            continue
+        window_bits = config['WINDOW_BITS']
+        if offer.request_max_window_bits:
+            window_bits = min(window_bits, offer.request_max_window_bits)
+        return PerMessageDeflateOfferAccept(
+            offer,
+            # Also bounds our decompressor for client frames
+            request_max_window_bits=config['WINDOW_BITS'] if offer.accept_max_window_bits else 0,
+            no_context_takeover=config['NO_CONTEXT_TAKEOVER'] or offer.request_no_context_takeover,
+            window_bits=window_bits,
+            mem_level=config['MEM_LEVEL'],
+        )
+    return None
+
+
+class CompressingServer(Server):
+    """Server whose WebSocket factory negotiates permessage-deflate when enabled"""
+
+    @property
+    def ws_factory(self):
+        return self.__dict__.get('_ws_factory')
+
+    @ws_factory.setter
+    def ws_factory(self, factory):
+        # Server.run() creates the factory; configure it as it is assigned
+        if factory is not None and settings.WEBSOCKET_COMPRESSION['ENABLED']:
+            factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
+        self._ws_factory = factory
+
+
+class CompressingCommandLineInterface(CommandLineInterface):
+    server_class = CompressingServer
+
+
+if __name__ == '__main__':
+    CompressingCommandLineInterface.entrypoint()
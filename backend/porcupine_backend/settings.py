@@ -4,7 +4,7 @@ Django settings for porcupine_backend project.
 
 import os
 from pathlib import Path
-from decouple import config
+from decouple import config, Csv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -36,13 +36,17 @@ LOCAL_APPS = [
     'apps.accounts',
     'apps.rooms',
     'apps.chat',
+    'apps.notifications',
 ]
 
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 
 MIDDLEWARE = [
+    'porcupine_backend.log.RequestLogMiddleware',
+    'porcupine_backend.compression.CompressionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'porcupine_backend.ratelimit.DatabaseLatencyMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -86,15 +90,129 @@ DATABASES = {
 }
 
 # Channels configuration
+# Room groups are spread over CHANNEL_REDIS_HOSTS; shards added to the registry
+# set (see `manage.py channel_shards`) are picked up without a restart.
+REDIS_URL = f"redis://{config('REDIS_HOST', default='127.0.0.1')}:{config('REDIS_PORT', default=6379, cast=int)}"
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'porcupine_backend.channel_layers.ShardedPubSubChannelLayer',
         'CONFIG': {
-            'hosts': [(config('REDIS_HOST', default='127.0.0.1'), config('REDIS_PORT', default=6379, cast=int))],
+            'hosts': config('CHANNEL_REDIS_HOSTS', default=REDIS_URL, cast=Csv()),
+            'registry': {
+                'address': config('CHANNEL_SHARD_REGISTRY', default=REDIS_URL),
+                'key': 'porcupine:channel-shards',
+            },
+            'refresh_interval': config('CHANNEL_SHARD_REFRESH', default=5, cast=int),
         },
     },
 }
 
+# Room broadcasts: clients connecting with ?coalesce=1 get events batched
+# into one frame per window; typing/presence events are shed first under load
+CHAT_BROADCAST = {
+    'COALESCE_WINDOW_MS': config('CHAT_COALESCE_WINDOW_MS', default=25, cast=int),
+    'MAX_PENDING': config('CHAT_MAX_PENDING_EVENTS', default=500, cast=int),
+}
+
+# Reconnect resume: recent messages per room are kept in Redis so a client
+# reconnecting with ?resume=<seq> only receives what it missed
+CHAT_RESUME = {
+    'CACHE_URL': config('CHAT_RESUME_CACHE_URL', default=REDIS_URL),
+    'CACHE_SIZE': config('CHAT_RESUME_CACHE_SIZE', default=200, cast=int),
+    'CACHE_TTL': 60 * 60 * 24,
+    'MAX_GAP': config('CHAT_RESUME_MAX_GAP', default=1000, cast=int),
+    'SNAPSHOT_SIZE': 50,
+}
+
+# Disappearing messages: rooms with a message_ttl are queued in Redis by
+# their next deadline and expired by `manage.py expire_messages`
+MESSAGE_EXPIRY = {
+    'QUEUE_URL': config('MESSAGE_EXPIRY_QUEUE_URL', default=REDIS_URL),
+    'BATCH_SIZE': 500,
+    'MAX_BATCHES': 20,
+    'POLL_INTERVAL': config('MESSAGE_EXPIRY_POLL_INTERVAL', default=5, cast=float),
+}
+
+# A connection heartbeats its presence in Redis every TTL / 3 seconds and
+# counts as online until TTL passes without one
+CHAT_PRESENCE = {
+    'TTL': config('CHAT_PRESENCE_TTL', default=60, cast=int),
+}
+
+# Celery runs the offline notification fan-out and digests
+# (`celery -A porcupine_backend worker -B`). With CELERY_TASK_ALWAYS_EAGER
+# tasks run inline in the sending process instead of through the broker.
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default=f'{REDIS_URL}/2')
+CELERY_TASK_ALWAYS_EAGER = config('CELERY_TASK_ALWAYS_EAGER', default=False, cast=bool)
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 4
+CELERY_BEAT_SCHEDULE = {
+    'flush-notification-digests': {
+        'task': 'apps.notifications.tasks.flush_digests',
+        'schedule': config('NOTIFICATION_FLUSH_INTERVAL', default=10, cast=float),
+    },
+}
+
+# New messages for offline members are coalesced per user and room for
+# DIGEST_WINDOW seconds, then delivered as one digest per user to each sink
+NOTIFICATIONS = {
+    'DIGEST_WINDOW': config('NOTIFICATION_DIGEST_WINDOW', default=60, cast=int),
+    'BATCH_SIZE': 500,
+    'SINKS': [
+        {'BACKEND': 'apps.notifications.sinks.LogSink'},
+    ],
+}
+
+# Rate limits as (tokens per second, burst), shared by REST and WebSocket
+# sends through Lua token buckets in Redis
+RATE_LIMIT_REDIS_URL = config('RATE_LIMIT_REDIS_URL', default=REDIS_URL)
+RATE_LIMITS = {
+    'message': {'user': (2, 20), 'room': (20, 100)},
+    'join': {'user': (0.2, 5), 'room': (1, 10)},
+}
+
+# Sends and joins are shed while smoothed database latency is above the
+# threshold, until it falls below threshold * RECOVERY_RATIO
+ADMISSION_CONTROL = {
+    'DB_LATENCY_THRESHOLD_MS': config('ADMISSION_DB_LATENCY_MS', default=250, cast=float),
+    'RECOVERY_RATIO': 0.7,
+    'SMOOTHING': 0.1,
+    'RETRY_AFTER': 5,
+    'PROBE_INTERVAL': 1,  # While shedding, let one request per interval through to re-measure
+}
+
+# API responses of MIN_SIZE bytes or more are sent with brotli (if
+# installed) or gzip. Cached history pages are stored precompressed at
+# CACHED_LEVELS, since they are compressed once and served many times.
+COMPRESSION = {
+    'MIN_SIZE': config('COMPRESSION_MIN_SIZE', default=1024, cast=int),
+    'LEVELS': {'gzip': 6, 'br': 4},
+    'CACHED_LEVELS': {'gzip': 9, 'br': 9},
+    'TYPES': ['application/json', 'text/'],
+    'EXCLUDE_PATHS': ['/api/auth/'],
+}
+
+# WebSocket permessage-deflate (needs the porcupine_backend.serve entrypoint
+# instead of plain `daphne`). Every connection keeps its own compressor of
+# about 2**(WINDOW_BITS + 2) + 2**(MEM_LEVEL + 9) bytes unless
+# NO_CONTEXT_TAKEOVER, which resets it per message at some cost in ratio.
+WEBSOCKET_COMPRESSION = {
+    'ENABLED': config('WS_COMPRESSION', default=False, cast=bool),
+    'WINDOW_BITS': config('WS_COMPRESSION_WINDOW_BITS', default=11, cast=int),
+    'MEM_LEVEL': config('WS_COMPRESSION_MEM_LEVEL', default=4, cast=int),
+    'NO_CONTEXT_TAKEOVER': config('WS_COMPRESSION_NO_CONTEXT_TAKEOVER', default=False, cast=bool),
+}
+
+# Cache (shared by all backend nodes, so version bumps invalidate everywhere)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config('CACHE_URL', default=f'{REDIS_URL}/1'),
+        'KEY_PREFIX': 'porcupine',
+    }
+}
+
 # Password validation
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
@@ -103,6 +221,24 @@ AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.NumericPasswordValidator'},
 ]
 
+# Password hashing runs in a small pool of low-priority processes so login
+# bursts cannot starve chat traffic; beyond MAX_QUEUE pending hashes auth
+# requests get 503 with Retry-After. WORKERS=0 hashes in the request thread.
+PASSWORD_HASHERS = [
+    'apps.accounts.hashers.PooledPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+PASSWORD_HASHING = {
+    'WORKERS': config('PASSWORD_HASH_WORKERS', default=2, cast=int),
+    'MAX_QUEUE': config('PASSWORD_HASH_MAX_QUEUE', default=32, cast=int),
+    'TIMEOUT': 10,
+    'RETRY_AFTER': 2,
+    'NICE': 10,
+}
+
 # Internationalization
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
@@ -118,13 +254,25 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Encrypted attachments: kept outside MEDIA_ROOT so they are never public.
+# With ATTACHMENT_SENDFILE=nginx downloads are served by the proxy from an
+# internal location mapping ACCEL_PREFIX to ROOT; 'sendfile' sets X-Sendfile.
+ATTACHMENTS = {
+    'ROOT': config('ATTACHMENT_ROOT', default=os.path.join(BASE_DIR, 'attachments')),
+    'MAX_SIZE': config('ATTACHMENT_MAX_SIZE', default=100 * 1024 * 1024, cast=int),
+    'MAX_CHUNK_SIZE': 8 * 1024 * 1024,
+    'SENDFILE': config('ATTACHMENT_SENDFILE', default=''),
+    'ACCEL_PREFIX': '/protected/attachments/',
+    'UPLOAD_EXPIRY': 60 * 60 * 24,
+}
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # REST Framework configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'apps.accounts.authentication.LazyJWTAuthentication',
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -165,23 +313,45 @@ if not DEBUG:
     SESSION_COOKIE_SECURE = True
     CSRF_COOKIE_SECURE = True
 
-# Logging
+# Logging: records are queued and written as JSON lines by a background
+# thread, so request handlers and the event loop never wait on I/O.
+# Access logs and other chatty loggers are rate limited and sampled.
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
-    'handlers': {
-        'file': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': 'django.log',
+    'filters': {
+        'context': {'()': 'porcupine_backend.log.ContextFilter'},
+        'sampling': {
+            '()': 'porcupine_backend.log.SamplingFilter',
+            'rate': 100,
+            'burst': 500,
+            'loggers': {
+                'porcupine.access': {
+                    'rate': config('LOG_ACCESS_RATE', default=200, cast=float),
+                    'burst': 1000,
+                    'sample': config('LOG_ACCESS_SAMPLE', default=1.0, cast=float),
+                },
+                'apps.chat.consumers': {
+                    'rate': 100,
+                    'burst': 500,
+                    'sample': config('LOG_MESSAGE_SAMPLE', default=0.1, cast=float),
+                },
+                'django.channels': {'rate': 20, 'burst': 100},
+                'daphne': {'rate': 20, 'burst': 100},
+            },
         },
-        'console': {
+    },
+    'handlers': {
+        'queue': {
+            '()': 'porcupine_backend.log.QueueLogHandler',
+            'filename': config('LOG_FILE', default=''),
+            'queue_size': 10000,
             'level': 'INFO',
-            'class': 'logging.StreamHandler',
+            'filters': ['sampling', 'context'],
         },
     },
     'root': {
-        'handlers': ['console'],
+        'handlers': ['queue'],
         'level': 'INFO',
     },
-}
\ No newline at end of file
+}
@@ -0,0 +1,25 @@
+"""
+Settings for WebSocket-only workers (porcupine_backend.asgi_ws).
+
+Same configuration as the main settings, but without admin, sessions,
+messages, staticfiles, whitenoise and the HTTP middleware stack, so socket
+workers import and keep resident only what the chat consumer needs.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'channels',
+    'apps.accounts',
+    'apps.rooms',
+    'apps.chat',
+    'apps.notifications',
+]
+
+MIDDLEWARE = []
+TEMPLATES = []
+ROOT_URLCONF = 'porcupine_backend.urls_ws'
+ASGI_APPLICATION = 'porcupine_backend.asgi_ws.application'
+STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
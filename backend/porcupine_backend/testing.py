@@ -0,0 +1,245 @@
+"""
+Shared helpers for the query-count and query-plan regression tests.
+
+Baselines live in ``backend/query_baselines/``:
+
+    counts.json  exact number of queries per endpoint scenario
+    plans.json   index each key query is expected to use
+    plans/       EXPLAIN output captured when baselines are updated
+
+Run ``UPDATE_QUERY_BASELINES=1 python manage.py test`` after an intended
+change (or a new scenario) to rewrite them, and review the diff; a scenario
+without a baseline fails otherwise. ``counts.json`` and ``plans.json``
+record the database they were captured on under ``_recorded_on``. Capture
+them on PostgreSQL, like production; the plan tests (QueryPlanTestCase)
+fail on other databases rather than skip.
+"""
+import json
+import os
+import re
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from apps.chat.models import Message, MessageRecipient
+from apps.rooms.models import Room, RoomMembership, SenderKeyBundle
+from .ratelimit import admission, limiter
+
+BASELINE_DIR = Path(settings.BASE_DIR) / 'query_baselines'
+UPDATE_BASELINES = os.environ.get('UPDATE_QUERY_BASELINES') == '1'
+
+# Ids, timestamps and other values that differ between runs
+PLAN_LITERAL_RE = re.compile(r"'[^']*'")
+PLAN_NUMBER_RE = re.compile(r'([=<>]) \d+\b')
+PLAN_INDEX_RE = re.compile(r'Index (?:Only )?Scan (?:using|on) (\S+)')
+
+SEED_USERS = 6
+SEED_ROOMS = 3
+SEED_MESSAGES_PER_ROOM = 20
+SEED_PASSWORD = 'correct-horse-battery'
+
+PLAN_ROOMS = 40
+PLAN_MESSAGES_PER_ROOM = 250
+
+TEST_SETTINGS = {
+    'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    'CHANNEL_LAYERS': {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    'PASSWORD_HASHERS': ['django.contrib.auth.hashers.MD5PasswordHasher'],
+    'RATE_LIMIT_REDIS_URL': '',
+}
+
+
+def load_baseline(name):
+    path = BASELINE_DIR / name
+    if not path.exists():
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(name, key, value):
+    data = load_baseline(name)
+    data[key] = value
+    BASELINE_DIR.mkdir(exist_ok=True)
+    with open(BASELINE_DIR / name, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def database_version():
+    if connection.vendor == 'postgresql':
+        version = connection.pg_version
+        return f'postgresql {version // 10000}.{version % 10000}'
+    return connection.vendor
+
+
+@override_settings(**TEST_SETTINGS)
+class SeededAPITestCase(TestCase):
+    """TestCase with a small seeded dataset and query baseline assertions"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = [
+            User.objects.create_user(
+                username=f'user{i}', email=f'user{i}@example.com', password=SEED_PASSWORD
+            )
+            for i in range(SEED_USERS)
+        ]
+        cls.user = cls.users[0]
+
+        cls.rooms = []
+        for i in range(SEED_ROOMS):
+            room = Room.objects.create(name=f'Room {i}', room_code=f'ROOM{i:02d}', created_by=cls.user)
+            for user in cls.users:
+                RoomMembership.objects.create(room=room, user=user, public_key=f'pk-{user.id}')
+            for n in range(SEED_MESSAGES_PER_ROOM):
+                sender = cls.users[n % SEED_USERS]
+                Message.objects.create_for_room(
+                    room=room, sender=sender, encrypted_content=f'ciphertext-{n}', nonce='nonce'
+                )
+            SenderKeyBundle.objects.bulk_create([
+                SenderKeyBundle(
+                    room=room, epoch=room.key_epoch, sender=sender,
+                    recipient=recipient, encrypted_key='wrapped'
+                )
+                for sender in cls.users for recipient in cls.users if sender != recipient
+            ])
+            cls.rooms.append(room)
+        cls.room = cls.rooms[0]
+        cls.message = Message.objects.filter(room=cls.room, sender=cls.user).first()
+
+    def setUp(self):
+        cache.clear()
+        limiter.reset()
+        admission.reset()
+        self.client = self.client_for(self.user)
+
+    def client_for(self, user):
+        client = APIClient()
+        token = RefreshToken.for_user(user).access_token
+        client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        return client
+
+    def assertQueryBaseline(self, name, func):
+        """Run func and assert it issues exactly the baseline number of queries"""
+        with CaptureQueriesContext(connection) as context:
+            result = func()
+        count = len(context.captured_queries)
+
+        if UPDATE_BASELINES:
+            save_baseline('counts.json', name, count)
+            save_baseline('counts.json', '_recorded_on', database_version())
+            return result
+
+        baseline = load_baseline('counts.json')
+        self.assertIn(name, baseline, f'No query baseline for {name}. Run with UPDATE_QUERY_BASELINES=1 to record it.')
+
+        queries = '\n'.join(query['sql'] for query in context.captured_queries)
+        self.assertEqual(
+            count, baseline[name],
+            f'{name}: {count} queries, baseline is {baseline[name]}. '
+            f'Run with UPDATE_QUERY_BASELINES=1 if intended.\n{queries}'
+        )
+        return result
+
+
+class QueryPlanTestCase(SeededAPITestCase):
+    """
+    SeededAPITestCase with enough extra rows for the planner to choose
+    between indexes the way it does on a live database; on a few dozen rows
+    any index, or none, is about as cheap.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        now = timezone.now()
+        rooms = Room.objects.bulk_create([
+            Room(name=f'Plan room {i}', room_code=f'PLAN{i:02d}', created_by=cls.user,
+                 last_message_seq=PLAN_MESSAGES_PER_ROOM)
+            for i in range(PLAN_ROOMS)
+        ])
+        RoomMembership.objects.bulk_create([
+            RoomMembership(room=room, user=user, public_key='pk') for room in rooms for user in cls.users
+        ])
+        messages = Message.objects.bulk_create([
+            Message(
+                room=room, sender=cls.users[n % SEED_USERS], encrypted_content='ciphertext', nonce='nonce',
+                seq=n + 1, timestamp=now - timedelta(minutes=PLAN_MESSAGES_PER_ROOM - n)
+            )
+            for room in rooms for n in range(PLAN_MESSAGES_PER_ROOM)
+        ], batch_size=2000)
+        # Mostly read, as receipts are once clients have caught up
+        MessageRecipient.objects.bulk_create([
+            MessageRecipient(
+                message=message, user=cls.users[(message.seq + 1) % SEED_USERS],
+                delivered_at=now, read_at=None if message.seq > PLAN_MESSAGES_PER_ROOM - 5 else now
+            )
+            for message in messages
+        ], batch_size=2000)
+        SenderKeyBundle.objects.bulk_create([
+            SenderKeyBundle(room=room, epoch=epoch, sender=sender, recipient=recipient, encrypted_key='wrapped')
+            for room in rooms for epoch in (1, 2)
+            for sender in cls.users for recipient in cls.users if sender != recipient
+        ], batch_size=2000)
+
+    def assertUsesIndex(self, name, queryset):
+        """
+        Assert the planner answers a key query from its intended index, with
+        the same indexes as the plan stored in plans/.
+
+        The table is analyzed and sequential scans are disabled while
+        planning, so a query shape that no index can serve is not hidden by
+        a cheap scan. Literal values are masked in the stored plan.
+        """
+        self.assertEqual(
+            connection.vendor, 'postgresql', f'{name}: query plans can only be checked on PostgreSQL'
+        )
+        expected = load_baseline('plans.json').get(name)
+        self.assertIsNotNone(expected, f'No index baseline for {name} in plans.json')
+
+        model = queryset.model
+        table = model._meta.db_table
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {connection.ops.quote_name(table)}')
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute(f'EXPLAIN (COSTS OFF) {sql}', params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        plan = PLAN_NUMBER_RE.sub(r'\1 ?', PLAN_LITERAL_RE.sub("'?'", plan))
+
+        path = BASELINE_DIR / 'plans' / f'{name}.txt'
+        if UPDATE_BASELINES:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(plan + '\n')
+            save_baseline('plans.json', '_recorded_on', database_version())
+        else:
+            self.assertTrue(
+                path.exists(), f'No plan baseline for {name}. Run with UPDATE_QUERY_BASELINES=1 to record it.'
+            )
+            # Scan types may flip on such small tables; the indexes used may not
+            self.assertEqual(
+                set(PLAN_INDEX_RE.findall(plan)), set(PLAN_INDEX_RE.findall(path.read_text())),
+                f'{name}: plan uses other indexes than plans/{path.name}:\n{plan}\n'
+                f'Run with UPDATE_QUERY_BASELINES=1 if intended.'
+            )
+
+        index_name = None
+        for index in model._meta.indexes:
+            if index.fields == expected['fields']:
+                index_name = index.name
+
+        self.assertNotIn(f'Seq Scan on {table}', plan, f'{name} scans {table} sequentially:\n{plan}')
+        if index_name:
+            self.assertIn(index_name, plan, f'{name} does not use {index_name}:\n{plan}')
+        else:
+            self.assertRegex(plan, rf'Index.* on {table}', f'{name} uses no index on {table}:\n{plan}')
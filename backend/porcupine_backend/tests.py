@@ -0,0 +1,229 @@
+import gzip
+import json
+import logging
+import queue
+from unittest import mock
+
+from autobahn.websocket.compress import PerMessageDeflateOffer
+from django.conf import settings
+from django.http import JsonResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.urls import reverse
+
+from .channel_layers import ShardedPubSubLoopLayer, affinity_key, rendezvous_pick
+from .compression import CompressionMiddleware, negotiate
+from .log import ContextFilter, JsonFormatter, QueueLogHandler, SamplingFilter, bind
+from .ratelimit import AdmissionController
+from .serve import accept_deflate
+from .testing import SeededAPITestCase
+
+
+def make_record(name='test', level=logging.INFO, msg='hello %s', args=('world',), **extra):
+    record = logging.LogRecord(name, level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class CaptureHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.addFilter(ContextFilter())
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class StructuredLoggingTests(SimpleTestCase):
+
+    def test_json_record_includes_context(self):
+        bind(request_id='req-1', room_id='room-1', user_id=7)
+        record = make_record(latency_ms=12.5)
+        ContextFilter().filter(record)
+        entry = json.loads(JsonFormatter().format(record))
+
+        self.assertEqual(entry['message'], 'hello world')
+        self.assertEqual(
+            (entry['request_id'], entry['room_id'], entry['user_id'], entry['latency_ms']),
+            ('req-1', 'room-1', '7', 12.5)
+        )
+
+    def test_rate_limit_per_logger(self):
+        sampling = SamplingFilter(rate=0.001, burst=3, loggers={'noisy': {'burst': 1}})
+        passed = [sampling.filter(make_record('noisy.sub')) for _ in range(4)]
+        self.assertEqual(passed, [True, False, False, False])
+
+        # Other loggers have their own bucket; warnings always pass
+        self.assertTrue(sampling.filter(make_record('quiet')))
+        self.assertTrue(sampling.filter(make_record('noisy.sub', level=logging.WARNING)))
+
+        sampling.buckets['noisy.sub'] = (1, sampling.buckets['noisy.sub'][1])
+        record = make_record('noisy.sub')
+        self.assertTrue(sampling.filter(record))
+        self.assertEqual(record.suppressed, 3)
+
+    def test_sampling(self):
+        sampling = SamplingFilter(rate=1000, burst=1000, loggers={'sampled': {'sample': 0.0}})
+        self.assertFalse(any(sampling.filter(make_record('sampled')) for _ in range(20)))
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        handler = QueueLogHandler(queue_size=1)
+        handler.stop()
+        for _ in range(3):
+            handler.handle(make_record())
+        self.assertEqual(handler.dropped, 2)
+
+        handler.queue = queue.Queue(1)
+        handler.handle(make_record())
+        self.assertEqual(handler.queue.get_nowait().dropped, 2)
+        handler.close()
+
+
+class RequestLogTests(SeededAPITestCase):
+
+    def test_access_log(self):
+        capture = CaptureHandler()
+        logger = logging.getLogger('porcupine.access')
+        logger.addHandler(capture)
+        self.addCleanup(logger.removeHandler, capture)
+        self.addCleanup(logger.setLevel, logger.level)
+        logger.setLevel(logging.INFO)
+
+        response = self.client.get(
+            reverse('message-list-create', args=[self.room.id]), HTTP_X_REQUEST_ID='edge-42'
+        )
+
+        self.assertEqual(response['X-Request-ID'], 'edge-42')
+        record = capture.records[-1]
+        self.assertEqual(record.request_id, 'edge-42')
+        self.assertEqual(record.room_id, str(self.room.id))
+        self.assertEqual(record.user_id, str(self.user.id))
+        self.assertEqual(record.status, 200)
+        self.assertGreater(record.latency_ms, 0)
+
+
+class CompressionTests(SimpleTestCase):
+    payload = {'results': [{'sender': {'username': f'user{i}'}, 'encrypted_content': 'x' * 40} for i in range(50)]}
+
+    def get(self, path='/api/chat/rooms/', response=None, **headers):
+        def get_response(request):
+            return response or JsonResponse(self.payload, headers={'ETag': '"abc"'})
+        return CompressionMiddleware(get_response)(RequestFactory().get(path, **headers))
+
+    def test_compresses_large_json(self):
+        response = self.get(HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(response.content)), self.payload)
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['ETag'], 'W/"abc"')
+
+    def test_skipped_responses(self):
+        skipped = [
+            self.get(),
+            self.get(HTTP_ACCEPT_ENCODING='gzip;q=0'),
+            self.get('/api/auth/login/', HTTP_ACCEPT_ENCODING='gzip'),
+            self.get(response=JsonResponse({'small': True}), HTTP_ACCEPT_ENCODING='gzip'),
+        ]
+        for response in skipped:
+            self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_negotiate(self):
+        self.assertEqual(negotiate('gzip, br', ['br', 'gzip']), 'br')
+        self.assertEqual(negotiate('br;q=0, *', ['br', 'gzip']), 'gzip')
+        self.assertEqual(negotiate('identity', ['br', 'gzip']), None)
+
+    @override_settings(WEBSOCKET_COMPRESSION={**settings.WEBSOCKET_COMPRESSION, 'WINDOW_BITS': 12})
+    def test_websocket_deflate_respects_client_limits(self):
+        accept = accept_deflate([PerMessageDeflateOffer(request_max_window_bits=10, request_no_context_takeover=True)])
+        self.assertEqual(accept.window_bits, 10)
+        self.assertEqual(accept.request_max_window_bits, 12)
+        self.assertTrue(accept.no_context_takeover)
+        self.assertIsNone(accept_deflate([]))
+
+
+class AdmissionControlTests(SimpleTestCase):
+
+    @override_settings(ADMISSION_CONTROL={
+        **settings.ADMISSION_CONTROL,
+        'DB_LATENCY_THRESHOLD_MS': 100, 'RECOVERY_RATIO': 0.5, 'SMOOTHING': 0.5, 'PROBE_INTERVAL': 1
+    })
+    def test_recovers_after_spike_without_other_traffic(self):
+        controller = AdmissionController()
+        with mock.patch('time.monotonic', return_value=1000.0) as now:
+            controller.record(1000)
+            self.assertFalse(controller.admit())
+
+            # Everything is shed, but one probe per interval gets through
+            now.return_value = 1001.0
+            self.assertTrue(controller.admit())
+            self.assertFalse(controller.admit())
+
+            # The probe's queries are fast again
+            for _ in range(5):
+                controller.record(1)
+            self.assertTrue(controller.admit())
+
+
+class ChannelShardingTests(SimpleTestCase):
+
+    addresses = [f'redis://redis-{i}:6379' for i in range(4)]
+
+    def placements(self, addresses, keys=1000):
+        return {key: rendezvous_pick(key, addresses) for key in (f'room.{n}' for n in range(keys))}
+
+    def test_affinity_key(self):
+        self.assertEqual(affinity_key('asgi__group__room.abc'), 'room.abc')
+        self.assertEqual(affinity_key('asgi__group__room.abc.presence'), 'room.abc')
+        self.assertEqual(affinity_key('specific.abc!def'), 'specific.abc!def')
+
+    def test_placement_is_stable(self):
+        self.assertEqual(self.placements(self.addresses), self.placements(list(reversed(self.addresses))))
+        # Spread over every shard
+        self.assertEqual(set(self.placements(self.addresses).values()), set(self.addresses))
+
+    def test_adding_a_shard_only_moves_groups_to_it(self):
+        before = self.placements(self.addresses)
+        after = self.placements(self.addresses + ['redis://redis-4:6379'])
+        moved = [key for key in before if before[key] != after[key]]
+        self.assertEqual({after[key] for key in moved}, {'redis://redis-4:6379'})
+        self.assertLess(len(moved), len(before) * 0.3)
+
+    def test_removing_a_shard_only_moves_its_groups(self):
+        before = self.placements(self.addresses)
+        after = self.placements(self.addresses[1:])
+        moved = [key for key in before if before[key] != after[key]]
+        self.assertEqual({before[key] for key in moved}, {self.addresses[0]})
+
+    async def test_moved_subscriptions_drain_after_grace_period(self):
+        layer = ShardedPubSubLoopLayer(hosts=self.addresses[:2], refresh_interval=5)
+        layer._shards_by_address = {address: mock.AsyncMock() for address in self.addresses[:2]}
+        layer._shards = list(layer._shards_by_address.values())
+        layer._placement = {}
+        names = [layer._get_group_channel_name(f'room.{n}') for n in range(50)]
+        layer.groups = {name: {'specific.x'} for name in names}
+        before = {name: layer._get_shard(name) for name in names}
+        removed = layer._shards_by_address[self.addresses[0]]
+
+        with mock.patch('porcupine_backend.channel_layers.RedisSingleShardConnection') as connection:
+            connection.side_effect = lambda host, layer: mock.AsyncMock()
+            await layer._apply_shards(set(self.addresses[1:3]))
+
+        moved = [name for name in names if layer._get_shard(name) is not before[name]]
+        self.assertTrue(moved)
+        for name in moved:
+            layer._get_shard(name).subscribe.assert_any_await(name)
+
+        # Still subscribed on the old shard during the grace period
+        await layer._drain_expired()
+        removed.unsubscribe.assert_not_awaited()
+        removed.flush.assert_not_awaited()
+
+        layer._draining = [(0, shard, name) for _, shard, name in layer._draining]
+        await layer._drain_expired()
+        removed.flush.assert_awaited_once()
+        kept = layer._shards_by_address[self.addresses[1]]
+        self.assertEqual(
+            {call.args[0] for call in kept.unsubscribe.await_args_list},
+            {name for name in moved if before[name] is kept},
+        )
+        self.assertEqual(layer._draining, [])
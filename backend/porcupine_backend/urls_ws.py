@@ -0,0 +1,4 @@
+"""
+URL configuration for WebSocket-only workers: no HTTP routes.
+"""
+urlpatterns = []